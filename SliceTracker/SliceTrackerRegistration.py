@@ -1,8 +1,11 @@
 import argparse, sys, os, logging
-import qt, slicer
+import re, time
+import numpy
+import qt, vtk, slicer
 from slicer.ScriptedLoadableModule import *
 from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin, ModuleWidgetMixin
 from SliceTrackerUtils.sessionData import *
+from SliceTrackerUtils.jobs import Job
 from SliceTrackerUtils.constants import SliceTrackerConstants
 from SlicerDevelopmentToolboxUtils.decorators import onReturnProcessEvents
 
@@ -130,13 +133,224 @@ class SliceTrackerRegistrationWidget(ScriptedLoadableModuleWidget, ModuleWidgetM
           setattr(self.progress, key, value)
 
 
+class PrecomputedMovingImage(ModuleLogicMixin):
+  """ Cropped and intensity normalized copy of a moving image and its mask
+
+  Every guidance registration uses the approved cover prostate image as moving image. Cropping it to the (margin
+  extended) prostate region and normalizing its intensities once spares BRAINSFit from processing the full field of
+  view on each run.
+  """
+
+  CROP_MARGIN_MM = 20.0
+  NORMALIZATION_PERCENTILES = (0.5, 99.5)
+
+  def __init__(self, volume, label, prefix=""):
+    self.sourceVolume = volume
+    self.sourceLabel = label
+    self.prefix = prefix
+    self.volume = None
+    self.label = None
+    self._sourceModifiedTimes = self._getSourceModifiedTimes()
+    self._compute()
+
+  def isValidFor(self, volume, label):
+    return self.volume is not None and volume is self.sourceVolume and label is self.sourceLabel and \
+           self._getSourceModifiedTimes() == self._sourceModifiedTimes
+
+  def clear(self):
+    for node in [self.volume, self.label]:
+      if node and node.GetScene():
+        slicer.mrmlScene.RemoveNode(node)
+    self.volume = None
+    self.label = None
+
+  def _getSourceModifiedTimes(self):
+    return tuple(node.GetImageData().GetMTime() if node.GetImageData() else None
+                 for node in [self.sourceVolume, self.sourceLabel])
+
+  def _compute(self):
+    volumeArray = slicer.util.arrayFromVolume(self.sourceVolume)
+    labelArray = self._getLabelArrayOnVolumeGrid()
+    lower, upper = self._getCropExtent(labelArray)
+    region = tuple(slice(l, u) for l, u in zip(lower, upper))
+
+    self.volume = self.createScalarVolumeNode(self.prefix + "-PRECOMPUTED-moving")
+    self._copyCroppedGeometry(self.sourceVolume, self.volume, lower)
+    slicer.util.updateVolumeFromArray(self.volume, self._normalize(volumeArray[region]))
+
+    self.label = self.volumesLogic.CreateAndAddLabelVolume(slicer.mrmlScene, self.volume,
+                                                           self.prefix + "-PRECOMPUTED-moving-label")
+    slicer.util.updateVolumeFromArray(self.label, labelArray[region].copy())
+    logging.debug("Precomputed moving image %s: cropped %s to %s" % (self.sourceVolume.GetName(),
+                                                                    str(volumeArray.shape),
+                                                                    str(tuple(u - l for l, u in zip(lower, upper)))))
+
+  def _getLabelArrayOnVolumeGrid(self):
+    labelArray = slicer.util.arrayFromVolume(self.sourceLabel)
+    if labelArray.shape == slicer.util.arrayFromVolume(self.sourceVolume).shape and \
+      numpy.allclose(self._getIJKToRASArray(self.sourceLabel), self._getIJKToRASArray(self.sourceVolume)):
+      return labelArray
+    resampledLabel = self.volumesLogic.CreateAndAddLabelVolume(slicer.mrmlScene, self.sourceVolume,
+                                                               "temp-precomputed-label")
+    self.runBRAINSResample(inputVolume=self.sourceLabel, referenceVolume=self.sourceVolume,
+                           outputVolume=resampledLabel)
+    labelArray = slicer.util.arrayFromVolume(resampledLabel).copy()
+    slicer.mrmlScene.RemoveNode(resampledLabel)
+    return labelArray
+
+  @staticmethod
+  def _getIJKToRASArray(volume):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volume.GetIJKToRASMatrix(ijkToRAS)
+    return numpy.array([[ijkToRAS.GetElement(row, col) for col in range(4)] for row in range(4)])
+
+  def _getCropExtent(self, labelArray):
+    shape = labelArray.shape
+    indices = numpy.nonzero(labelArray)
+    if not len(indices[0]):
+      return [0] * len(shape), list(shape)
+    spacing = list(reversed(self.sourceVolume.GetSpacing()))  # array axes are ordered k, j, i
+    margin = [int(numpy.ceil(self.CROP_MARGIN_MM / s)) for s in spacing]
+    lower = [max(int(idx.min()) - m, 0) for idx, m in zip(indices, margin)]
+    upper = [min(int(idx.max()) + m + 1, size) for idx, m, size in zip(indices, margin, shape)]
+    return lower, upper
+
+  def _copyCroppedGeometry(self, sourceVolume, targetVolume, lowerKJI):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    sourceVolume.GetIJKToRASMatrix(ijkToRAS)
+    targetVolume.SetIJKToRASMatrix(ijkToRAS)
+    origin = ijkToRAS.MultiplyPoint(list(reversed(lowerKJI)) + [1.0])
+    targetVolume.SetOrigin(origin[:3])
+
+  def _normalize(self, data):
+    data = data.astype(numpy.float32)
+    low, high = numpy.percentile(data, self.NORMALIZATION_PERCENTILES)
+    if high <= low:
+      return data - low
+    return numpy.clip((data - low) / (high - low), 0.0, 1.0)
+
+
+class RegistrationThroughputEstimator(object):
+  """ Keeps track of the BRAINSFit throughput per registration stage
+
+  Throughput is measured in processed samples (fixed image voxels * samplingPercentage * numberOfIterations) per
+  second and used for adapting the stage settings of subsequent registrations to a given time budget.
+  """
+
+  DEFAULT_SETTINGS = {'numberOfIterations': 1500, 'samplingPercentage': 0.002}
+  MINIMUM_SCALE = 0.1
+  SAFETY_FACTOR = 0.8
+  SMOOTHING = 0.5
+
+  def __init__(self):
+    self.rates = {}
+
+  def getWork(self, fixedVolume, settings):
+    return fixedVolume.GetImageData().GetNumberOfPoints() * float(settings['samplingPercentage']) * \
+           int(settings['numberOfIterations'])
+
+  def record(self, stage, fixedVolume, settings, elapsedTime):
+    if elapsedTime <= 0:
+      return
+    rate = self.getWork(fixedVolume, settings) / elapsedTime
+    previous = self.rates.get(stage)
+    self.rates[stage] = rate if previous is None else self.SMOOTHING * rate + (1 - self.SMOOTHING) * previous
+    logging.debug("Throughput of %s registration: %.0f samples/s" % (stage, self.rates[stage]))
+
+  def predictDuration(self, stage, fixedVolume, settings=None):
+    if stage not in self.rates:
+      return None
+    return self.getWork(fixedVolume, settings or self.DEFAULT_SETTINGS) / self.rates[stage]
+
+  def getSettings(self, stage, remainingStages, fixedVolume, remainingTime):
+    """ returns stage settings that fit the share of remainingTime which is allotted to the given stage """
+    settings = dict(self.DEFAULT_SETTINGS)
+    predictions = [self.predictDuration(s, fixedVolume) for s in remainingStages]
+    prediction = self.predictDuration(stage, fixedVolume)
+    if prediction is None or remainingTime is None:
+      return settings
+    if None in predictions:
+      allottedTime = remainingTime / len(remainingStages)
+    else:
+      allottedTime = remainingTime * prediction / sum(predictions)
+    scale = min(1.0, max(self.MINIMUM_SCALE, self.SAFETY_FACTOR * allottedTime / prediction))
+    if scale < 1.0:
+      factor = scale ** 0.5
+      settings['numberOfIterations'] = max(1, int(settings['numberOfIterations'] * factor))
+      settings['samplingPercentage'] = settings['samplingPercentage'] * factor
+      logging.debug("Reducing work of %s registration to %d%% in order to meet the deadline" % (stage, scale * 100))
+    return settings
+
+
+class CLIProgressMonitor(object):
+  """ Collects progress and optimizer metric values of a running BRAINSFit CLI node
+
+  Metric values are parsed from the lines BRAINSFit's iteration observer prints to the CLI output while the CLI module
+  is running: the iteration number followed by the metric value and the current parameters, e.g.
+  "12   -0.4321   [0.01, 0.02, ...]".
+  """
+
+  METRIC_LINE_PATTERN = re.compile(r"^[ \t]*(\d+)[ \t]+([-+]?(?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][-+]?\d+)?)"
+                                   r"(?:[ \t].*)?$", re.MULTILINE)
+
+  @property
+  def lastMetricValue(self):
+    return self.metricValues[-1] if self.metricValues else (None, None)
+
+  def __init__(self, stage, callback=None):
+    self.stage = stage
+    self.callback = callback
+    self.metricValues = []
+    self.progress = 0.0
+    self.estimatedRemainingTime = None
+    self.elapsedTime = 0.0
+    self._parsedLength = 0
+
+  def __call__(self, job):
+    self.progress = job.progress
+    self.elapsedTime = job.elapsedTime
+    self.estimatedRemainingTime = job.getEstimatedRemainingTime()
+    self._parseOutput(job.cliNode.GetOutputText() or "")
+    if self.callback:
+      self.callback(self)
+
+  def _parseOutput(self, output):
+    unparsed = output[self._parsedLength:]
+    completeLinesLength = unparsed.rfind("\n") + 1
+    for match in self.METRIC_LINE_PATTERN.finditer(unparsed[:completeLinesLength]):
+      iteration, value = int(match.group(1)), float(match.group(2))
+      self.metricValues.append((iteration, value))
+      logging.debug("%s registration iteration %d: metric %f" % (self.stage, iteration, value))
+    self._parsedLength += completeLinesLength
+
+  def getStatusText(self):
+    text = "%s registration: %d%%" % (self.stage, self.progress * 100)
+    iteration, value = self.lastMetricValue
+    if iteration is not None:
+      text += " | iteration %d, metric %.5f" % (iteration, value)
+    if self.estimatedRemainingTime is not None:
+      text += " | ~%ds remaining" % self.estimatedRemainingTime
+    return text
+
+  def logSummary(self):
+    iteration, value = self.lastMetricValue
+    logging.info("%s registration took %.1fs (%d metric evaluations, final metric %s)"
+                 % (self.stage, self.elapsedTime, len(self.metricValues), value))
+
+
 class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin):
 
+  STAGE_NAMES = {'rigid': 'Rigid', 'affine': 'Affine', 'bSpline': 'BSpline'}
+
   counter = 1
 
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
     self.registrationResult = None
+    self.originalMovingVolume = None
+    self.scheduler = None
+    self.throughputEstimator = RegistrationThroughputEstimator()
+    self.deadline = None
 
   def _processParameterNode(self, parameterNode):
     if not self.registrationResult:
@@ -146,9 +360,16 @@ class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixi
     result.labels.fixed = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('FixedLabelNodeID'))
     result.labels.moving = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingLabelNodeID'))
     movingVolume = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingImageNodeID'))
-    result.volumes.moving = self.volumesLogic.CloneVolume(slicer.mrmlScene, movingVolume,
-                                                          "temp-movingVolume_" + str(self.counter))
-    self.counter += 1
+    precomputedVolumeID = parameterNode.GetAttribute('PrecomputedMovingImageNodeID')
+    if precomputedVolumeID:
+      self.originalMovingVolume = movingVolume
+      result.volumes.moving = slicer.mrmlScene.GetNodeByID(precomputedVolumeID)
+      result.labels.moving = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('PrecomputedMovingLabelNodeID'))
+    else:
+      self.originalMovingVolume = None
+      result.volumes.moving = self.volumesLogic.CloneVolume(slicer.mrmlScene, movingVolume,
+                                                            "temp-movingVolume_" + str(self.counter))
+      self.counter += 1
 
     logging.debug("Fixed Image Name: %s" % result.volumes.fixed.GetName())
     logging.debug("Fixed Label Name: %s" % result.labels.fixed.GetName())
@@ -160,22 +381,35 @@ class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixi
       logging.debug("Initial Registration Name: %s" % initialTransform.GetName())
     return result
 
-  def run(self, parameterNode, progressCallback=None):
+  def run(self, parameterNode, progressCallback=None, deadline=None):
     self.progressCallback = progressCallback
+    self.deadline = time.time() + deadline if deadline else None
     result = self._processParameterNode(parameterNode)
+    result.truncated = False
 
     registrationTypes = ['rigid', 'affine', 'bSpline']
     self.createVolumeAndTransformNodes(registrationTypes, prefix=str(result.seriesNumber), suffix=result.suffix)
 
-    self.doRigidRegistration(movingBinaryVolume=result.labels.moving, initializeTransformMode="useCenterOfROIAlign")
-    self.doAffineRegistration()
-    self.doBSplineRegistration(initialTransform=result.transforms.affine)
+    # the rigid stage always runs to completion, the deadline can only cut off affine and bSpline
+    if not self.doRigidRegistration(movingBinaryVolume=result.labels.moving,
+                                    initializeTransformMode="useCenterOfROIAlign"):
+      self.deadline = None
+      self._restoreMovingData(parameterNode)
+      raise RuntimeError("Rigid registration did not complete")
+    completed = ['rigid']
+    if self.doAffineRegistration():
+      completed.append('affine')
+      if self.doBSplineRegistration(initialTransform=result.transforms.affine):
+        completed.append('bSpline')
+    if len(completed) < len(registrationTypes):
+      self._useBestCompletedStage(registrationTypes, completed)
+    self.deadline = None
 
     targetsNodeID = parameterNode.GetAttribute('TargetsNodeID')
     if targetsNodeID:
       result.targets.original = slicer.mrmlScene.GetNodeByID(targetsNodeID)
       self.transformTargets(registrationTypes, result.targets.original, str(result.seriesNumber), suffix=result.suffix)
-    result.volumes.moving = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingImageNodeID'))
+    self._restoreMovingData(parameterNode)
 
   def runReRegistration(self, parameterNode, progressCallback=None):
     logging.debug("Starting Re-Registration")
@@ -203,7 +437,44 @@ class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixi
     if targetsNodeID:
       result.targets.original = slicer.mrmlScene.GetNodeByID(targetsNodeID)
       self.transformTargets(registrationTypes, result.originalTargets, str(result.seriesNumber), suffix=result.suffix)
-    result.movingVolume = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingImageNodeID'))
+    self._restoreMovingData(parameterNode)
+
+  def _restoreMovingData(self, parameterNode):
+    result = self.registrationResult
+    result.volumes.moving = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingImageNodeID'))
+    result.labels.moving = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('MovingLabelNodeID'))
+    self.originalMovingVolume = None
+
+  def _useBestCompletedStage(self, registrationTypes, completed):
+    """ replaces the outputs of stages cut off by the deadline with copies of the last completed stage
+
+    Cancelled BRAINSFit runs do not write any output, so their partial progress is lost.
+    """
+    result = self.registrationResult
+    result.truncated = True
+    best = completed[-1]
+    logging.warn("Registration deadline was reached. Falling back to %s registration result" % best)
+    matrix = vtk.vtkMatrix4x4()
+    result.getTransform(best).GetMatrixTransformToParent(matrix)
+    for regType in [t for t in registrationTypes if t not in completed]:
+      transform, volume = result.getTransform(regType), result.getVolume(regType)
+      transformName, volumeName = transform.GetName(), volume.GetName()
+      for node in [transform, volume]:
+        slicer.mrmlScene.RemoveNode(node)
+      transform = self.createLinearTransformNode(transformName)
+      transform.SetMatrixTransformToParent(matrix)
+      result.setTransform(regType, transform)
+      result.setVolume(regType, self.volumesLogic.CloneVolume(slicer.mrmlScene, result.getVolume(best), volumeName))
+    self.updateProgress(labelText='\nRegistration truncated at %s stage' % best, value=4)
+
+  def getRemainingTime(self):
+    return None if self.deadline is None else self.deadline - time.time()
+
+  def _applyStageSettings(self, stage, remainingStages, params):
+    remainingTime = self.getRemainingTime()
+    if remainingTime is not None:
+      params.update(self.throughputEstimator.getSettings(stage, remainingStages, self.registrationResult.volumes.fixed,
+                                                         remainingTime))
 
   def createVolumeAndTransformNodes(self, registrationTypes, prefix, suffix=""):
     for regType in registrationTypes:
@@ -239,8 +510,10 @@ class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixi
                    'useRigid': True}
     for key, value in kwargs.iteritems():
       paramsRigid[key] = value
-    slicer.cli.run(slicer.modules.brainsfit, None, paramsRigid, wait_for_completion=True)
+    self._applyStageSettings('rigid', ['rigid', 'affine', 'bSpline'], paramsRigid)
+    completed = self._runBRAINSFit('rigid', paramsRigid, self.registrationResult.transforms.rigid)
     self.registrationResult.cmdArguments += "Rigid Registration Parameters: %s" % str(paramsRigid) + "\n\n"
+    return completed
 
   def doAffineRegistration(self):
     self.updateProgress(labelText='\nAffine registration', value=2)
@@ -253,8 +526,10 @@ class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixi
                     'maskProcessingMode': "ROI",
                     'useAffine': True,
                     'initialTransform': self.registrationResult.transforms.rigid}
-    slicer.cli.run(slicer.modules.brainsfit, None, paramsAffine, wait_for_completion=True)
+    self._applyStageSettings('affine', ['affine', 'bSpline'], paramsAffine)
+    completed = self._runBRAINSFit('affine', paramsAffine, self.registrationResult.transforms.affine)
     self.registrationResult.cmdArguments += "Affine Registration Parameters: %s" % str(paramsAffine) + "\n\n"
+    return completed
 
   def doBSplineRegistration(self, initialTransform, **kwargs):
     self.updateProgress(labelText='\nBSpline registration', value=3)
@@ -276,10 +551,55 @@ class SliceTrackerRegistrationLogic(ScriptedLoadableModuleLogic, ModuleLogicMixi
     for key, value in kwargs.iteritems():
       paramsBSpline[key] = value
 
-    slicer.cli.run(slicer.modules.brainsfit, None, paramsBSpline, wait_for_completion=True)
+    self._applyStageSettings('bSpline', ['bSpline'], paramsBSpline)
+    completed = self._runBRAINSFit('bSpline', paramsBSpline, self.registrationResult.transforms.bSpline)
     self.registrationResult.cmdArguments += "BSpline Registration Parameters: %s" % str(paramsBSpline) + "\n\n"
 
-    self.updateProgress(labelText='\nCompleted registration', value=4)
+    if completed:
+      self.updateProgress(labelText='\nCompleted registration', value=4)
+    return completed
+
+  def _runCLI(self, module, params, timeout=None, progressMonitor=None):
+    if self.scheduler:
+      cliNode = self.scheduler.runCLI(module, params, priority=Job.INTERACTIVE_REGISTRATION, timeout=timeout,
+                                      progressCallback=progressMonitor)
+    elif timeout is None:
+      cliNode = slicer.cli.run(module, None, params, wait_for_completion=True)
+    else:
+      raise ValueError("Running CLI modules with a timeout requires a job scheduler")
+    return cliNode.GetStatus() == cliNode.Completed
+
+  def _runBRAINSFit(self, stage, params, outputTransform):
+    remainingTime = None if stage == 'rigid' else self.getRemainingTime()
+    if remainingTime is not None and remainingTime <= 0:
+      return False
+    runParams = dict(params)
+    if self.originalMovingVolume:
+      # registering the precomputed image would otherwise produce a cropped and normalized output volume
+      outputVolumeID = runParams.pop('outputVolume')
+    startTime = time.time()
+    monitor = CLIProgressMonitor(self.STAGE_NAMES[stage], callback=self._onStageProgress)
+    completed = self._runCLI(slicer.modules.brainsfit, runParams, timeout=remainingTime,
+                             progressMonitor=monitor if self.scheduler else None)
+    monitor.logSummary()
+    if not completed:
+      return False
+    settings = dict(RegistrationThroughputEstimator.DEFAULT_SETTINGS)
+    settings.update({k: v for k, v in params.iteritems() if k in settings})
+    self.throughputEstimator.record(stage, self.registrationResult.volumes.fixed, settings, time.time() - startTime)
+    if not self.originalMovingVolume:
+      return True
+    paramsResample = {'inputVolume': self.originalMovingVolume,
+                      'referenceVolume': self.registrationResult.volumes.fixed,
+                      'outputVolume': outputVolumeID,
+                      'warpTransform': outputTransform,
+                      'interpolationMode': 'Linear'}
+    return self._runCLI(slicer.modules.brainsresample, paramsResample)
+
+  def _onStageProgress(self, monitor):
+    statusText = monitor.getStatusText()
+    slicer.util.showStatusMessage(statusText)
+    self.updateProgress(labelText="\n" + statusText)
 
   def updateProgress(self, **kwargs):
     if self.progressCallback:
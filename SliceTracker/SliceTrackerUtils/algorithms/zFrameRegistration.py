@@ -1,16 +1,22 @@
 import os
 import sys
+import logging
+import numpy
 
 import slicer
+import SimpleITK as sitk
 from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
 
+from ..jobs import Job
+
 
 class ZFrameRegistrationBase(ModuleLogicMixin):
 
   ZFRAME_TRANSFORM_NAME = "ZFrameTransform"
 
-  def __init__(self, inputVolume):
+  def __init__(self, inputVolume, scheduler=None):
     self.inputVolume = inputVolume
+    self.scheduler = scheduler
     self.outputTransform = None
     self.outputVolume = None
 
@@ -23,11 +29,16 @@ class ZFrameRegistrationBase(ModuleLogicMixin):
   def runRegistration(self):
     raise NotImplementedError
 
+  def runCLI(self, module, params):
+    if self.scheduler:
+      return self.scheduler.runCLI(module, params, priority=Job.ZFRAME_REGISTRATION)
+    return slicer.cli.run(module, None, params, wait_for_completion=True)
+
 
 class LineMarkerRegistration(ZFrameRegistrationBase):
 
-  def __init__(self, inputVolume):
-    super(LineMarkerRegistration, self).__init__(inputVolume)
+  def __init__(self, inputVolume, scheduler=None):
+    super(LineMarkerRegistration, self).__init__(inputVolume, scheduler)
     self.markerConfigPath = os.path.join(os.path.dirname(sys.modules[self.__module__].__file__), '..', 'Resources',
                                          'zframe', 'zframe-config.csv')
 
@@ -40,13 +51,13 @@ class LineMarkerRegistration(ZFrameRegistrationBase):
 
     params = {'inputVolume': self.inputVolume, 'markerConfigFile': self.markerConfigPath,
               'outputVolume': self.outputVolume, 'markerTransform': self.outputTransform}
-    slicer.cli.run(slicer.modules.linemarkerregistration, None, params, wait_for_completion=True)
+    self.runCLI(slicer.modules.linemarkerregistration, params)
 
 
 class OpenSourceZFrameRegistration(ZFrameRegistrationBase):
 
-  def __init__(self, inputVolume):
-    super(OpenSourceZFrameRegistration, self).__init__(inputVolume)
+  def __init__(self, inputVolume, scheduler=None):
+    super(OpenSourceZFrameRegistration, self).__init__(inputVolume, scheduler)
 
   def runRegistration(self, start, end):
     assert start != -1 and end != -1
@@ -55,4 +66,166 @@ class OpenSourceZFrameRegistration(ZFrameRegistrationBase):
 
     params = {'inputVolume': self.inputVolume, 'startSlice': start, 'endSlice': end,
               'outputTransform': self.outputTransform}
-    slicer.cli.run(slicer.modules.zframeregistration, None, params, wait_for_completion=True)
\ No newline at end of file
+    self.runCLI(slicer.modules.zframeregistration, params)
+
+
+def labelSliceIslands(array):
+  """ labels the islands of every slice (first array axis) in a single pass
+
+  Slices get stacked into one 2D image separated by an empty row, so that islands cannot connect across slices.
+  Returns the labels with shape (slices, rows + 1, columns) and the slice index of each label (-1 for background and
+  unused labels).
+  """
+  numberOfSlices, rows, columns = array.shape
+  mosaic = numpy.zeros((numberOfSlices, rows + 1, columns), dtype=numpy.uint8)
+  mosaic[:, :rows, :] = array != 0
+  labelImage = sitk.ConnectedComponent(sitk.GetImageFromArray(mosaic.reshape(-1, columns)))
+  labels = sitk.GetArrayFromImage(labelImage).reshape(mosaic.shape)
+  sliceOfLabel = numpy.full(int(labels.max()) + 1, -1, dtype=numpy.int64)
+  sliceOfLabel[labels] = numpy.arange(numberOfSlices)[:, numpy.newaxis, numpy.newaxis]
+  sliceOfLabel[0] = -1
+  return labels, sliceOfLabel
+
+
+class ZFrameROILocalizer(object):
+  """ Localizes the z-frame fiducial rods within a cover template volume
+
+  Rods show up as small bright islands in every slice crossing the frame. The volume gets thresholded (Otsu) and the
+  islands of all slices get labeled at once. Islands with a rod-like cross section area are kept and the longest run of
+  consecutive slices with at least ROD_COUNT of them is taken as start/end. The bounding box of those islands plus
+  MARGIN is proposed as ROI.
+  """
+
+  ROD_COUNT = 7
+  ROD_AREA_RANGE = (2.0, 80.0)  # mm^2
+  MINIMUM_NUMBER_OF_SLICES = 3
+  MARGIN = 10.0  # mm
+
+  def __init__(self, inputVolume):
+    self.inputVolume = inputVolume
+
+  def localize(self):
+    """ returns ((minimumIJK, maximumIJK), startSlice, endSlice) or None if no z-frame was found """
+    array = slicer.util.arrayFromVolume(self.inputVolume)
+    thresholdFilter = sitk.OtsuThresholdImageFilter()
+    thresholdFilter.Execute(sitk.GetImageFromArray(array))
+    labels, sliceOfLabel = labelSliceIslands(array > thresholdFilter.GetThreshold())
+
+    spacing = numpy.array(self.inputVolume.GetSpacing())
+    areas = numpy.bincount(labels.ravel()) * spacing[0] * spacing[1]
+    rods = (sliceOfLabel >= 0) & (areas >= self.ROD_AREA_RANGE[0]) & (areas <= self.ROD_AREA_RANGE[1])
+    rodsPerSlice = numpy.bincount(sliceOfLabel[rods], minlength=array.shape[0])
+    run = self.getLongestRun(rodsPerSlice >= self.ROD_COUNT)
+    if run is None or run[1] - run[0] + 1 < self.MINIMUM_NUMBER_OF_SLICES:
+      return None
+    startSlice, endSlice = run
+
+    rods &= (sliceOfLabel >= startSlice) & (sliceOfLabel <= endSlice)
+    k, j, i = numpy.nonzero(rods[labels])
+    margin = numpy.ceil(self.MARGIN / spacing).astype(int)
+    dimensions = numpy.array(self.inputVolume.GetImageData().GetDimensions())
+    minimumIJK = numpy.maximum(numpy.array([i.min(), j.min(), k.min()]) - margin, 0)
+    maximumIJK = numpy.minimum(numpy.array([i.max(), j.max(), k.max()]) + margin, dimensions - 1)
+    return (minimumIJK, maximumIJK), startSlice, endSlice
+
+  @staticmethod
+  def getLongestRun(mask):
+    """ returns first and last index of the longest run of True values or None """
+    edges = numpy.diff(numpy.concatenate([[0], numpy.asarray(mask, dtype=int), [0]]))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1) - 1
+    if not len(starts):
+      return None
+    longest = int(numpy.argmax(ends - starts))
+    return int(starts[longest]), int(ends[longest])
+
+
+class NeedlePathSearch(object):
+  """ Finds the nearest needle path and the depth along it for many targets at once
+
+  Path origins and directions are held as (N,3) arrays. Without index, all targets get compared to all paths in one
+  NumPy operation. With index (by default for more than INDEX_THRESHOLD paths), path origins get bucketed into a 2D
+  grid perpendicular to the path direction and each target only gets compared to the paths of the surrounding cells.
+  The index requires parallel paths, which is the case for needle guide templates; otherwise all paths get compared.
+  """
+
+  INDEX_THRESHOLD = 1000
+  PARALLEL_TOLERANCE = 1e-6
+
+  def __init__(self, origins, directions, useIndex=None):
+    self.origins = numpy.asarray(origins, dtype=float).reshape(-1, 3)
+    self.directions = numpy.asarray(directions, dtype=float).reshape(-1, 3)
+    if useIndex is None:
+      useIndex = len(self.origins) > self.INDEX_THRESHOLD
+    self._grid = self._createGrid() if useIndex and len(self.origins) else None
+
+  def findNearest(self, positions):
+    """ returns the nearest path index (-1 if there are no paths) and the depth along it for each of the positions """
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    if not len(self.origins):
+      return numpy.full(len(positions), -1, dtype=int), numpy.zeros(len(positions))
+    if self._grid is None:
+      nearest = self._findNearestPaths(positions)
+    else:
+      nearest = numpy.array([self._findNearestPathUsingGrid(position) for position in positions], dtype=int)
+    depths = numpy.einsum('mk,mk->m', positions - self.origins[nearest], self.directions[nearest])
+    return nearest, depths
+
+  def _findNearestPaths(self, positions, candidates=None):
+    origins = self.origins if candidates is None else self.origins[candidates]
+    directions = self.directions if candidates is None else self.directions[candidates]
+    offsets = positions[:, numpy.newaxis, :] - origins[numpy.newaxis, :, :]
+    depths = numpy.einsum('mnk,nk->mn', offsets, directions)
+    perpendicular = offsets - depths[..., numpy.newaxis] * directions
+    distances = numpy.einsum('mnk,mnk->mn', perpendicular, perpendicular)
+    nearest = numpy.argmin(distances, axis=1)
+    if candidates is None:
+      return nearest
+    return candidates[nearest], distances[numpy.arange(len(positions)), nearest]
+
+  def _createGrid(self):
+    axis = self.directions[0] / numpy.linalg.norm(self.directions[0])
+    norms = numpy.linalg.norm(self.directions, axis=1)
+    if numpy.any(numpy.linalg.norm(numpy.cross(self.directions, axis), axis=1) > self.PARALLEL_TOLERANCE * norms):
+      logging.debug("Needle paths are not parallel. Comparing targets to all paths.")
+      return None
+    helper = numpy.eye(3)[numpy.argmin(numpy.abs(axis))]
+    u = numpy.cross(axis, helper)
+    u /= numpy.linalg.norm(u)
+    plane = numpy.array([u, numpy.cross(axis, u)])
+    projected = numpy.dot(self.origins, plane.T)
+    minimum = projected.min(axis=0)
+    extent = projected.max(axis=0) - minimum
+    area = extent[0] * extent[1]
+    cellSize = numpy.sqrt(area / len(projected)) if area > 0 else max(extent.max() / len(projected), 1.0)
+    cells = numpy.floor((projected - minimum) / cellSize).astype(int)
+    buckets = {}
+    for index, cell in enumerate(map(tuple, cells)):
+      buckets.setdefault(cell, []).append(index)
+    buckets = {cell: numpy.array(indexes) for cell, indexes in buckets.items()}
+    return {"plane": plane, "minimum": minimum, "cellSize": cellSize, "buckets": buckets, "shape": cells.max(axis=0)}
+
+  def _findNearestPathUsingGrid(self, position):
+    grid = self._grid
+    cell = numpy.floor((numpy.dot(grid["plane"], position) - grid["minimum"]) / grid["cellSize"]).astype(int)
+    maximumRing = int(max(numpy.abs(cell).max(), numpy.abs(cell - grid["shape"]).max()))
+    best, bestDistance = -1, numpy.inf
+    for ring in range(maximumRing + 1):
+      candidates = [grid["buckets"][c] for c in self._getRingCells(cell, ring) if c in grid["buckets"]]
+      if candidates:
+        candidates = numpy.sort(numpy.concatenate(candidates))
+        nearest, distances = self._findNearestPaths(position[numpy.newaxis, :], candidates)
+        if distances[0] < bestDistance or (distances[0] == bestDistance and nearest[0] < best):
+          best, bestDistance = int(nearest[0]), distances[0]
+      if best != -1 and (ring * grid["cellSize"]) ** 2 >= bestDistance:
+        break
+    return best
+
+  @staticmethod
+  def _getRingCells(cell, ring):
+    x, y = cell
+    if ring == 0:
+      return [(x, y)]
+    cells = [(x + dx, y + dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)]
+    cells += [(x + dx, y + dy) for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+    return cells
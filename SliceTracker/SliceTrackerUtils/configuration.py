@@ -1,9 +1,106 @@
 import ConfigParser
 import inspect, os
-from SlicerDevelopmentToolboxUtils.mixins import ModuleWidgetMixin
+import re
+from collections import namedtuple
+from SlicerDevelopmentToolboxUtils.mixins import ModuleWidgetMixin, ModuleLogicMixin
+from SlicerDevelopmentToolboxUtils.metaclasses import Singleton
 from constants import SliceTrackerConstants as constants
 
 
+class SettingsSnapshot(namedtuple("SettingsSnapshot", ["coverProstatePattern", "coverTemplatePattern",
+                                                       "needleImagePattern", "vibeImagePattern", "planningImageRegex",
+                                                       "seriesTypes", "seriesTypeRules", "trackableSeriesTypes",
+                                                       "skippableSeriesTypes", "classificationRules"])):
+  """ Immutable copy of the settings which are read for every series
+
+  Series description patterns are plain substrings and get matched in the order given by seriesTypeRules. The
+  trackable and skippable series types get resolved once when the snapshot is created.
+  """
+
+  __slots__ = ()
+
+  @classmethod
+  def create(cls, values):
+    rules = ((values["COVER_PROSTATE_PATTERN"], constants.COVER_PROSTATE),
+             (values["COVER_TEMPLATE_PATTERN"], constants.COVER_TEMPLATE),
+             (values["NEEDLE_IMAGE_PATTERN"], constants.GUIDANCE_IMAGE),
+             (values["VIBE_IMAGE_PATTERN"], constants.VIBE_IMAGE))
+    seriesTypes = tuple(values["SERIES_TYPES"] or [])
+    containsAny = lambda seriesType, patterns: any(pattern in seriesType for pattern in patterns)
+    trackablePatterns = [values["COVER_TEMPLATE_PATTERN"], values["COVER_PROSTATE_PATTERN"],
+                         values["NEEDLE_IMAGE_PATTERN"]]
+    notSkippablePatterns = [values["COVER_PROSTATE_PATTERN"], values["COVER_TEMPLATE_PATTERN"]]
+    return cls(coverProstatePattern=values["COVER_PROSTATE_PATTERN"],
+               coverTemplatePattern=values["COVER_TEMPLATE_PATTERN"],
+               needleImagePattern=values["NEEDLE_IMAGE_PATTERN"],
+               vibeImagePattern=values["VIBE_IMAGE_PATTERN"],
+               planningImageRegex=re.compile(values["PLANNING_IMAGE_PATTERN"]),
+               seriesTypes=seriesTypes,
+               seriesTypeRules=rules,
+               trackableSeriesTypes=frozenset(t for t in seriesTypes if containsAny(t, trackablePatterns)),
+               skippableSeriesTypes=frozenset(t for t in seriesTypes if not containsAny(t, notSkippablePatterns)),
+               classificationRules=values["Series_Classification_Rules"] or "")
+
+  def computeSeriesType(self, series):
+    for pattern, seriesType in self.seriesTypeRules:
+      if pattern in series:
+        return seriesType
+    return constants.OTHER_IMAGE
+
+  def isPlanningImage(self, seriesDescription):
+    return self.planningImageRegex.match(seriesDescription) is not None or \
+           seriesDescription == self.planningImageRegex.pattern
+
+
+class SliceTrackerSettings(ModuleLogicMixin):
+  """ Provides the current SettingsSnapshot
+
+  The snapshot is built from QSettings once and only rebuilt after one of its settings was changed through setSetting
+  or removeSetting, or refresh detected a modification made elsewhere (e.g. the application settings). Writes of
+  SliceTracker settings (see SliceTrackerConfiguration) go through this class for that reason.
+  """
+
+  __metaclass__ = Singleton
+
+  MODULE_NAME = constants.MODULE_NAME
+
+  SETTING_NAMES = ["COVER_PROSTATE_PATTERN", "COVER_TEMPLATE_PATTERN", "NEEDLE_IMAGE_PATTERN", "VIBE_IMAGE_PATTERN",
+                   "PLANNING_IMAGE_PATTERN", "SERIES_TYPES", "Series_Classification_Rules"]
+
+  @property
+  def snapshot(self):
+    if self._snapshot is None:
+      self._values = self._readValues()
+      self._snapshot = SettingsSnapshot.create(self._values)
+    return self._snapshot
+
+  def __init__(self):
+    self._values = None
+    self._snapshot = None
+
+  def _readValues(self):
+    return {name: self.getSetting(name, moduleName=self.MODULE_NAME) for name in self.SETTING_NAMES}
+
+  def setSetting(self, setting, value, moduleName=None):
+    ModuleLogicMixin.setSetting(self, setting, value, moduleName=moduleName or self.MODULE_NAME)
+    if setting in self.SETTING_NAMES and self._values is not None and self._values.get(setting) != value:
+      self.invalidate()
+
+  def removeSetting(self, setting, moduleName=None):
+    ModuleLogicMixin.removeSetting(self, setting, moduleName=moduleName or self.MODULE_NAME)
+    if setting in self.SETTING_NAMES:
+      self.invalidate()
+
+  def invalidate(self):
+    self._values = None
+    self._snapshot = None
+
+  def refresh(self):
+    if self._values is not None and self._readValues() != self._values:
+      self.invalidate()
+    return self.snapshot
+
+
 class SliceTrackerConfiguration(ModuleWidgetMixin):
 
   def __init__(self, moduleName, configFile):
@@ -11,6 +108,12 @@ class SliceTrackerConfiguration(ModuleWidgetMixin):
     self.configFile = configFile
     self.loadConfiguration()
 
+  def setSetting(self, setting, value, moduleName=None):
+    SliceTrackerSettings().setSetting(setting, value, moduleName=moduleName or self.moduleName)
+
+  def removeSetting(self, setting, moduleName=None):
+    SliceTrackerSettings().removeSetting(setting, moduleName=moduleName or self.moduleName)
+
   def loadConfiguration(self):
 
     config = ConfigParser.RawConfigParser()
@@ -19,6 +122,9 @@ class SliceTrackerConfiguration(ModuleWidgetMixin):
     if not self.getSetting("ZFrame_Registration_Class_Name"):
       self.setSetting("ZFrame_Registration_Class_Name", config.get('ZFrame Registration', 'class'))
 
+    if not self.getSetting("ZFrame_Automatic_ROI"):
+      self.setSetting("ZFrame_Automatic_ROI", config.get('ZFrame Registration', 'Automatic_ROI'))
+
     if not self.getSetting("PLANNING_IMAGE_PATTERN"):
       self.setSetting("PLANNING_IMAGE_PATTERN", config.get('Series Descriptions', 'PLANNING_IMAGE_PATTERN'))
     if not self.getSetting("COVER_PROSTATE_PATTERN"):
@@ -30,6 +136,9 @@ class SliceTrackerConfiguration(ModuleWidgetMixin):
     if not self.getSetting("VIBE_IMAGE_PATTERN"):
       self.setSetting("VIBE_IMAGE_PATTERN", config.get('Series Descriptions', 'VIBE_IMAGE_PATTERN'))
 
+    if not self.getSetting("Series_Classification_Rules"):
+      self.setSetting("Series_Classification_Rules", config.get('Series Classification', 'Rules'))
+
     seriesTypes = [constants.COVER_TEMPLATE, constants.COVER_PROSTATE, constants.GUIDANCE_IMAGE,
                    constants.VIBE_IMAGE, constants.OTHER_IMAGE]
 
@@ -50,6 +159,22 @@ class SliceTrackerConfiguration(ModuleWidgetMixin):
     if not self.getSetting("Demo_Mode"):
       self.setSetting("Demo_Mode", config.get('Modes', 'Demo_Mode'))
 
+    if not self.getSetting("Registration_Deadline"):
+      self.setSetting("Registration_Deadline", config.get('Registration', 'Deadline'))
+
+    if not self.getSetting("Storage_Format"):
+      self.setSetting("Storage_Format", config.get('Persistence', 'Storage_Format'))
+
+    for kind in ["Temporary", "Approved", "Archive"]:
+      if not self.getSetting("Compression_%s" % kind):
+        self.setSetting("Compression_%s" % kind, config.get('Persistence', 'Compression_%s' % kind))
+
+    if not self.getSetting("Compression_Threads"):
+      self.setSetting("Compression_Threads", config.get('Persistence', 'Compression_Threads'))
+
+    if not self.getSetting("File_Loading_Threads"):
+      self.setSetting("File_Loading_Threads", config.get('Loading', 'File_Loading_Threads'))
+
     if not self.getSetting("Use_Deep_Learning"):
       self.setSetting("Use_Deep_Learning", config.get('Segmentation', 'Use_Deep_Learning'))
 
@@ -9,6 +9,7 @@ class SliceTrackerConstants(object):
   INTRAOP_SAMPLE_DATA_URL = 'https://github.com/SlicerProstate/SliceTracker/releases/download/test-data/Intraop-deid.zip'
 
   JSON_FILENAME = "results.json"
+  JOURNAL_FILENAME = "journal.jsonl"
 
   MISSING_PREOP_ANNOTATION_TEXT = "No preop data available"
   LEFT_VIEWER_SLICE_ANNOTATION_TEXT = 'BIOPSY PLAN'
@@ -1,12 +1,16 @@
 import logging
 import os
 import datetime
+import operator
+import time
 import qt
 import vtk
 import re
 import slicer
+from collections import OrderedDict
 
 from constants import SliceTrackerConstants as constants
+from configuration import SliceTrackerSettings
 
 from SlicerDevelopmentToolboxUtils.decorators import logmethod
 from SlicerDevelopmentToolboxUtils.widgets import ExtendedQMessageBox
@@ -98,6 +102,148 @@ class NewCaseSelectionNameWidget(qt.QMessageBox, ModuleWidgetMixin):
     self.notice.text = "" if not os.path.exists(self.newCaseDirectory) else "Note: Directory already exists."
 
 
+class SeriesTypeClassifier(object):
+  """ Classifies series by rules which get compiled into a single matcher
+
+  A rule assigns its series type if all of its conditions hold. A condition either searches a regular expression in a
+  DICOM attribute (e.g. ``ProtocolName ~ ^t2_tse``) or compares the number of slices (e.g. ``NumberOfSlices >= 20``).
+  Rules are written one per line as ``<series type> = <condition> [& <condition> ...]`` and get evaluated in order
+  before the series description patterns. The first matching rule wins. All expressions of one attribute are combined
+  into one regular expression of optional lookaheads, so every attribute gets scanned once per series. Expressions must
+  therefore not use numbered backreferences.
+  """
+
+  TAGS = OrderedDict([("SeriesDescription", "0008,103E"),
+                      ("ProtocolName", "0018,1030"),
+                      ("SequenceName", "0018,0024")])
+  SLICE_COUNT = "NumberOfSlices"
+
+  OPERATORS = OrderedDict([(">=", operator.ge), ("<=", operator.le), ("==", operator.eq), ("!=", operator.ne),
+                           (">", operator.gt), ("<", operator.lt)])
+
+  RULE_PATTERN = re.compile(r"^\s*(?P<seriesType>[^=]+?)\s*=\s*(?P<conditions>.+?)\s*$")
+  EXPRESSION_CONDITION_PATTERN = re.compile(r"^(?P<tag>\w+)\s*~\s*(?P<expression>.+)$")
+  SLICE_COUNT_CONDITION_PATTERN = re.compile(r"^%s\s*(?P<operator>%s)\s*(?P<value>\d+)$"
+                                             % (SLICE_COUNT, "|".join(re.escape(o) for o in OPERATORS.keys())))
+
+  @classmethod
+  def fromSettings(cls, settings):
+    rules = cls.parseRules(settings.classificationRules, settings.seriesTypes)
+    rules += [(seriesType, [("SeriesDescription", re.escape(pattern))], []) for pattern, seriesType in
+              settings.seriesTypeRules]
+    return cls(rules, defaultSeriesType=constants.OTHER_IMAGE)
+
+  @classmethod
+  def parseRules(cls, text, seriesTypes):
+    """ returns a list of (seriesType, [(tag, expression)], [(operator, sliceCount)]). Invalid rules get skipped """
+    rules = []
+    for line in [l.strip() for l in (text or "").splitlines()]:
+      if not line or line.startswith("#"):
+        continue
+      try:
+        rules.append(cls._parseRule(line, seriesTypes))
+      except ValueError as exc:
+        logging.error("Ignoring series classification rule '%s': %s" % (line, str(exc)))
+    return rules
+
+  @classmethod
+  def _parseRule(cls, line, seriesTypes):
+    match = cls.RULE_PATTERN.match(line)
+    if not match:
+      raise ValueError("expected <series type> = <condition> [& <condition> ...]")
+    seriesType = match.group("seriesType")
+    if seriesTypes and seriesType not in seriesTypes:
+      raise ValueError("unknown series type %s" % seriesType)
+    expressions, sliceCounts = [], []
+    for condition in [c.strip() for c in match.group("conditions").split("&")]:
+      sliceCountMatch = cls.SLICE_COUNT_CONDITION_PATTERN.match(condition)
+      expressionMatch = cls.EXPRESSION_CONDITION_PATTERN.match(condition)
+      if sliceCountMatch:
+        sliceCounts.append((cls.OPERATORS[sliceCountMatch.group("operator")], int(sliceCountMatch.group("value"))))
+      elif expressionMatch and expressionMatch.group("tag") in cls.TAGS:
+        expression = expressionMatch.group("expression").strip()
+        try:
+          re.compile(expression)
+        except re.error as exc:
+          raise ValueError("invalid expression %s (%s)" % (expression, str(exc)))
+        expressions.append((expressionMatch.group("tag"), expression))
+      else:
+        raise ValueError("invalid condition %s" % condition)
+    return seriesType, expressions, sliceCounts
+
+  def __init__(self, rules, defaultSeriesType):
+    self.defaultSeriesType = defaultSeriesType
+    self._compile(rules)
+    self._cache = {}
+    self.resetStatistics()
+
+  def _compile(self, rules):
+    lookaheads = {tag: [] for tag in self.TAGS.keys()}
+    self._rules = []
+    for index, (seriesType, expressions, sliceCounts) in enumerate(rules):
+      groups = []
+      for conditionIndex, (tag, expression) in enumerate(expressions):
+        group = "r%dc%d" % (index, conditionIndex)
+        lookaheads[tag].append("(?:(?=.*?(?P<%s>%s)))?" % (group, expression))
+        groups.append(group)
+      self._rules.append((seriesType, frozenset(groups), sliceCounts))
+    self._matchers = [(tag, re.compile("".join(patterns), re.DOTALL)) for tag, patterns in lookaheads.items()
+                      if patterns]
+
+  def classify(self, series, headers=None):
+    try:
+      return self._cache[series]
+    except KeyError:
+      pass
+    start = time.time()
+    headers = headers or self.getDefaultHeaders(series)
+    matchedGroups = set()
+    for tag, matcher in self._matchers:
+      groups = matcher.match(headers.get(tag) or "").groupdict()
+      matchedGroups.update(group for group, value in groups.items() if value is not None)
+    sliceCount = headers.get(self.SLICE_COUNT)
+    seriesType = self.defaultSeriesType
+    for ruleSeriesType, groups, sliceCounts in self._rules:
+      if groups.issubset(matchedGroups) and \
+        all(sliceCount is not None and compare(sliceCount, value) for compare, value in sliceCounts):
+        seriesType = ruleSeriesType
+        break
+    elapsed = time.time() - start
+    self._statistics["classifications"] += 1
+    self._statistics["totalTime"] += elapsed
+    self._statistics["maximumTime"] = max(self._statistics["maximumTime"], elapsed)
+    logging.debug("Classified %s as %s in %.3f ms" % (series, seriesType, elapsed * 1000))
+    self._cache[series] = seriesType
+    return seriesType
+
+  def classifyAll(self, seriesList, headers):
+    start = time.time()
+    seriesTypes = {series: self.classify(series, headers.get(series)) for series in seriesList}
+    if seriesList:
+      logging.debug("Classified %d series in %.3f ms" % (len(seriesList), (time.time() - start) * 1000))
+    return seriesTypes
+
+  def getDefaultHeaders(self, series):
+    return {"SeriesDescription": series.split(": ", 1)[-1]}
+
+  def invalidate(self, series=None):
+    if series is None:
+      self._cache = {}
+    else:
+      self._cache.pop(series, None)
+
+  def getStatistics(self, reset=False):
+    statistics = dict(self._statistics)
+    count = statistics["classifications"]
+    statistics["averageTime"] = statistics["totalTime"] / count if count else 0.0
+    if reset:
+      self.resetStatistics()
+    return statistics
+
+  def resetStatistics(self):
+    self._statistics = {"classifications": 0, "totalTime": 0.0, "maximumTime": 0.0}
+
+
 class SeriesTypeManager(LogicBase):
 
   SeriesTypeManuallyAssignedEvent = vtk.vtkCommand.UserEvent + 2334
@@ -108,32 +254,56 @@ class SeriesTypeManager(LogicBase):
 
   assignedSeries = {}
 
+  @property
+  def classifier(self):
+    settings = SliceTrackerSettings().snapshot
+    if self._classifier is None or self._classifierSettings is not settings:
+      self._classifier = SeriesTypeClassifier.fromSettings(settings)
+      self._classifierSettings = settings
+    return self._classifier
+
   def __init__(self):
     LogicBase.__init__(self)
     self.seriesTypes = self.getSetting("SERIES_TYPES")
+    self.seriesHeaders = {}
+    self._classifier = None
+    self._classifierSettings = None
 
   def clear(self):
     self.assignedSeries = {}
+    self.seriesHeaders = {}
+    self.invalidate()
+
+  def invalidate(self, series=None):
+    if self._classifier:
+      self._classifier.invalidate(series)
+
+  def setSeriesHeaders(self, series, headers):
+    self.seriesHeaders[series] = headers
+    self.invalidate(series)
+
+  def setSliceCount(self, series, sliceCount):
+    """ updates the number of slices of a series which received more files, which reclassifies it """
+    headers = dict(self.seriesHeaders.get(series) or self.classifier.getDefaultHeaders(series))
+    headers[SeriesTypeClassifier.SLICE_COUNT] = sliceCount
+    self.setSeriesHeaders(series, headers)
+
+  def classify(self, seriesList):
+    return self.classifier.classifyAll(seriesList, self.seriesHeaders)
 
   def getSeriesType(self, series):
+    """ returns the assigned series type or classifies the series
+
+    Classified types are not stored in assignedSeries, which only holds assigned types. The classifier caches them
+    until the headers of the series (e.g. its number of slices while files arrive) or the settings change.
+    """
     try:
       return self.assignedSeries[series]
     except KeyError:
-      self.assignedSeries[series] = self.computeSeriesType(series)
-    return self.assignedSeries[series]
+      return self.computeSeriesType(series)
 
   def computeSeriesType(self, series):
-    if self.getSetting("COVER_PROSTATE_PATTERN") in series:
-      seriesType = constants.COVER_PROSTATE
-    elif self.getSetting("COVER_TEMPLATE_PATTERN") in series:
-      seriesType = constants.COVER_TEMPLATE
-    elif self.getSetting("NEEDLE_IMAGE_PATTERN") in series:
-      seriesType = constants.GUIDANCE_IMAGE
-    elif self.getSetting("VIBE_IMAGE_PATTERN") in series:
-      seriesType = constants.VIBE_IMAGE
-    else:
-      seriesType = constants.OTHER_IMAGE
-    return seriesType
+    return self.classifier.classify(series, self.seriesHeaders.get(series))
 
   def autoAssign(self, series):
     self.assignedSeries[series] = self.getSeriesType(series)
@@ -144,7 +314,7 @@ class SeriesTypeManager(LogicBase):
     if seriesType:
       assert seriesType in self.seriesTypes
       self.assignedSeries[series] = seriesType
-      self.invokeEvent(self.SeriesTypeManuallyAssignedEvent)
+      self.invokeEvent(self.SeriesTypeManuallyAssignedEvent, series)
     else:
       self.autoAssign(series)
 
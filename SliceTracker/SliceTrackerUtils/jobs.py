@@ -0,0 +1,315 @@
+import heapq
+import logging
+import multiprocessing
+import itertools
+import time
+
+import qt
+import slicer
+import vtk
+
+from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+
+
+class Job(object):
+
+  INTERACTIVE_REGISTRATION = 0
+  ZFRAME_REGISTRATION = 1
+  BIAS_CORRECTION = 2
+  PERSISTENCE = 3
+
+  PRIORITY_NAMES = {INTERACTIVE_REGISTRATION: "interactive registration",
+                    ZFRAME_REGISTRATION: "z-frame registration",
+                    BIAS_CORRECTION: "bias correction",
+                    PERSISTENCE: "persistence"}
+
+  QUEUED = "queued"
+  RUNNING = "running"
+  COMPLETED = "completed"
+  FAILED = "failed"
+  CANCELLED = "cancelled"
+
+  @property
+  def active(self):
+    return self.state in [self.QUEUED, self.RUNNING]
+
+  @property
+  def progress(self):
+    return self.cliNode.GetProgress() / 100.0 if self.cliNode else 0.0
+
+  @property
+  def elapsedTime(self):
+    return time.time() - self.startTime if self.startTime else 0.0
+
+  def __init__(self, name, priority, function=None, cliModule=None, parameters=None, key=None, callback=None):
+    assert (function is None) != (cliModule is None)
+    self.name = name
+    self.priority = priority
+    self.function = function
+    self.cliModule = cliModule
+    self.parameters = parameters
+    self.key = key
+    self.callback = callback
+    self.state = self.QUEUED
+    self.cliNode = None
+    self.preempted = False
+    self.timedOut = False
+    self.error = None
+    self.startTime = None
+
+  def isCLIJob(self):
+    return self.cliModule is not None
+
+  def getEstimatedRemainingTime(self):
+    progress = self.progress
+    if not self.state == self.RUNNING or progress <= 0:
+      return None
+    return self.elapsedTime * (1.0 - progress) / progress
+
+  def __repr__(self):
+    return "%s (%s, %s)" % (self.name, self.PRIORITY_NAMES.get(self.priority, self.priority), self.state)
+
+
+class JobScheduler(ModuleLogicMixin):
+  """ Coordinates all CLI module runs and deferred work of a session
+
+  Jobs are ordered by priority class (Job.INTERACTIVE_REGISTRATION first). Synchronous jobs (runCLI) start
+  immediately and preempt running CLI jobs of lower priority, which get cancelled and requeued. Queued background
+  jobs are not started while a synchronous job of higher priority is running. The callback of a background job gets
+  called with the job once it completed, failed or got cancelled for good.
+  """
+
+  JobQueuedEvent = vtk.vtkCommand.UserEvent + 1101
+  JobStartedEvent = vtk.vtkCommand.UserEvent + 1102
+  JobFinishedEvent = vtk.vtkCommand.UserEvent + 1103
+  JobCancelledEvent = vtk.vtkCommand.UserEvent + 1104
+
+  POLLING_INTERVAL = 0.05
+
+  @property
+  def maximumConcurrentJobs(self):
+    return self._maximumConcurrentJobs
+
+  @maximumConcurrentJobs.setter
+  def maximumConcurrentJobs(self, value):
+    self._maximumConcurrentJobs = max(1, value)
+    self._scheduleNext()
+
+  def __init__(self):
+    self._maximumConcurrentJobs = max(1, multiprocessing.cpu_count() // 2)
+    self._queue = []
+    self._counter = itertools.count()
+    self._running = []
+    self._blockingPriorities = []
+    self._pollingJob = None
+    self._scheduleTimer = qt.QTimer()
+    self._scheduleTimer.singleShot = True
+    self._scheduleTimer.interval = 0
+    self._scheduleTimer.connect('timeout()', self._startQueuedJobs)
+
+  def __del__(self):
+    self.cancelAll()
+
+  def submit(self, job):
+    if job.key is not None:
+      queued = self.getQueuedJob(job.key)
+      if queued:
+        queued.function, queued.cliModule, queued.parameters = job.function, job.cliModule, job.parameters
+        return queued
+    job.state = Job.QUEUED
+    heapq.heappush(self._queue, (job.priority, next(self._counter), job))
+    self.invokeEvent(self.JobQueuedEvent, job.name)
+    self._scheduleNext()
+    return job
+
+  def submitFunction(self, name, function, priority=Job.PERSISTENCE, key=None):
+    return self.submit(Job(name, priority, function=function, key=key))
+
+  def submitCLI(self, name, cliModule, parameters, priority, key=None, callback=None):
+    return self.submit(Job(name, priority, cliModule=cliModule, parameters=parameters, key=key, callback=callback))
+
+  def runCLI(self, cliModule, parameters, priority=Job.INTERACTIVE_REGISTRATION, name=None, timeout=None,
+             progressCallback=None):
+    """ runs the CLI module and returns its CLI node once finished
+
+    progressCallback gets called with the running job at every polling interval
+    """
+    job = Job(name or cliModule.name, priority, cliModule=cliModule, parameters=parameters)
+    self._runCLIJobBlocking(job, timeout, progressCallback)
+    return job.cliNode
+
+  def isBlocking(self):
+    """ returns True while a synchronous job runs or is waited for """
+    return len(self._blockingPriorities) > 0
+
+  def _runCLIJobBlocking(self, job, timeout=None, progressCallback=None):
+    if self._pollingJob:
+      raise RuntimeError("%s cannot be started while %s is running" % (job.name, self._pollingJob.name))
+    self._preemptLowerPriorityJobs(job.priority)
+    self._blockingPriorities.append(job.priority)
+    try:
+      self._setJobRunning(job)
+      if timeout is None and progressCallback is None:
+        job.cliNode = slicer.cli.run(job.cliModule, None, job.parameters, wait_for_completion=True)
+      else:
+        self._runCLIJobAndPoll(job, timeout, progressCallback)
+      self._onCLIJobFinished(job)
+    finally:
+      self._blockingPriorities.remove(job.priority)
+      self._scheduleNext()
+
+  def _runCLIJobAndPoll(self, job, timeout=None, progressCallback=None):
+    """ runs the CLI node asynchronously and processes events until it finished
+
+    User input is not processed while polling and synchronous runs requested meanwhile (e.g. by timer driven
+    handlers) raise a RuntimeError, so that nothing can start another run on top of the polled one.
+    """
+    job.cliNode = slicer.cli.run(job.cliModule, None, job.parameters, wait_for_completion=False)
+    endTime = time.time() + max(0, timeout) if timeout is not None else None
+    self._pollingJob = job
+    try:
+      while job.cliNode.IsBusy():
+        if endTime is not None and not job.timedOut and time.time() >= endTime:
+          logging.warn("Job %s exceeded its time limit of %.1fs and gets cancelled" % (job.name, timeout))
+          job.timedOut = True
+          job.cliNode.Cancel()
+        if progressCallback:
+          progressCallback(job)
+        slicer.app.processEvents(qt.QEventLoop.ExcludeUserInputEvents)
+        time.sleep(self.POLLING_INTERVAL)
+    finally:
+      self._pollingJob = None
+    if progressCallback:
+      progressCallback(job)
+
+  def getQueuedJob(self, key):
+    for _, _, job in self._queue:
+      if job.key == key and job.state == Job.QUEUED:
+        return job
+    return None
+
+  def finish(self, job):
+    """ returns once the given job is done. A queued job runs right away, a running one is waited for """
+    if job.state == Job.QUEUED and job in [entry[2] for entry in self._queue]:
+      self._queue = [entry for entry in self._queue if entry[2] is not job]
+      heapq.heapify(self._queue)
+      if job.isCLIJob():
+        self._runCLIJobBlocking(job)
+      else:
+        self._runFunctionJob(job)
+    elif job.state == Job.RUNNING and job.isCLIJob():
+      self._blockingPriorities.append(job.priority)
+      try:
+        while job.active:
+          slicer.app.processEvents(qt.QEventLoop.ExcludeUserInputEvents)
+          time.sleep(self.POLLING_INTERVAL)
+      finally:
+        self._blockingPriorities.remove(job.priority)
+        self._scheduleNext()
+    return job
+
+  def getQueue(self):
+    return list(self._running) + [job for _, _, job in sorted(self._queue)]
+
+  def cancel(self, job):
+    if job.state == Job.QUEUED:
+      self._queue = [entry for entry in self._queue if entry[2] is not job]
+      heapq.heapify(self._queue)
+      job.state = Job.CANCELLED
+      self.invokeEvent(self.JobCancelledEvent, job.name)
+      self._notifyFinished(job)
+    elif job.state == Job.RUNNING and job.cliNode:
+      job.cliNode.Cancel()
+
+  def cancelAll(self):
+    for job in self.getQueue():
+      job.preempted = False
+      self.cancel(job)
+
+  def flush(self, priority=Job.PERSISTENCE):
+    """ runs all queued function jobs of the given priority class right away """
+    for job in [job for _, _, job in sorted(self._queue) if job.priority == priority and not job.isCLIJob()]:
+      self._queue = [entry for entry in self._queue if entry[2] is not job]
+      heapq.heapify(self._queue)
+      self._runFunctionJob(job)
+
+  def _scheduleNext(self):
+    if self._queue and not self._scheduleTimer.isActive():
+      self._scheduleTimer.start()
+
+  def _startQueuedJobs(self):
+    while self._queue and len(self._running) < self.maximumConcurrentJobs:
+      priority, _, job = self._queue[0]
+      if self._blockingPriorities and priority >= min(self._blockingPriorities):
+        return
+      heapq.heappop(self._queue)
+      if job.isCLIJob():
+        self._startCLIJob(job)
+      else:
+        self._runFunctionJob(job)
+
+  def _setJobRunning(self, job):
+    job.state = Job.RUNNING
+    job.startTime = time.time()
+    job.preempted = False
+    self._running.append(job)
+    logging.debug("Starting job %s" % job)
+    self.invokeEvent(self.JobStartedEvent, job.name)
+
+  def _runFunctionJob(self, job):
+    self._setJobRunning(job)
+    try:
+      job.function()
+      job.state = Job.COMPLETED
+    except Exception as exc:
+      logging.error("Job %s failed: %s" % (job.name, str(exc)))
+      job.state, job.error = Job.FAILED, exc
+    self._running.remove(job)
+    self.invokeEvent(self.JobFinishedEvent, job.name)
+    self._notifyFinished(job)
+    self._scheduleNext()
+
+  def _startCLIJob(self, job):
+    self._setJobRunning(job)
+    job.cliNode = slicer.cli.run(job.cliModule, None, job.parameters, wait_for_completion=False)
+    job.cliNodeObserver = job.cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode().StatusModifiedEvent,
+                                                  lambda caller, event: self._onCLINodeStatusModified(job))
+
+  def _onCLINodeStatusModified(self, job):
+    if job.cliNode.IsBusy():
+      return
+    job.cliNode.RemoveObserver(job.cliNodeObserver)
+    self._onCLIJobFinished(job)
+    if job.state == Job.CANCELLED and job.preempted:
+      logging.debug("Requeueing preempted job %s" % job.name)
+      self.submit(job)
+    self._scheduleNext()
+
+  def _onCLIJobFinished(self, job):
+    status = job.cliNode.GetStatus()
+    if status == job.cliNode.Completed:
+      job.state = Job.COMPLETED
+    elif status == job.cliNode.Cancelled:
+      job.state = Job.CANCELLED
+    else:
+      job.state = Job.FAILED
+      logging.error("Job %s failed: %s" % (job.name, job.cliNode.GetErrorText()))
+    if job in self._running:
+      self._running.remove(job)
+    self.invokeEvent(self.JobCancelledEvent if job.state == Job.CANCELLED else self.JobFinishedEvent, job.name)
+    if not (job.state == Job.CANCELLED and job.preempted):
+      self._notifyFinished(job)
+
+  def _notifyFinished(self, job):
+    if not job.callback:
+      return
+    try:
+      job.callback(job)
+    except Exception as exc:
+      logging.error("Callback of job %s failed: %s" % (job.name, str(exc)))
+
+  def _preemptLowerPriorityJobs(self, priority):
+    for job in [job for job in self._running if job.isCLIJob() and job.priority > priority]:
+      logging.debug("Preempting job %s" % job)
+      job.preempted = True
+      job.cliNode.Cancel()
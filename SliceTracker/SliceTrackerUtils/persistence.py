@@ -0,0 +1,858 @@
+import os
+import re
+import sys
+import json
+import shutil
+import logging
+import multiprocessing
+import struct
+import tempfile
+import threading
+import time
+import zlib
+import Queue
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import qt
+import slicer
+import vtk
+
+from SlicerDevelopmentToolboxUtils.metaclasses import Singleton
+
+try:
+  import h5py
+except ImportError:
+  h5py = None
+
+
+def atomicReplace(source, destination):
+  """ moves source to destination, replacing an existing destination without exposing a partially written file """
+  if sys.platform.startswith('win'):
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    MOVEFILE_WRITE_THROUGH = 0x8
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(destination),
+                                              MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+      raise ctypes.WinError()
+  else:
+    os.rename(source, destination)
+
+
+def getTemporaryFileName(filename):
+  directory, basename = os.path.split(filename)
+  return os.path.join(directory, ".tmp-%d-%s" % (threading.current_thread().ident, basename))
+
+
+class Compression(object):
+  """ Compression of saved volumes, parsed from settings like "gzip:6" or "raw"
+
+  Data kinds have their own setting (Compression_<kind>).
+  """
+
+  RAW = "raw"
+  GZIP = "gzip"
+
+  TEMPORARY = "Temporary"
+  APPROVED = "Approved"
+  ARCHIVE = "Archive"
+
+  DEFAULT_LEVEL = 6
+
+  @staticmethod
+  def fromString(text, numberOfThreads=0):
+    codec, _, level = str(text).strip().lower().partition(":")
+    if codec not in [Compression.RAW, Compression.GZIP]:
+      raise ValueError("Unknown compression codec %s. Valid codecs are: raw, gzip" % codec)
+    return Compression(codec, int(level) if level else Compression.DEFAULT_LEVEL, numberOfThreads)
+
+  @property
+  def compressed(self):
+    return self.codec != self.RAW
+
+  def __init__(self, codec=GZIP, level=DEFAULT_LEVEL, numberOfThreads=0):
+    self.codec = codec
+    self.level = min(max(level, 1), 9)
+    self.numberOfThreads = numberOfThreads if numberOfThreads > 0 else multiprocessing.cpu_count()
+
+  def __repr__(self):
+    return "%s:%d" % (self.codec, self.level) if self.compressed else self.codec
+
+
+def gzipCompress(data, level, numberOfThreads, chunkSize=1024*1024):
+  """ compresses data into a single gzip member by deflating chunks in parallel (like pigz)
+
+  Every chunk is deflated independently and ends with a sync flush, which makes the concatenation a valid deflate
+  stream. zlib releases the GIL while compressing, so threads scale across cores.
+  """
+  data = buffer(data)
+  chunks = [buffer(data, offset, chunkSize) for offset in range(0, len(data), chunkSize)] or [""]
+
+  def compressChunk(index):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(chunks[index]) + \
+           compressor.flush(zlib.Z_FINISH if index == len(chunks) - 1 else zlib.Z_SYNC_FLUSH)
+
+  pool = ThreadPool(max(1, min(numberOfThreads, len(chunks))))
+  try:
+    compressedChunks = pool.map(compressChunk, range(len(chunks)))
+  finally:
+    pool.close()
+  header = "\x1f\x8b\x08\x00" + struct.pack("<I", 0) + "\x00\xff"
+  trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+  return [header] + compressedChunks + [trailer]
+
+
+NRRD_TYPES = {'int8': 'signed char', 'uint8': 'unsigned char', 'int16': 'short', 'uint16': 'unsigned short',
+              'int32': 'int', 'uint32': 'unsigned int', 'int64': 'long long', 'uint64': 'unsigned long long',
+              'float32': 'float', 'float64': 'double'}
+
+NRRD_TYPE_ALIASES = {'char': 'int8', 'signed char': 'int8', 'int8_t': 'int8', 'uchar': 'uint8', 'uint8_t': 'uint8',
+                     'short int': 'int16', 'signed short': 'int16', 'signed short int': 'int16', 'int16_t': 'int16',
+                     'ushort': 'uint16', 'unsigned short int': 'uint16', 'uint16_t': 'uint16', 'signed int': 'int32',
+                     'int32_t': 'int32', 'uint': 'uint32', 'uint32_t': 'uint32', 'longlong': 'int64',
+                     'long long int': 'int64', 'signed long long': 'int64', 'signed long long int': 'int64',
+                     'int64_t': 'int64', 'ulonglong': 'uint64', 'unsigned long long int': 'uint64',
+                     'uint64_t': 'uint64'}
+NRRD_TYPE_ALIASES.update({name: dtype for dtype, name in NRRD_TYPES.iteritems()})
+NRRD_TYPE_ALIASES.update({dtype: dtype for dtype in NRRD_TYPES.keys()})
+
+NRRD_SPACE_TO_RAS = {'left-posterior-superior': [-1, -1, 1], 'LPS': [-1, -1, 1],
+                     'left-anterior-superior': [-1, 1, 1], 'LAS': [-1, 1, 1],
+                     'right-anterior-superior': [1, 1, 1], 'RAS': [1, 1, 1]}
+
+
+def readNrrdArray(filename):
+  """ reads a single component 3D NRRD (raw or gzip encoded) and returns voxels (k, j, i) and the row-major 4x4
+  IJKToRAS matrix. Does not use VTK or MRML. Raises ValueError for files it does not support
+  """
+  with open(filename, 'rb') as infile:
+    content = infile.read()
+  headerEnd = content.find("\n\n")
+  if not content.startswith("NRRD") or headerEnd == -1:
+    raise ValueError("%s is not a NRRD file with attached data" % filename)
+  fields = {}
+  for line in content[:headerEnd].splitlines()[1:]:
+    if line.startswith("#") or ":" not in line or ":=" in line:
+      continue
+    key, value = line.split(":", 1)
+    fields[key.strip().lower()] = value.strip()
+  if fields.get("dimension") != "3" or "data file" in fields or "datafile" in fields or \
+     int(fields.get("byte skip", 0)) or int(fields.get("line skip", 0)):
+    raise ValueError("Unsupported NRRD layout in %s" % filename)
+  try:
+    dtype = numpy.dtype(NRRD_TYPE_ALIASES[fields["type"]])
+    spaceToRAS = NRRD_SPACE_TO_RAS[fields["space"]]
+  except KeyError as exc:
+    raise ValueError("Unsupported NRRD field value %s in %s" % (str(exc), filename))
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('>' if fields.get("endian") == "big" else '<')
+  sizes = [int(size) for size in fields["sizes"].split()]
+
+  data = content[headerEnd + 2:]
+  encoding = fields.get("encoding")
+  if encoding in ("gzip", "gz"):
+    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+  elif encoding != "raw":
+    raise ValueError("Unsupported NRRD encoding %s in %s" % (encoding, filename))
+  numberOfBytes = numpy.prod(sizes) * dtype.itemsize
+  if len(data) < numberOfBytes:
+    raise ValueError("%s is truncated" % filename)
+  array = numpy.frombuffer(data, dtype=dtype, count=numpy.prod(sizes)).reshape(sizes[::-1])
+  array = array.astype(dtype.newbyteorder('='))
+
+  def parseVectors(text):
+    return [[float(value) for value in vector.split(",")] for vector in re.findall(r"\(([^)]*)\)", text)]
+
+  directions = parseVectors(fields["space directions"])
+  origin = parseVectors(fields["space origin"])[0] if "space origin" in fields else [0.0, 0.0, 0.0]
+  if len(directions) != 3 or fields["space directions"].count("none"):
+    raise ValueError("Unsupported NRRD space directions in %s" % filename)
+  ijkToRAS = []
+  for row in range(3):
+    ijkToRAS += [spaceToRAS[row] * directions[column][row] for column in range(3)] + [spaceToRAS[row] * origin[row]]
+  return array, ijkToRAS + [0.0, 0.0, 0.0, 1.0]
+
+
+def createVolumeNode(array, ijkToRAS, nodeClassName, name):
+  """ creates a volume node (not part of the MRML scene) from voxels (k, j, i) and a row-major IJKToRAS matrix """
+  from vtk.util import numpy_support
+  node = getattr(slicer, nodeClassName)()
+  node.SetName(name)
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(array.shape[::-1])
+  scalars = numpy_support.numpy_to_vtk(array.ravel(), deep=True,
+                                       array_type=numpy_support.get_vtk_array_type(array.dtype))
+  imageData.GetPointData().SetScalars(scalars)
+  node.SetAndObserveImageData(imageData)
+  matrix = vtk.vtkMatrix4x4()
+  matrix.DeepCopy(list(ijkToRAS))
+  node.SetIJKToRASMatrix(matrix)
+  return node
+
+
+def getIJKToRAS(node):
+  ijkToRAS = vtk.vtkMatrix4x4()
+  node.GetIJKToRASMatrix(ijkToRAS)
+  return [ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)]
+
+
+def writeNrrd(node, filename, compression):
+  """ writes a single component volume as NRRD with the given compression """
+  writeNrrdArray(slicer.util.arrayFromVolume(node), getIJKToRAS(node), filename, compression)
+
+
+def writeNrrdArray(array, ijkToRAS, filename, compression):
+  """ writes voxels (k, j, i) with the given row-major 4x4 IJKToRAS matrix as NRRD. Does not use VTK or MRML """
+  data = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+  rasToLPS = [-1, -1, 1]
+
+  def toVector(column):
+    return "(%s)" % ",".join(repr(rasToLPS[row] * ijkToRAS[row * 4 + column]) for row in range(3))
+
+  header = ["NRRD0004",
+            "# Complete NRRD file format specification at:",
+            "# http://teem.sourceforge.net/nrrd/format.html",
+            "type: %s" % NRRD_TYPES[data.dtype.name],
+            "dimension: 3",
+            "space: left-posterior-superior",
+            "sizes: %s" % " ".join(str(size) for size in data.shape[::-1]),
+            "space directions: %s" % " ".join(toVector(column) for column in range(3)),
+            "kinds: domain domain domain",
+            "endian: little",
+            "encoding: %s" % compression.codec,
+            "space origin: %s" % toVector(3),
+            "", ""]
+  content = gzipCompress(data, compression.level, compression.numberOfThreads) if compression.compressed \
+    else [buffer(data)]
+  with open(filename, 'wb') as outfile:
+    outfile.write("\n".join(header))
+    for part in content:
+      outfile.write(part)
+
+
+def writeNode(node, filename, compression=None):
+  """ writes the node using its default storage node. The node does not need to be part of the MRML scene
+
+  Scalar volumes written as NRRD are encoded by writeNrrd if a compression is given.
+  """
+  imageData = node.GetImageData() if isinstance(node, slicer.vtkMRMLScalarVolumeNode) else None
+  if compression and imageData and imageData.GetNumberOfScalarComponents() == 1 and filename.endswith(".nrrd"):
+    writeNrrd(node, filename, compression)
+    return
+  storageNode = node.CreateDefaultStorageNode()
+  storageNode.SetFileName(filename)
+  if compression:
+    storageNode.SetUseCompression(compression.compressed)
+  if not storageNode.WriteData(node):
+    raise IOError("Writing %s failed" % node.GetName())
+
+
+class VolumeSnapshot(object):
+  """ Copy of the voxels and geometry of a single component scalar volume, written without VTK or MRML """
+
+  @staticmethod
+  def isSupported(node, filename):
+    imageData = node.GetImageData() if isinstance(node, slicer.vtkMRMLScalarVolumeNode) else None
+    return imageData is not None and imageData.GetNumberOfScalarComponents() == 1 and filename.endswith(".nrrd")
+
+  def __init__(self, node):
+    self.name = node.GetName()
+    self.nodeClass = node.GetClassName()
+    self.array = numpy.array(slicer.util.arrayFromVolume(node), copy=True)
+    self.ijkToRAS = getIJKToRAS(node)
+
+  def write(self, filename, compression=None):
+    writeNrrdArray(self.array, self.ijkToRAS, filename, compression or Compression())
+
+
+class FileSnapshot(object):
+  """ File content of a node as written by its storage node. Created on the main thread """
+
+  def __init__(self, node, filename, compression=None):
+    self.name = node.GetName()
+    temporaryDirectory = tempfile.mkdtemp()
+    try:
+      temporaryFileName = os.path.join(temporaryDirectory, os.path.basename(filename))
+      writeNode(node, temporaryFileName, compression)
+      with open(temporaryFileName, 'rb') as temporaryFile:
+        self.content = temporaryFile.read()
+    finally:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+
+  def write(self, filename, compression=None):
+    with open(filename, 'wb') as outfile:
+      outfile.write(self.content)
+
+
+def createSnapshot(node, filename, compression=None):
+  """ returns a snapshot of the node which can be written from any thread """
+  if VolumeSnapshot.isSupported(node, filename):
+    return VolumeSnapshot(node)
+  return FileSnapshot(node, filename, compression)
+
+
+class PersistenceWorker(object):
+  """ Writes session data on a dedicated thread
+
+  Nodes are snapshot on the calling (main) thread: voxels of scalar volumes are copied into numpy arrays, all other
+  nodes are written to memory by their storage nodes. The worker thread never touches VTK or MRML objects. It writes
+  snapshots, text and copied files to temporary files within the destination directory and atomically renames them
+  into place, so that a crash never leaves a partially written file behind. Writes are processed in submission
+  order, which guarantees that results.json is replaced only after the data it references. If a container
+  (CaseContainer) is set, all files are written into it instead.
+
+  The callback of a write gets called on the worker thread with True once the file was written, with False if
+  writing failed.
+  """
+
+  __metaclass__ = Singleton
+
+  FLUSH_POLLING_INTERVAL = 0.02
+
+  def __init__(self):
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._failedFileNames = []
+    self._thread = None
+    self._statistics = self._createStatistics()
+    self.container = None
+
+  def _ensureThreadRunning(self):
+    if self._thread and self._thread.is_alive():
+      return
+    self._thread = threading.Thread(target=self._run, name="SliceTrackerPersistence")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _submit(self, filename, writeFunction, callback=None):
+    self._ensureThreadRunning()
+    self._queue.put((filename, writeFunction, callback))
+
+  def exists(self, filename):
+    return self.container.exists(filename) if self.container else os.path.exists(filename)
+
+  def writeNode(self, node, filename, compression=None, callback=None):
+    snapshot = createSnapshot(node, filename, compression)
+    if self.container:
+      self._submitToContainer(filename, lambda container: container.writeSnapshot(snapshot, filename, compression),
+                              callback)
+    else:
+      self._submitFile(filename, lambda temporaryFileName: snapshot.write(temporaryFileName, compression), callback)
+
+  def writeText(self, filename, content, callback=None):
+    def write(temporaryFileName):
+      with open(temporaryFileName, 'w') as outfile:
+        outfile.write(content)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    if self.container:
+      self._submitToContainer(filename, lambda container: container.writeBytes(filename, content), callback)
+    else:
+      self._submitFile(filename, write, callback)
+
+  def copyFile(self, source, destination, callback=None):
+    if self.container:
+      self._submitToContainer(destination, lambda container: container.copyFile(source, destination), callback)
+    else:
+      self._submitFile(destination, lambda temporaryFileName: shutil.copy(source, temporaryFileName), callback)
+
+  def mirrorFile(self, mirror):
+    container = self.container
+    self._submit(mirror.destination, lambda: mirror.update(container))
+
+  def _submitFile(self, filename, writeFunction, callback=None):
+    self._submit(filename, lambda: self._replaceAtomically(filename, writeFunction), callback)
+
+  def _submitToContainer(self, filename, writeFunction, callback=None):
+    container = self.container
+
+    def write():
+      writeFunction(container)
+      return container.getStorageSize(filename)
+    self._submit(filename, write, callback)
+
+  def _replaceAtomically(self, filename, writeFunction):
+    if not os.path.exists(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    temporaryFileName = getTemporaryFileName(filename)
+    try:
+      writeFunction(temporaryFileName)
+      atomicReplace(temporaryFileName, filename)
+    finally:
+      if os.path.exists(temporaryFileName):
+        os.remove(temporaryFileName)
+    return os.path.getsize(filename)
+
+  def _createStatistics(self):
+    return {"files": 0, "bytes": 0, "seconds": 0.0}
+
+  def getStatistics(self, reset=False):
+    """ returns number of files, bytes and seconds spent writing since the last reset """
+    with self._lock:
+      statistics = dict(self._statistics)
+      if reset:
+        self._statistics = self._createStatistics()
+    return statistics
+
+  def _run(self):
+    while True:
+      filename, writeFunction, callback = self._queue.get()
+      success = False
+      try:
+        startTime = time.time()
+        size = writeFunction()
+        success = True
+        with self._lock:
+          self._statistics["files"] += 1
+          self._statistics["bytes"] += size
+          self._statistics["seconds"] += time.time() - startTime
+      except Exception as exc:
+        logging.error("Failed to write %s: %s" % (filename, str(exc)))
+        with self._lock:
+          self._failedFileNames.append(filename)
+      finally:
+        self._notify(filename, callback, success)
+        self._queue.task_done()
+
+  def _notify(self, filename, callback, success):
+    if not callback:
+      return
+    try:
+      callback(success)
+    except Exception as exc:
+      logging.error("Callback for %s failed: %s" % (filename, str(exc)))
+
+  def isBusy(self):
+    return self._queue.unfinished_tasks > 0
+
+  def flush(self):
+    """ waits until all submitted writes finished
+
+    On the main thread, paint and timer events keep being processed while waiting. Returns the file names which
+    failed to be written since the last flush
+    """
+    if threading.current_thread().name == "MainThread":
+      while self.isBusy():
+        slicer.app.processEvents(qt.QEventLoop.ExcludeUserInputEvents)
+        time.sleep(self.FLUSH_POLLING_INTERVAL)
+    self._queue.join()
+    with self._lock:
+      failedFileNames, self._failedFileNames = self._failedFileNames, []
+    return failedFileNames
+
+
+class LogFileMirror(object):
+  """ Mirrors a growing log file by appending only the bytes which were written since the last update
+
+  A rotated source (replaced, truncated or rewritten from its beginning) is detected by its file identity, its size
+  and its first bytes and gets mirrored again from its start. An existing destination is continued if it is a prefix
+  of the source, otherwise it is replaced.
+  """
+
+  HEADER_SIZE = 4096
+
+  def __init__(self, source, destination):
+    self.source = source
+    self.destination = destination
+    self._offset = None
+    self._identity = None
+    self._header = ""
+
+  def _getIdentity(self, stat):
+    return stat.st_dev, stat.st_ino
+
+  def update(self, container=None):
+    """ appends new bytes of the source to the destination and returns the number of bytes appended """
+    with open(self.source, 'rb') as sourceFile:
+      stat = os.fstat(sourceFile.fileno())
+      header = sourceFile.read(self.HEADER_SIZE)
+      if self._offset is None:
+        self._offset = self._getResumeOffset(header, stat.st_size, container)
+      elif self._identity != self._getIdentity(stat) or stat.st_size < self._offset or \
+          not header.startswith(self._header[:self._offset]):
+        logging.debug("%s was rotated. Mirroring it from its beginning" % self.source)
+        self._offset = 0
+      self._identity = self._getIdentity(stat)
+      self._header = header
+      sourceFile.seek(self._offset)
+      content = sourceFile.read(stat.st_size - self._offset)
+    if content:
+      self._append(content, container)
+      self._offset += len(content)
+    return len(content)
+
+  def _getResumeOffset(self, header, sourceSize, container):
+    size, existingHeader = self._getDestinationSizeAndHeader(container)
+    if size is not None and size <= sourceSize and header.startswith(existingHeader):
+      return size
+    self._truncate(container)
+    return 0
+
+  def _getDestinationSizeAndHeader(self, container):
+    if container:
+      if not container.exists(self.destination):
+        return None, None
+      content = container.readBytes(self.destination)
+      return len(content), content[:self.HEADER_SIZE]
+    if not os.path.exists(self.destination):
+      return None, None
+    with open(self.destination, 'rb') as destinationFile:
+      return os.fstat(destinationFile.fileno()).st_size, destinationFile.read(self.HEADER_SIZE)
+
+  def _truncate(self, container):
+    if container:
+      container.writeBytes(self.destination, "")
+    else:
+      open(self.destination, 'wb').close()
+
+  def _append(self, content, container):
+    if container:
+      container.appendBytes(self.destination, content)
+      return
+    with open(self.destination, 'ab') as destinationFile:
+      destinationFile.write(content)
+      destinationFile.flush()
+      os.fsync(destinationFile.fileno())
+
+
+class ProcedureJournal(object):
+  """ Append-only journal (JSON lines) of procedure events
+
+  Every entry carries a sequence number. Compacting the session into results.json stores the sequence number of the
+  last entry it covers, so that entries which were appended afterwards can be replayed after a crash. Entries are
+  appended immediately while the files they reference are written asynchronously, which is why replaying has to
+  check that these files exist.
+  """
+
+  @property
+  def sequence(self):
+    return self._sequence
+
+  def __init__(self, filename, sequence=0):
+    self.filename = filename
+    self._sequence = sequence
+    self._removeIncompleteEntry()
+    for entry in self.read(afterSequence=sequence):
+      self._sequence = entry["sequence"]
+
+  def _removeIncompleteEntry(self):
+    if not os.path.exists(self.filename):
+      return
+    with open(self.filename, 'rb+') as journalFile:
+      content = journalFile.read()
+      if content and not content.endswith("\n"):
+        logging.warn("Removing incomplete journal entry from %s" % self.filename)
+        journalFile.truncate(content.rfind("\n") + 1)
+
+  def append(self, event, **data):
+    self._sequence += 1
+    entry = dict(data, sequence=self._sequence, event=event)
+    with open(self.filename, 'a') as journalFile:
+      journalFile.write(json.dumps(entry) + "\n")
+      journalFile.flush()
+      os.fsync(journalFile.fileno())
+    return entry
+
+  def read(self, afterSequence=0):
+    if not os.path.exists(self.filename):
+      return
+    with open(self.filename) as journalFile:
+      for line in journalFile:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          logging.warn("Ignoring invalid journal entry in %s" % self.filename)
+          return
+        if entry["sequence"] > afterSequence:
+          yield entry
+
+  def truncate(self):
+    temporaryFileName = getTemporaryFileName(self.filename)
+    open(temporaryFileName, 'w').close()
+    atomicReplace(temporaryFileName, self.filename)
+
+
+class ParallelFileLoader(object):
+  """ Reads and decodes volume files on a thread pool and creates their nodes on the main thread
+
+  Worker threads only parse NRRD files into numpy arrays (see readNrrdArray), zlib releases the GIL while
+  decompressing. VTK and MRML objects are created on the calling thread. Files of other types than volumes and label
+  maps as well as files that could not be read in parallel are loaded serially.
+  """
+
+  NODE_CLASSES = {
+    'loadVolume': 'vtkMRMLScalarVolumeNode',
+    'loadLabelVolume': 'vtkMRMLLabelMapVolumeNode'
+  }
+
+  def __init__(self, numberOfThreads):
+    self.numberOfThreads = numberOfThreads
+
+  def load(self, files):
+    """ loads the given (filePath, loadFunction) tuples and returns a dictionary mapping filePath to node """
+    startTime = time.time()
+    parallel = [(path, fn) for path, fn in files if fn.__name__ in self.NODE_CLASSES and path.endswith(".nrrd")
+                and self.numberOfThreads > 1]
+    serial = [(path, fn) for path, fn in files if (path, fn) not in parallel]
+
+    nodes = {}
+    if parallel:
+      pool = ThreadPool(min(self.numberOfThreads, len(parallel)))
+      try:
+        volumes = pool.map(self._readArray, [path for path, _ in parallel])
+      finally:
+        pool.close()
+      for (path, loadFunction), volume in zip(parallel, volumes):
+        if volume:
+          nodes[path] = self._addToScene(path, loadFunction, *volume)
+        else:
+          serial.append((path, loadFunction))
+    for path, loadFunction in serial:
+      _, nodes[path] = loadFunction(path, returnNode=True)
+
+    self._reportThroughput(files, time.time() - startTime)
+    return nodes
+
+  def _readArray(self, path):
+    try:
+      return readNrrdArray(path)
+    except Exception as exc:
+      logging.warn("Parallel loading of %s failed, falling back to serial loading: %s" % (path, str(exc)))
+      return None
+
+  def _addToScene(self, path, loadFunction, array, ijkToRAS):
+    node = createVolumeNode(array, ijkToRAS, self.NODE_CLASSES[loadFunction.__name__],
+                            os.path.splitext(os.path.basename(path))[0])
+    slicer.mrmlScene.AddNode(node)
+    node.CreateDefaultDisplayNodes()
+    return node
+
+  def _reportThroughput(self, files, elapsedTime):
+    if not files or elapsedTime <= 0:
+      return
+    megaBytes = sum(os.path.getsize(path) for path, _ in files if os.path.exists(path)) / (1024.0 * 1024.0)
+    logging.info("Loaded %d files (%.1f MB) in %.2fs using %d threads: %.1f MB/s, %.1f files/s"
+                 % (len(files), megaBytes, elapsedTime, self.numberOfThreads, megaBytes / elapsedTime,
+                    len(files) / elapsedTime))
+
+
+class CaseContainer(object):
+  """ Single file (HDF5) container for the data of a case
+
+  Every file of the SliceTrackerOutputs directory layout becomes a dataset at its relative path. Volumes are stored
+  as chunked and compressed voxel arrays along with their geometry, all other files (transforms, markups, text) as
+  compressed bytes. Datasets are read individually, which gives random access to the data of any single result.
+  All access goes through a single file handle which is guarded by a lock since the persistence worker writes from
+  its own thread.
+
+  Rewritten datasets are overwritten in place if their shape, type and compression did not change, file datasets are
+  resizable for that purpose. Space of replaced datasets is not reused by HDF5, so the container is compacted into a
+  new file when closing if it holds considerably more than its datasets. Unlike files in the directory layout,
+  writes into the container are not atomic: a crash while writing can leave the container damaged. The journal is
+  kept as a separate file next to the container, so events recorded since the last save survive such a crash.
+  """
+
+  FILENAME = "case.h5"
+
+  VOLUME = "volume"
+  FILE = "file"
+
+  COMPRESSION = "gzip"
+  COMPRESSION_LEVEL = 4
+
+  COMPACTION_MINIMUM_WASTED_BYTES = 16 * 1024 * 1024
+  COMPACTION_MAXIMUM_WASTED_RATIO = 0.25
+
+  @staticmethod
+  def isAvailable():
+    return h5py is not None
+
+  @staticmethod
+  def isContainer(filename):
+    return filename.endswith(CaseContainer.FILENAME)
+
+  def __init__(self, filename):
+    if not self.isAvailable():
+      raise ImportError("Reading and writing case containers requires h5py")
+    self.filename = filename
+    self.directory = os.path.dirname(filename)
+    self._lock = threading.Lock()
+    self._file = h5py.File(filename, 'a')
+
+  def close(self):
+    with self._lock:
+      if not self._file:
+        return
+      wastedBytes = self._getWastedBytes()
+      self._file.close()
+      self._file = None
+    if wastedBytes > max(self.COMPACTION_MINIMUM_WASTED_BYTES,
+                         self.COMPACTION_MAXIMUM_WASTED_RATIO * os.path.getsize(self.filename)):
+      self.compact()
+
+  def _getWastedBytes(self):
+    usedBytes = []
+    self._file.visititems(lambda name, item: usedBytes.append(item.id.get_storage_size())
+                          if isinstance(item, h5py.Dataset) else None)
+    self._file.flush()
+    return os.path.getsize(self.filename) - sum(usedBytes)
+
+  def compact(self):
+    """ copies all datasets into a new file which atomically replaces the (closed) container """
+    temporaryFileName = getTemporaryFileName(self.filename)
+    try:
+      with h5py.File(self.filename, 'r') as source, h5py.File(temporaryFileName, 'w') as destination:
+        for name in source:
+          source.copy(name, destination)
+      atomicReplace(temporaryFileName, self.filename)
+    except Exception as exc:
+      logging.warn("Compacting %s failed: %s" % (self.filename, str(exc)))
+    finally:
+      if os.path.exists(temporaryFileName):
+        os.remove(temporaryFileName)
+
+  def importDirectory(self, directory, excludedFileNames):
+    """ copies all files of a case saved in the directory layout into the container """
+    for root, _, fileNames in os.walk(directory):
+      for fileName in fileNames:
+        filename = os.path.join(root, fileName)
+        if fileName in excludedFileNames or fileName.startswith(".tmp-") or self.exists(filename):
+          continue
+        self.copyFile(filename, filename)
+
+  def getKey(self, filename):
+    """ returns the dataset path of a file name, which can be absolute or relative to the container directory """
+    if os.path.isabs(filename):
+      filename = os.path.relpath(filename, self.directory)
+    return filename.replace(os.sep, "/")
+
+  def exists(self, filename):
+    with self._lock:
+      return self.getKey(filename) in self._file
+
+  def keys(self):
+    keys = []
+    with self._lock:
+      self._file.visititems(lambda name, item: keys.append(name) if isinstance(item, h5py.Dataset) else None)
+    return keys
+
+  def getStorageSize(self, filename):
+    with self._lock:
+      return self._file[self.getKey(filename)].id.get_storage_size()
+
+  def _createDataset(self, filename, data, kind, compression=None, **attributes):
+    """ writes data into the dataset of filename. File datasets are resizable and overwritten in place """
+    key = self.getKey(filename)
+    if compression and not compression.compressed:
+      filters = {}
+    else:
+      filters = dict(shuffle=True, compression=self.COMPRESSION,
+                     compression_opts=compression.level if compression else self.COMPRESSION_LEVEL)
+    resizable = kind == self.FILE
+    with self._lock:
+      dataset = self._file.get(key)
+      if dataset is not None and not self._canOverwrite(dataset, data, kind, filters, resizable):
+        del self._file[key]
+        dataset = None
+      if dataset is None:
+        dataset = self._file.create_dataset(key, shape=data.shape, dtype=data.dtype, chunks=True,
+                                            maxshape=(None,) if resizable else None, **filters)
+      elif resizable:
+        dataset.resize(data.shape)
+      dataset[...] = data
+      dataset.attrs["kind"] = kind
+      for name, value in attributes.iteritems():
+        dataset.attrs[name] = value
+      self._file.flush()
+
+  def _canOverwrite(self, dataset, data, kind, filters, resizable):
+    if dataset.attrs.get("kind") != kind or dataset.dtype != data.dtype or \
+       dataset.compression != filters.get("compression") or dataset.compression_opts != filters.get("compression_opts"):
+      return False
+    return dataset.maxshape[0] is None if resizable else dataset.shape == data.shape
+
+  def writeSnapshot(self, snapshot, filename, compression=None):
+    """ writes a VolumeSnapshot or FileSnapshot (see createSnapshot) """
+    if isinstance(snapshot, VolumeSnapshot):
+      self._createDataset(filename, snapshot.array, self.VOLUME, compression=compression, name=snapshot.name,
+                          nodeClass=snapshot.nodeClass, ijkToRAS=snapshot.ijkToRAS)
+    else:
+      self.writeBytes(filename, snapshot.content, name=snapshot.name)
+
+  def writeNode(self, node, filename, compression=None):
+    self.writeSnapshot(createSnapshot(node, filename, compression), filename, compression)
+
+  def writeBytes(self, filename, content, **attributes):
+    self._createDataset(filename, numpy.frombuffer(content or "\0", dtype=numpy.uint8), self.FILE,
+                        size=len(content), **attributes)
+
+  def appendBytes(self, filename, content):
+    key = self.getKey(filename)
+    with self._lock:
+      dataset = self._file.get(key)
+      if dataset is None or dataset.maxshape[0] is not None:
+        previous = dataset[...].tostring()[:dataset.attrs["size"]] if dataset is not None else ""
+        if dataset is not None:
+          del self._file[key]
+        dataset = self._file.create_dataset(key, shape=(len(previous),), maxshape=(None,), dtype=numpy.uint8,
+                                            chunks=(64 * 1024,), compression=self.COMPRESSION,
+                                            compression_opts=self.COMPRESSION_LEVEL)
+        if previous:
+          dataset[:] = numpy.frombuffer(previous, dtype=numpy.uint8)
+        dataset.attrs["kind"] = self.FILE
+        dataset.attrs["size"] = len(previous)
+      size = dataset.attrs["size"]
+      dataset.resize((size + len(content),))
+      dataset[size:] = numpy.frombuffer(content, dtype=numpy.uint8)
+      dataset.attrs["size"] = size + len(content)
+      self._file.flush()
+
+  def copyFile(self, source, filename):
+    with open(source, 'rb') as sourceFile:
+      self.writeBytes(filename, sourceFile.read())
+
+  def _readDataset(self, filename):
+    with self._lock:
+      dataset = self._file[self.getKey(filename)]
+      return dataset[...], dict(dataset.attrs)
+
+  def readBytes(self, filename):
+    data, attributes = self._readDataset(filename)
+    return data.tostring()[:attributes["size"]]
+
+  def readText(self, filename):
+    return self.readBytes(filename)
+
+  def readNode(self, filename, loadFunction):
+    """ adds the node stored as filename to the MRML scene. loadFunction is used for all data other than volumes """
+    data, attributes = self._readDataset(filename)
+    if attributes["kind"] == self.VOLUME:
+      node = createVolumeNode(data, attributes["ijkToRAS"], attributes["nodeClass"], attributes["name"])
+      slicer.mrmlScene.AddNode(node)
+      node.CreateDefaultDisplayNodes()
+      return node
+    temporaryDirectory = tempfile.mkdtemp()
+    try:
+      temporaryFileName = os.path.join(temporaryDirectory, os.path.basename(filename))
+      with open(temporaryFileName, 'wb') as temporaryFile:
+        temporaryFile.write(data.tostring()[:attributes["size"]])
+      _, node = loadFunction(temporaryFileName, returnNode=True)
+    finally:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    if node and "name" in attributes:
+      node.SetName(attributes["name"])
+    return node
+
+  def export(self, directory, compression=None):
+    """ writes all files of the container to directory, which recreates the SliceTrackerOutputs directory layout """
+    for key in self.keys():
+      filename = os.path.join(directory, *key.split("/"))
+      if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+      data, attributes = self._readDataset(key)
+      if attributes["kind"] == self.VOLUME:
+        writeNrrdArray(data, attributes["ijkToRAS"], filename, compression or Compression())
+      else:
+        with open(filename, 'wb') as outfile:
+          outfile.write(data.tostring()[:attributes["size"]])
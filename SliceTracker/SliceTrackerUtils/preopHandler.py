@@ -6,7 +6,6 @@ import xml
 import getpass
 import datetime
 import logging
-import re
 
 from SlicerDevelopmentToolboxUtils.mixins import ModuleWidgetMixin, ModuleLogicMixin
 from SlicerDevelopmentToolboxUtils.widgets import CustomStatusProgressbar, SliceWidgetConfirmYesNoDialog
@@ -17,6 +16,7 @@ from SlicerDevelopmentToolboxUtils.exceptions import PreProcessedDataError, NoEl
 from .algorithms.automaticProstateSegmentation import AutomaticSegmentationLogic
 from .steps.plugins.segmentationValidator import SliceTrackerSegmentationValidatorPlugin
 from .constants import SliceTrackerConstants
+from .configuration import SliceTrackerSettings
 from .sessionData import SegmentationData, PreopData
 
 
@@ -247,7 +247,7 @@ class PreopDataHandler(ModuleWidgetMixin, ModuleLogicMixin):
     from mpReview import mpReviewLogic
     seriesMap, _ = mpReviewLogic.loadMpReviewProcessedData(resourcesDir)
 
-    regex = self.getSetting("PLANNING_IMAGE_PATTERN", moduleName=self.MODULE_NAME)
+    settings = SliceTrackerSettings().snapshot
 
     for series in seriesMap:
       seriesName = str(seriesMap[series]['LongName'])
@@ -258,7 +258,7 @@ class PreopDataHandler(ModuleWidgetMixin, ModuleLogicMixin):
 
       dom = xml.dom.minidom.parse(xmlFile)
       seriesDescription = self.findElement(dom, "SeriesDescription")
-      if re.match(regex, seriesDescription) or seriesDescription == regex:
+      if settings.isPlanningImage(seriesDescription):
         return seriesMap[series]['NRRDLocation'], segmentationsPath
 
     raise NoEligibleSeriesFoundError("No eligible series found for preop AX T2 segmentation. MpReview might not have "
@@ -1,12 +1,15 @@
-import os, logging
+import os, logging, time
 import vtk, ctk, ast
 import qt
 
 import slicer
-from sessionData import SessionData, RegistrationResult, RegistrationTypeData
+from sessionData import SessionData, RegistrationResult, RegistrationTypeData, ContentAddressedStore
 from constants import SliceTrackerConstants
-from helpers import SeriesTypeManager
+from configuration import SliceTrackerSettings
+from helpers import SeriesTypeManager, SeriesTypeClassifier
 from preopHandler import PreopDataHandler
+from jobs import JobScheduler, Job
+from persistence import CaseContainer
 
 from SlicerDevelopmentToolboxUtils.constants import DICOMTAGS, STYLE
 from SlicerDevelopmentToolboxUtils.events import SlicerDevelopmentToolboxEvents
@@ -19,7 +22,7 @@ from SlicerDevelopmentToolboxUtils.decorators import singleton, onExceptionRetur
 from SlicerDevelopmentToolboxUtils.decorators import onReturnProcessEvents, onExceptionReturnNone
 from SlicerDevelopmentToolboxUtils.module.session import StepBasedSession
 
-from SliceTrackerRegistration import SliceTrackerRegistrationLogic
+from SliceTrackerRegistration import SliceTrackerRegistrationLogic, PrecomputedMovingImage
 
 
 @singleton
@@ -39,6 +42,8 @@ class SliceTrackerSession(StepBasedSession):
   CurrentResultChangedEvent = vtk.vtkCommand.UserEvent + 152
   RegistrationStatusChangedEvent = vtk.vtkCommand.UserEvent + 153
   TargetSelectionEvent = vtk.vtkCommand.UserEvent + 154
+  SeriesStatusChangedEvent = vtk.vtkCommand.UserEvent + 155
+  SeriesTypeChangedEvent = vtk.vtkCommand.UserEvent + 156
 
   InitiateZFrameCalibrationEvent = vtk.vtkCommand.UserEvent + 160
   InitiateSegmentationEvent = vtk.vtkCommand.UserEvent + 161
@@ -86,7 +91,7 @@ class SliceTrackerSession(StepBasedSession):
   def zFrameRegistrationSuccessful(self, value):
     self._zFrameRegistrationSuccessful = value
     if self._zFrameRegistrationSuccessful:
-      self.save()
+      self.scheduleSave(journaled=False)
       self.invokeEvent(self.ZFrameRegistrationSuccessfulEvent)
 
   @property
@@ -102,7 +107,8 @@ class SliceTrackerSession(StepBasedSession):
     if self.currentResult and self.currentResult.name == series:
       return
     if self.currentResult is not None:
-      self.currentResult.removeEventObservers()
+      for event in RegistrationResult.StatusEvents.values():
+        self.currentResult.removeEventObserver(event, self.onRegistrationResultStatusChanged)
     self._currentResult = series
     if self.currentResult:
       for event in RegistrationResult.StatusEvents.values():
@@ -192,19 +198,26 @@ class SliceTrackerSession(StepBasedSession):
 
   def __init__(self):
     StepBasedSession.__init__(self)
+    self.scheduler = JobScheduler()
     self.registrationLogic = SliceTrackerRegistrationLogic()
+    self.registrationLogic.scheduler = self.scheduler
     self.seriesTypeManager = SeriesTypeManager()
     self.seriesTypeManager.addEventObserver(self.seriesTypeManager.SeriesTypeManuallyAssignedEvent,
-                                            lambda caller, event: self.invokeEvent(self.SeriesTypeManuallyAssignedEvent))
+                                            self.onSeriesTypeManuallyAssigned)
     self.resetAndInitializeMembers()
 
   def resetAndInitializeMembers(self):
     self._busy = False
+    self._registrationRunning = False
+    self._scheduledSaveJournaled = True
+    self.scheduler.cancelAll()
     self.seriesTypeManager.clear()
+    SliceTrackerSettings().refresh()
     self.initializeColorNodes()
     self.directory = None
     self.data = SessionData()
     self.data.addEventObserver(self.data.NewResultCreatedEvent, self.onNewRegistrationResultCreated)
+    self.data.addEventObserver(self.data.ResultStatusChangedEvent, self.onResultStatusChanged)
     self.trainingMode = False
     self.resetPreopDICOMReceiver()
     self.resetIntraopDICOMReceiver()
@@ -217,6 +230,19 @@ class SliceTrackerSession(StepBasedSession):
     self.retryMode = False
     self.previousStep = None
     self.temporaryIntraopTargets = None
+    self.clearPrecomputedMovingImage()
+
+  def clearPrecomputedMovingImage(self):
+    if getattr(self, "precomputedMovingImage", None):
+      self.precomputedMovingImage.clear()
+    self.precomputedMovingImage = None
+
+  def getPrecomputedMovingImage(self, coverProstateResult):
+    volume, label = coverProstateResult.volumes.fixed, coverProstateResult.labels.fixed
+    if not self.precomputedMovingImage or not self.precomputedMovingImage.isValidFor(volume, label):
+      self.clearPrecomputedMovingImage()
+      self.precomputedMovingImage = PrecomputedMovingImage(volume, label, prefix=str(coverProstateResult.seriesNumber))
+    return self.precomputedMovingImage
 
   def initializeColorNodes(self):
     from mpReview import mpReviewLogic
@@ -239,7 +265,7 @@ class SliceTrackerSession(StepBasedSession):
     return self.seriesTypeManager.isCoverProstate(self.currentSeries) and not self.data.usePreopData
 
   def isBusy(self):
-    return self.isPreProcessing() or self._busy
+    return self.isPreProcessing() or self._busy or self._registrationRunning or self.scheduler.isBlocking()
 
   def isPreProcessing(self):
     return slicer.util.selectedModule() != self.MODULE_NAME
@@ -269,6 +295,7 @@ class SliceTrackerSession(StepBasedSession):
     self.createDirectory(self.intraopDICOMDirectory)
     self.createDirectory(self.preprocessedDirectory)
     self.createDirectory(self.outputDirectory)
+    self.data.openJournal(self.outputDirectory)
     self.startPreopDICOMReceiver()
     self.newCaseCreated = False
     self.invokeEvent(self.NewCaseStartedEvent)
@@ -276,6 +303,7 @@ class SliceTrackerSession(StepBasedSession):
   def close(self, save=False):
     if not self.isRunning():
       return
+    self.scheduler.flush(Job.PERSISTENCE)
     message = None
     if save:
       success, failedFileNames = self.data.close(self.outputDirectory)
@@ -284,26 +312,68 @@ class SliceTrackerSession(StepBasedSession):
     self.resetAndInitializeMembers()
     self.invokeEvent(self.CloseCaseEvent, str(message))
 
-  def save(self):
-    success, failedFileNames = self.data.save(self.outputDirectory)
+  def finishBiasCorrection(self):
+    """ waits for a pending bias correction, which replaces the initial volume once done """
+    for job in [job for job in self.scheduler.getQueue() if job.priority == Job.BIAS_CORRECTION]:
+      self.scheduler.finish(job)
+
+  def scheduleSave(self, journaled=True):
+    """ saves modified data in the background without waiting for it to be written
+
+    Changes which are not recorded in the journal (e.g. z-frame registration and preop data) need journaled=False, so
+    that results.json gets rewritten as well.
+    """
+    self._scheduledSaveJournaled = self._scheduledSaveJournaled and journaled
+    self.scheduler.submitFunction("Save session data", self._runScheduledSave, priority=Job.PERSISTENCE, key="save")
+
+  def _runScheduledSave(self):
+    journaled, self._scheduledSaveJournaled = self._scheduledSaveJournaled, True
+    self.data.save(self.outputDirectory, journaled=journaled)
+
+  def save(self, journaled=False):
+    """ saves modified data. Unless journaled, waits until all data has been written before reporting success """
+    success, failedFileNames = self.data.save(self.outputDirectory, journaled=journaled)
+    if not journaled:
+      failedFileNames += self.data.flush()
     return success and not len(failedFileNames), "The following data failed to saved:\n %s" % failedFileNames
 
   def complete(self):
     self.data.completed = True
     self.close(save=True)
 
+  def isStoredInContainer(self):
+    return self.data.container is not None or self.getSetting("Storage_Format") == "HDF5"
+
+  def exportCase(self, destination):
+    """ saves the case and writes it from its container to destination using the directory layout """
+    if os.path.abspath(destination) == os.path.abspath(self.outputDirectory):
+      raise ValueError("The case cannot be exported into its own output directory")
+    self.scheduler.flush(Job.PERSISTENCE)
+    self.data.save(self.outputDirectory)
+    self.data.export(destination)
+
+  @property
+  def resultsFileName(self):
+    containerFileName = os.path.join(self.outputDirectory, CaseContainer.FILENAME)
+    if os.path.exists(containerFileName):
+      return containerFileName
+    return os.path.join(self.outputDirectory, SliceTrackerConstants.JSON_FILENAME)
+
   def load(self):
-    filename = os.path.join(self.outputDirectory, SliceTrackerConstants.JSON_FILENAME)
+    filename = self.resultsFileName
     completed = self.data.wasSessionCompleted(filename)
     if slicer.util.confirmYesNoDisplay("A %s session has been found for the selected case. Do you want to %s?" \
                                         % ("completed" if completed else "started",
                                            "open it" if completed else "continue this session")):
       slicer.app.layoutManager().blockSignals(True)
       self._busy = True
+      startTime = time.time()
       self.data.load(filename)
       self.postProcessLoadedSessionData()
       slicer.app.layoutManager().blockSignals(False)
       self.invokeEvent(self.LoadingMetadataSuccessfulEvent)
+      logging.info("Case loaded: time to interactive %.2fs (%d files deferred until first access)"
+                   % (time.time() - startTime, self.data.getNumberOfPendingFiles()))
     else:
       self.clearData()
 
@@ -413,6 +483,7 @@ class SliceTrackerSession(StepBasedSession):
     indexer = ctk.ctkDICOMIndexer()
 
     newSeries = []
+    grownSeries = []
     for currentIndex, currentFile in enumerate(newFileList, start=1):
       self.invokeEvent(SlicerDevelopmentToolboxEvents.NewFileIndexedEvent,
                        ["Indexing file %s" % currentFile, len(newFileList), currentIndex].__str__())
@@ -423,15 +494,32 @@ class SliceTrackerSession(StepBasedSession):
       indexer.addFile(slicer.dicomDatabase, currentFile, None)
       series = self.makeSeriesNumberDescription(currentFile)
       if series not in self.seriesList:
-        self.seriesTimeStamps[series] = self.getTime()
+        if series in self.data.seriesReceivedTimeStamps:
+          self.seriesTimeStamps[series] = self.data.seriesReceivedTimeStamps[series]
+        else:
+          self.seriesTimeStamps[series] = self.getTime()
+          self.data.seriesReceivedTimeStamps[series] = self.seriesTimeStamps[series]
+          self.data.recordEvent("seriesReceived", series=series, time=self.seriesTimeStamps[series])
         self.seriesList.append(series)
         newSeries.append(series)
         self.loadableList[series] = self.createLoadableFileListForSeries(series)
+        self.seriesTypeManager.setSeriesHeaders(series, self.getSeriesHeaders(currentFile, series))
+      elif series in self.loadableList and currentFile not in self.loadableList[series]:
+        self.loadableList[series].append(currentFile)
+        if series not in grownSeries:
+          grownSeries.append(series)
+    previousSeriesTypes = {series: self.seriesTypeManager.getSeriesType(series) for series in grownSeries}
+    for series in grownSeries:
+      self.seriesTypeManager.setSliceCount(series, len(self.loadableList[series]))
     self.seriesList = sorted(self.seriesList, key=lambda s: RegistrationResult.getSeriesNumberFromString(s))
+    self.seriesTypeManager.classify(newSeries + grownSeries)
 
     if len(newFileList):
       self.verifyPatientIDEquality(newFileList)
       self.invokeEvent(self.NewImageSeriesReceivedEvent, newSeries.__str__())
+    for series in grownSeries:
+      if self.seriesTypeManager.getSeriesType(series) != previousSeriesTypes[series]:
+        self.invokeEvent(self.SeriesTypeChangedEvent, series)
 
   def verifyPatientIDEquality(self, receivedFiles):
     seriesNumberPatientID = self.getAdditionalInformationForReceivedSeries(receivedFiles)
@@ -504,6 +592,11 @@ class SliceTrackerSession(StepBasedSession):
                             .format(dcmFile, seriesNumber, seriesDescription))
     return "{}: {}".format(seriesNumber, seriesDescription)
 
+  def getSeriesHeaders(self, dcmFile, series):
+    headers = {name: self.getDICOMValue(dcmFile, tag) or "" for name, tag in SeriesTypeClassifier.TAGS.items()}
+    headers[SeriesTypeClassifier.SLICE_COUNT] = len(self.loadableList[series])
+    return headers
+
   def getAdditionalInformationForReceivedSeries(self, fileList):
     seriesNumberPatientID = {}
     for currentFile in [os.path.join(self.intraopDICOMDirectory, f) for f in fileList]:
@@ -546,7 +639,7 @@ class SliceTrackerSession(StepBasedSession):
       self.startPreopDICOMReceiver()
 
   def hasJSONResults(self):
-    return os.path.exists(os.path.join(self.outputDirectory, SliceTrackerConstants.JSON_FILENAME))
+    return os.path.exists(self.resultsFileName)
 
   def onPreprocessingSuccessful(self, caller, event):
     self.setupPreopLoadedTargets()
@@ -614,10 +707,7 @@ class SliceTrackerSession(StepBasedSession):
     return currentSeriesNumber > approvedSeriesNumber
 
   def isInGeneralTrackable(self, series):
-    seriesType = self.seriesTypeManager.getSeriesType(series)
-    return self.isAnyListItemInString(seriesType, [self.getSetting("COVER_TEMPLATE_PATTERN"),
-                                                   self.getSetting("COVER_PROSTATE_PATTERN"),
-                                                   self.getSetting("NEEDLE_IMAGE_PATTERN")])
+    return self.seriesTypeManager.getSeriesType(series) in SliceTrackerSettings().snapshot.trackableSeriesTypes
 
   def resultHasNotBeenProcessed(self, series):
     return not (self.data.registrationResultWasApproved(series) or
@@ -625,9 +715,7 @@ class SliceTrackerSession(StepBasedSession):
                 self.data.registrationResultWasRejected(series))
 
   def isEligibleForSkipping(self, series):
-    seriesType = self.seriesTypeManager.getSeriesType(series)
-    return not self.isAnyListItemInString(seriesType,[self.getSetting("COVER_PROSTATE_PATTERN"),
-                                                      self.getSetting("COVER_TEMPLATE_PATTERN")])
+    return self.seriesTypeManager.getSeriesType(series) in SliceTrackerSettings().snapshot.skippableSeriesTypes
 
   def takeActionForCurrentSeries(self):
     event = None
@@ -649,22 +737,29 @@ class SliceTrackerSession(StepBasedSession):
     self.invokeEvent(self.InitiateSegmentationEvent, str(True))
 
   def getRegistrationResultNameAndGeneratedSuffix(self, name):
-    nOccurrences = sum([1 for result in self.data.getResultsAsList() if name in result.name])
+    nOccurrences = self.data.getNumberOfResultsForSeries(name)
     suffix = ""
     if nOccurrences:
       suffix = "_Retry_" + str(nOccurrences)
     return name, suffix
 
   def onInvokeRegistration(self, initial=True, retryMode=False, segmentationData=None):
+    if self._registrationRunning:
+      logging.warn("Ignoring registration request while another registration is running")
+      return
+    self._registrationRunning = True
     self.progress = ModuleWidgetMixin.createProgressDialog(maximum=4, value=1, windowFlags=qt.Qt.CustomizeWindowHint |
                                                                                            qt.Qt.WindowTitleHint)
     self.progress.setCancelButton(None)
-    if initial:
-      self.applyInitialRegistration(retryMode, segmentationData, progressCallback=self.updateProgressBar)
-    else:
-      self.applyRegistration(progressCallback=self.updateProgressBar)
-    self.progress.close()
-    self.progress = None
+    try:
+      if initial:
+        self.applyInitialRegistration(retryMode, segmentationData, progressCallback=self.updateProgressBar)
+      else:
+        self.applyRegistration(progressCallback=self.updateProgressBar)
+    finally:
+      self.progress.close()
+      self.progress = None
+      self._registrationRunning = False
     logging.debug('Re-Registration is done')
 
   @onReturnProcessEvents
@@ -707,10 +802,11 @@ class SliceTrackerSession(StepBasedSession):
     self.dilateMask(fixedLabel, dilateValue=self.segmentedLabelValue)
     self._runRegistration(self.currentSeriesVolume, fixedLabel, coverProstateRegResult.volumes.fixed,
                           coverProstateRegResult.labels.fixed, coverProstateRegResult.targets.approved, None,
-                          progressCallback)
+                          progressCallback, self.getPrecomputedMovingImage(coverProstateRegResult),
+                          deadline=float(self.getSetting("Registration_Deadline")))
 
   def _runRegistration(self, fixedVolume, fixedLabel, movingVolume, movingLabel, targets, segmentationData,
-                       progressCallback):
+                       progressCallback, precomputedMovingImage=None, deadline=None):
     result = self.generateNameAndCreateRegistrationResult(fixedVolume)
     result.receivedTime = self.seriesTimeStamps[result.name.replace(result.suffix, "")]
     if segmentationData:
@@ -721,9 +817,23 @@ class SliceTrackerSession(StepBasedSession):
     parameterNode.SetAttribute('MovingImageNodeID', movingVolume.GetID())
     parameterNode.SetAttribute('MovingLabelNodeID', movingLabel.GetID())
     parameterNode.SetAttribute('TargetsNodeID', targets.GetID())
+    if precomputedMovingImage:
+      parameterNode.SetAttribute('PrecomputedMovingImageNodeID', precomputedMovingImage.volume.GetID())
+      parameterNode.SetAttribute('PrecomputedMovingLabelNodeID', precomputedMovingImage.label.GetID())
     result.startTime = self.getTime()
-    self.registrationLogic.run(parameterNode, progressCallback=progressCallback)
+    self.data.recordEvent("registrationStarted", name=result.name, time=result.startTime)
+    try:
+      self.registrationLogic.run(parameterNode, progressCallback=progressCallback, deadline=deadline)
+    except RuntimeError as exc:
+      result.endTime = self.getTime()
+      logging.error("Registration of %s failed: %s" % (result.name, str(exc)))
+      result.reject()
+      slicer.util.errorDisplay("Registration of %s failed. Please retry the registration." % result.name,
+                               detailedText=str(exc), windowTitle="SliceTracker")
+      return
     result.endTime = self.getTime()
+    ContentAddressedStore().prefetchContentHashes(result.volumes.asList() + result.labels.asList())
+    self.data.recordEvent("registrationEnded", name=result.name, time=result.endTime, truncated=result.truncated)
     self.addTargetsToMRMLScene(result)
     if self.seriesTypeManager.isCoverProstate(self.currentSeries) and self.temporaryIntraopTargets:
       self.addTemporaryTargetsToResult(result)
@@ -747,13 +857,26 @@ class SliceTrackerSession(StepBasedSession):
     self.skipAllUnregisteredPreviousSeries(self.currentResult.name)
     if self._busy:
       return
-    self.save()
+    if self.currentResult.approved and self.seriesTypeManager.isCoverProstate(self.currentResult.name):
+      self.getPrecomputedMovingImage(self.currentResult)
+    self.scheduleSave()
     self.invokeEvent(self.RegistrationStatusChangedEvent)
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def onNewRegistrationResultCreated(self, caller, event, callData):
     self.currentResult = callData
 
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onResultStatusChanged(self, caller, event, callData):
+    seriesNumber = RegistrationResult.getSeriesNumberFromString(callData)
+    for series in self.seriesList:
+      if RegistrationResult.getSeriesNumberFromString(series) == seriesNumber:
+        self.invokeEvent(self.SeriesStatusChangedEvent, series)
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSeriesTypeManuallyAssigned(self, caller, event, callData):
+    self.invokeEvent(self.SeriesTypeManuallyAssignedEvent, callData)
+
   def skipAllUnregisteredPreviousSeries(self, series):
     selectedSeriesNumber = RegistrationResult.getSeriesNumberFromString(series)
     for series in [series for series in self.seriesList if not self.seriesTypeManager.isCoverTemplate(series)]:
@@ -776,7 +899,7 @@ class SliceTrackerSession(StepBasedSession):
   def skip(self, series):
     self.skipAllUnregisteredPreviousSeries(series)
     self.skipSeries(series)
-    self.save()
+    self.scheduleSave()
 
   def _getConsent(self):
     return RadioButtonChoiceMessageBox("Who gave consent?", options=["Clinician", "Operator"]).exec_()
@@ -2,20 +2,393 @@ import logging
 import slicer, vtk
 import os, json
 import shutil
+import threading
+import time
+import bisect
+import hashlib
+import itertools
+import numpy
 from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from SlicerDevelopmentToolboxUtils.constants import FileExtension
+from SlicerDevelopmentToolboxUtils.metaclasses import Singleton
 from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
 from SlicerDevelopmentToolboxUtils.decorators import onExceptionReturnNone, logmethod
 from SlicerDevelopmentToolboxUtils.widgets import CustomStatusProgressbar
 
 from constants import SliceTrackerConstants
 from helpers import SeriesTypeManager
+from persistence import PersistenceWorker, ProcedureJournal, ParallelFileLoader, CaseContainer, Compression
+from persistence import LogFileMirror
+
+
+class NodeDirtyTracker(ModuleLogicMixin):
+  """ Remembers what has been written to disk in order to only write data that changed since its last save
+
+  Nodes are compared by a signature of their saved content (e.g. image data modification time and geometry for
+  volumes, fiducial positions and labels for markups), text files by their content and copied files by size and
+  modification time of the source. If a writer (PersistenceWorker) is set, writes are handed over to it and files are
+  marked as saved once the writer reports them written. Until then their signatures are pending, which prevents
+  submitting the same content twice.
+  """
+
+  __metaclass__ = Singleton
+
+  def __init__(self):
+    self.writer = None
+    self._lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    with self._lock:
+      self._signatures = {}
+      self._pending = {}
+
+  def forget(self, filename):
+    with self._lock:
+      self._signatures.pop(os.path.abspath(filename), None)
+
+  def getNodeSignature(self, node):
+    signature = [node.GetClassName(), node.GetName()]
+    if isinstance(node, slicer.vtkMRMLMarkupsFiducialNode):
+      signature.append(node.GetLocked())
+      for index in range(node.GetNumberOfFiducials()):
+        position = [0.0, 0.0, 0.0]
+        node.GetNthFiducialPosition(index, position)
+        signature.append((node.GetNthFiducialLabel(index), tuple(position), node.GetNthFiducialSelected(index),
+                          node.GetNthFiducialVisibility(index), node.GetNthFiducialLocked(index)))
+    elif isinstance(node, slicer.vtkMRMLVolumeNode):
+      ijkToRAS = vtk.vtkMatrix4x4()
+      node.GetIJKToRASMatrix(ijkToRAS)
+      signature.append(tuple(ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)))
+      signature.append(node.GetImageData().GetMTime() if node.GetImageData() else None)
+    elif isinstance(node, slicer.vtkMRMLTransformNode):
+      transform = node.GetTransformToParent()
+      signature += [node.GetMTime(), transform.GetMTime() if transform else None]
+    elif isinstance(node, slicer.vtkMRMLModelNode):
+      signature += [node.GetMTime(), node.GetPolyData().GetMTime() if node.GetPolyData() else None]
+    else:
+      signature.append(node.GetMTime())
+    return tuple(signature)
+
+  def exists(self, filename):
+    return self.writer.exists(filename) if self.writer else os.path.exists(filename)
+
+  def isModified(self, filename, signature):
+    filename = os.path.abspath(filename)
+    with self._lock:
+      if self._pending.get(filename) == signature:
+        return False
+      savedSignature = self._signatures.get(filename)
+    return not self.exists(filename) or savedSignature != signature
+
+  def markSaved(self, filename, signature):
+    with self._lock:
+      self._signatures[os.path.abspath(filename)] = signature
+
+  def _submit(self, filename, signature, write):
+    """ calls write with a callback which marks filename saved if the writer succeeded """
+    filename = os.path.abspath(filename)
+    with self._lock:
+      self._pending[filename] = signature
+
+    def onWritten(success):
+      with self._lock:
+        if self._pending.get(filename) == signature:
+          del self._pending[filename]
+        if success:
+          self._signatures[filename] = signature
+    write(onWritten)
+
+  def markNodeSaved(self, node, filename):
+    self.markSaved(filename, self.getNodeSignature(node))
+
+  def saveNodeDataIfModified(self, node, outputDir, extension, name=None, compression=None):
+    name = self.replaceUnwantedCharacters(name if name else node.GetName())
+    filename = os.path.join(outputDir, name + extension)
+    signature = self.getNodeSignature(node)
+    if not self.isModified(filename, signature):
+      return True, name
+    if self.writer:
+      self._submit(filename, signature, lambda callback: self.writer.writeNode(node, filename, compression, callback))
+      return True, name
+    success, name = self.saveNodeData(node, outputDir, extension, name=name)
+    if success:
+      self.markSaved(filename, signature)
+    return success, name
+
+  def writeFileIfModified(self, filename, content):
+    if not self.isModified(filename, content):
+      return False
+    if self.writer:
+      self._submit(filename, content, lambda callback: self.writer.writeText(filename, content, callback))
+      return True
+    with open(filename, 'w') as outfile:
+      outfile.write(content)
+    self.markSaved(filename, content)
+    return True
+
+  def copyFileIfModified(self, source, destination):
+    stat = os.stat(source)
+    signature = (os.path.abspath(source), stat.st_size, stat.st_mtime)
+    if not self.isModified(destination, signature):
+      return False
+    if self.writer:
+      self._submit(destination, signature,
+                   lambda callback: self.writer.copyFile(source, destination, callback))
+      return True
+    shutil.copy(source, destination)
+    self.markSaved(destination, signature)
+    return True
+
+
+class ContentAddressedStore(ModuleLogicMixin):
+  """ Stores volumes once per content as blobs/<first two hash characters>/<hash>.nrrd
+
+  The hash covers node class, geometry and voxel data, so identical volumes (e.g. the fixed volume of retried
+  registrations) are written only once. Hashes are memoized by the NodeDirtyTracker signature of a node, which turns
+  repeated saves of unchanged data into a lookup, and can be computed in advance on a background thread
+  (prefetchContentHashes). Blob file names do not carry node names, which are therefore kept per reference (e.g.
+  results/<name>/volumes/fixed, see getReference) in a separate mapping (names) that is saved along with the results.
+  Cases saved before names were kept per reference map blob file names to names instead.
+  """
+
+  __metaclass__ = Singleton
+
+  DIRECTORY = "blobs"
+
+  @staticmethod
+  def isBlobFileName(fileName):
+    return fileName.startswith(ContentAddressedStore.DIRECTORY + "/")
+
+  @staticmethod
+  def getReference(*keys):
+    return "/".join(keys)
+
+  @staticmethod
+  def computeContentHash(className, ijkToRAS, array):
+    """ hashes class name, row-major IJKToRAS matrix and voxels. Does not use VTK or MRML """
+    contentHash = hashlib.sha1(className)
+    contentHash.update(repr(ijkToRAS))
+    array = numpy.ascontiguousarray(array)
+    contentHash.update(repr((array.shape, array.dtype.str)))
+    contentHash.update(array.data)
+    return contentHash.hexdigest()
+
+  def __init__(self):
+    self._hashPool = None
+    self.clear()
+
+  def clear(self):
+    self.names = {}
+    self._hashes = {}
+    self._pendingHashes = {}
+    self._storedFileNames = set()
+    self._pendingFileNames = set()
+
+  def getName(self, reference, fileName):
+    """ returns the node name of the blob fileName as referenced by reference """
+    return self.names.get(reference, self.names.get(fileName))
+
+  def forget(self, filename):
+    self._storedFileNames.discard(os.path.abspath(filename))
+
+  def _getHashInput(self, node):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(ijkToRAS)
+    return node.GetClassName(), [ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)]
+
+  def prefetchContentHashes(self, nodes):
+    """ starts hashing copies of the given volumes on a background thread. hashlib releases the GIL while hashing """
+    for node in [node for node in nodes if node and node.GetImageData()]:
+      signature = NodeDirtyTracker().getNodeSignature(node)
+      if signature in self._hashes or signature in self._pendingHashes:
+        continue
+      if not self._hashPool:
+        self._hashPool = ThreadPool(1)
+      className, ijkToRAS = self._getHashInput(node)
+      array = numpy.array(slicer.util.arrayFromVolume(node), copy=True)
+      self._pendingHashes[signature] = self._hashPool.apply_async(self.computeContentHash,
+                                                                  (className, ijkToRAS, array))
+
+  def getContentHash(self, node):
+    """ returns the memoized or prefetched hash. Volumes which were not prefetched get hashed on the calling thread """
+    signature = NodeDirtyTracker().getNodeSignature(node)
+    try:
+      return self._hashes[signature]
+    except KeyError:
+      pass
+    if signature in self._pendingHashes:
+      self._hashes[signature] = self._pendingHashes.pop(signature).get()
+    else:
+      className, ijkToRAS = self._getHashInput(node)
+      self._hashes[signature] = self.computeContentHash(className, ijkToRAS, slicer.util.arrayFromVolume(node))
+    return self._hashes[signature]
+
+  def getFileName(self, node, extension=FileExtension.NRRD):
+    contentHash = self.getContentHash(node)
+    return "/".join([self.DIRECTORY, contentHash[:2], contentHash + extension])
+
+  def save(self, node, outputDir, extension=FileExtension.NRRD, compression=None):
+    """ writes the node unless a blob with the same content exists and returns (success, blob file name) """
+    fileName = self.getFileName(node, extension)
+    filename = os.path.abspath(os.path.join(outputDir, fileName))
+    if filename in self._storedFileNames or filename in self._pendingFileNames:
+      return True, fileName
+    if NodeDirtyTracker().exists(filename):
+      self._storedFileNames.add(filename)
+      return True, fileName
+    writer = NodeDirtyTracker().writer
+    if writer:
+      self._pendingFileNames.add(filename)
+
+      def onWritten(written):
+        self._pendingFileNames.discard(filename)
+        if written:
+          self._storedFileNames.add(filename)
+      writer.writeNode(node, filename, compression, onWritten)
+      return True, fileName
+    else:
+      self.createDirectory(os.path.dirname(filename))
+      success, _ = self.saveNodeData(node, os.path.dirname(filename), extension,
+                                     name=os.path.basename(filename)[:-len(extension)])
+    if success:
+      self._storedFileNames.add(filename)
+    return success, fileName
+
+  def registerLoadedNode(self, node, fileName, directory):
+    """ remembers the hash of a loaded blob to not recompute it on save. Call after naming the node """
+    self._hashes[NodeDirtyTracker().getNodeSignature(node)] = os.path.splitext(os.path.basename(fileName))[0]
+    self._storedFileNames.add(os.path.abspath(os.path.join(directory, fileName)))
+
+
+class RegistrationResultStore(OrderedDict):
+  """ Registration results by name, with secondary indexes by series number, status and series type
+
+  The indexes are updated when results are added or removed and on status events of the results. Approved results
+  are additionally kept sorted by series number. The series type index is rebuilt on first use after results changed
+  or a series type got assigned manually.
+  """
+
+  def __init__(self, *args, **kwargs):
+    self._counter = itertools.count()
+    self._insertionIndices = {}
+    self._statuses = {}
+    self._observers = {}
+    self._resultsBySeriesNumber = {}
+    self._resultsByStatus = {}
+    self._resultsBySeriesType = None
+    self._approvedOrder = []
+    SeriesTypeManager().addEventObserver(SeriesTypeManager.SeriesTypeManuallyAssignedEvent, self._onSeriesTypeAssigned)
+    OrderedDict.__init__(self, *args, **kwargs)
+
+  def close(self):
+    SeriesTypeManager().removeEventObserver(SeriesTypeManager.SeriesTypeManuallyAssignedEvent,
+                                            self._onSeriesTypeAssigned)
+
+  def __setitem__(self, name, result, **kwargs):
+    if name in self:
+      self._removeFromIndexes(name)
+    OrderedDict.__setitem__(self, name, result, **kwargs)
+    self._addToIndexes(name, result)
+
+  def __delitem__(self, name, **kwargs):
+    self._removeFromIndexes(name)
+    OrderedDict.__delitem__(self, name, **kwargs)
+
+  def clear(self):
+    for name in self.keys():
+      self._removeFromIndexes(name)
+    OrderedDict.clear(self)
+
+  def sort(self, key=lambda item: item[0]):
+    items = sorted(self.items(), key=key)
+    self.clear()
+    for name, result in items:
+      self[name] = result
+
+  def _getApprovedOrderKey(self, name, result):
+    return result.seriesNumber, self._insertionIndices[name], name
+
+  def _addToIndexes(self, name, result):
+    self._insertionIndices[name] = next(self._counter)
+    self._resultsBySeriesNumber.setdefault(result.seriesNumber, []).append(result)
+    self._addToStatusIndex(name, result)
+    self._resultsBySeriesType = None
+    self._observers[name] = lambda caller, event, name=name: self._onStatusChanged(name)
+    for event in RegistrationStatus.StatusEvents.values():
+      result.addEventObserver(event, self._observers[name])
+
+  def _removeFromIndexes(self, name):
+    result = self[name]
+    observer = self._observers.pop(name)
+    for event in RegistrationStatus.StatusEvents.values():
+      result.removeEventObserver(event, observer)
+    self._removeFromStatusIndex(name, result)
+    self._resultsBySeriesNumber[result.seriesNumber].remove(result)
+    self._resultsBySeriesType = None
+    del self._insertionIndices[name]
+
+  def _addToStatusIndex(self, name, result):
+    self._statuses[name] = result.status
+    self._resultsByStatus.setdefault(result.status, OrderedDict())[name] = result
+    if result.approved:
+      bisect.insort(self._approvedOrder, self._getApprovedOrderKey(name, result))
+
+  def _removeFromStatusIndex(self, name, result):
+    status = self._statuses.pop(name)
+    del self._resultsByStatus[status][name]
+    if status == RegistrationStatus.APPROVED_STATUS:
+      index = bisect.bisect_left(self._approvedOrder, self._getApprovedOrderKey(name, result))
+      del self._approvedOrder[index]
+
+  def _onStatusChanged(self, name):
+    result = self[name]
+    if self._statuses[name] != result.status:
+      self._removeFromStatusIndex(name, result)
+      self._addToStatusIndex(name, result)
+
+  def _onSeriesTypeAssigned(self, caller, event):
+    self._resultsBySeriesType = None
+
+  def getResultsBySeriesNumber(self, seriesNumber):
+    return list(self._resultsBySeriesNumber.get(seriesNumber, []))
+
+  def getResultsByStatus(self, status):
+    return self._resultsByStatus.get(status, OrderedDict()).values()
+
+  def getResultsBySeriesType(self, seriesType):
+    if self._resultsBySeriesType is None:
+      seriesTypeManager = SeriesTypeManager()
+      self._resultsBySeriesType = {}
+      for result in self.values():
+        self._resultsBySeriesType.setdefault(seriesTypeManager.getSeriesType(result.name), []).append(result)
+    return list(self._resultsBySeriesType.get(seriesType, []))
+
+  def getNumberOfApprovedResults(self):
+    return len(self._approvedOrder)
+
+  def getApprovedResults(self):
+    """ returns the approved results sorted by series number """
+    return [self[name] for _, _, name in self._approvedOrder]
+
+  def getMostRecentApprovedResult(self, priorToSeriesNumber=None, condition=None):
+    """ returns the approved result with the highest series number (below priorToSeriesNumber if given) """
+    end = bisect.bisect_left(self._approvedOrder, (priorToSeriesNumber,)) if priorToSeriesNumber else \
+      len(self._approvedOrder)
+    for index in range(end - 1, -1, -1):
+      result = self[self._approvedOrder[index][2]]
+      if not condition or condition(result):
+        return result
+    return None
 
 
 class SessionData(ModuleLogicMixin):
 
   NewResultCreatedEvent = vtk.vtkCommand.UserEvent + 901
+  ResultStatusChangedEvent = vtk.vtkCommand.UserEvent + 902
 
   _completed = False
   _resumed = False
@@ -28,6 +401,8 @@ class SessionData(ModuleLogicMixin):
   def completed(self, value):
     self._completed = value
     self.completedLogTimeStamp = self.generateLogfileTimeStampDict() if self._completed else None
+    if self._completed:
+      self.recordEvent("caseCompleted", logfile=self.completedLogTimeStamp)
 
   @property
   def resumed(self):
@@ -39,19 +414,41 @@ class SessionData(ModuleLogicMixin):
       raise ValueError("Completed case is not supposed to be resumed.")
     if value and not self.completed:
       self.resumeTimeStamps.append(self.getTime())
+      self.recordEvent("caseResumed", time=self.resumeTimeStamps[-1])
     self._resumed = value
 
   @staticmethod
   def wasSessionCompleted(filename):
-    with open(filename) as data_file:
-      data = json.load(data_file)
-      procedureEvents = data["procedureEvents"]
-      return "caseCompleted" in procedureEvents.keys()
+    data = SessionData.readResults(filename)
+    procedureEvents = data["procedureEvents"]
+    return "caseCompleted" in procedureEvents.keys()
+
+  @staticmethod
+  def readResults(filename):
+    """ returns the content of results.json, which filename either points to or to a case container """
+    if CaseContainer.isContainer(filename):
+      container = CaseContainer(filename)
+      try:
+        return json.loads(container.readText(SliceTrackerConstants.JSON_FILENAME))
+      finally:
+        container.close()
+    with open(filename) as dataFile:
+      return json.load(dataFile)
 
   @property
   def usedAutomaticPreopSegmentation(self):
     return self.preopData is not None and self.preopData.segmentation.algorithm == "Automatic"
 
+  @property
+  def initialVolume(self):
+    self._initialVolume = getattr(self, "_initialVolume", None)
+    return self._initialVolume
+
+  @initialVolume.setter
+  def initialVolume(self, volume):
+    self._initialVolume = volume
+    ContentAddressedStore().prefetchContentHashes([volume])
+
   @property
   def usePreopData(self):
     self.preopData = getattr(self, "preopData", None)
@@ -63,9 +460,14 @@ class SessionData(ModuleLogicMixin):
     self.preopData = PreopData() if self._usePreopData else None
 
   def __init__(self):
+    NodeDirtyTracker().writer = PersistenceWorker()
     self.resetAndInitializeData()
 
   def resetAndInitializeData(self):
+    self.closeContainer()
+    self.journal = None
+    self._loading = False
+    self.seriesReceivedTimeStamps = {}
     self.seriesTypeManager = SeriesTypeManager()
     self.startTime = self.getTime()
     self.resumeTimeStamps = []
@@ -84,14 +486,21 @@ class SessionData(ModuleLogicMixin):
 
     self.zFrameRegistrationResult = None
 
-    self._savedRegistrationResults = []
+    NodeDirtyTracker().clear()
+    ContentAddressedStore().clear()
     self.initializeRegistrationResults()
 
     self.customProgressBar = CustomStatusProgressbar()
     self.alreadyLoadedFileNames = {}
+    self._blobNodeNames = {}
+    self._loadFunctions = {}
+    self._logFileMirrors = {}
+    self._directory = None
 
   def initializeRegistrationResults(self):
-    self.registrationResults = OrderedDict()
+    if getattr(self, "registrationResults", None) is not None:
+      self.registrationResults.close()
+    self.registrationResults = RegistrationResultStore()
 
   def createZFrameRegistrationResult(self, series):
     self.zFrameRegistrationResult = ZFrameRegistrationResult(series)
@@ -99,28 +508,135 @@ class SessionData(ModuleLogicMixin):
 
   def createResult(self, series, invokeEvent=True):
     assert series not in self.registrationResults.keys()
-    self.registrationResults[series] = RegistrationResult(series)
+    result = RegistrationResult(series)
+    self.registrationResults[series] = result
+    for event in RegistrationResult.StatusEvents.values():
+      result.addEventObserver(event, lambda caller, event, result=result: self.onResultStatusChanged(result))
     if invokeEvent is True:
       self.invokeEvent(self.NewResultCreatedEvent, series)
     return self.registrationResults[series]
 
+  def openContainer(self, filename):
+    self.container = CaseContainer(filename)
+    NodeDirtyTracker().writer.container = self.container
+
+  def closeContainer(self):
+    if not getattr(self, "container", None):
+      self.container = None
+      return
+    self.flush()
+    NodeDirtyTracker().writer.container = None
+    self.container.close()
+    self.container = None
+
+  def _configureStorage(self, outputDir):
+    filename = os.path.join(outputDir, CaseContainer.FILENAME)
+    storageFormat = self.getSetting("Storage_Format", moduleName=SliceTrackerConstants.MODULE_NAME)
+    if self.container or not (os.path.exists(filename) or storageFormat == "HDF5"):
+      return
+    if not CaseContainer.isAvailable():
+      logging.warn("h5py is not available. Saving case data as directory instead of %s" % filename)
+      return
+    importExistingFiles = not os.path.exists(filename)
+    self.flush()
+    self.openContainer(filename)
+    if importExistingFiles:
+      # a case saved as directory before switching to HDF5. Results may reference files which have not been loaded
+      self.container.importDirectory(outputDir, [CaseContainer.FILENAME, SliceTrackerConstants.JOURNAL_FILENAME])
+
+  def export(self, destination):
+    """ writes the case container to destination using the SliceTrackerOutputs directory layout """
+    if not self.container:
+      raise ValueError("Case data is not stored in a container")
+    self.flush()
+    self.container.export(destination, self.getCompression(Compression.ARCHIVE))
+
+  def getCompression(self, kind):
+    """ returns the compression of volumes of the given kind, which is replaced by archive for completed cases """
+    if self.completed:
+      kind = Compression.ARCHIVE
+    setting = self.getSetting("Compression_%s" % kind, moduleName=SliceTrackerConstants.MODULE_NAME)
+    if not setting:
+      return None
+    numberOfThreads = int(self.getSetting("Compression_Threads", moduleName=SliceTrackerConstants.MODULE_NAME) or 0)
+    return Compression.fromString(setting, numberOfThreads)
+
+  def openJournal(self, directory, sequence=0):
+    self.journal = ProcedureJournal(os.path.join(directory, SliceTrackerConstants.JOURNAL_FILENAME), sequence)
+
+  def recordEvent(self, event, **data):
+    if self.journal and not self._loading:
+      self.journal.append(event, **data)
+
+  def onResultStatusChanged(self, result):
+    self.recordEvent(result.status, result=result.asDict(), blobNames=result.getBlobNames())
+    self.invokeEvent(self.ResultStatusChangedEvent, result.name)
+
   def load(self, filename):
+    """ loads a session from results.json or from a case container """
     directory = os.path.dirname(filename)
     self.resetAndInitializeData()
-    with open(filename) as dataFile:
+    self._loading = True
+    try:
       self.customProgressBar.visible = True
       self.customProgressBar.text = "Reading meta information"
 
-      logging.debug("reading json file %s" % filename)
-      data = json.load(dataFile)
+      logging.debug("reading results from %s" % filename)
+      if CaseContainer.isContainer(filename):
+        self.openContainer(filename)
+        data = json.loads(self.container.readText(SliceTrackerConstants.JSON_FILENAME))
+      else:
+        data = self.readResults(filename)
+      self._directory = directory
+      ContentAddressedStore().names.update(data.get("blobNames", {}))
+      self.loadFiles(directory, self._getInitialAndZFrameFiles(data))
       self.readInitialTargetsAndVolume(data, directory)
       self.loadZFrameRegistrationData(data, directory)
       self.loadProcedureEvents(data)
       self.loadPreopData(data)
       self.loadResults(data, directory)
-    self.registrationResults = OrderedDict(sorted(self.registrationResults.items()))
+      self.openJournal(directory, data.get("journalSequence", 0))
+      self.replayJournal(directory, data.get("journalSequence", 0))
+    finally:
+      self._loading = False
+    self.registrationResults.sort()
+    self.preloadDataForNextRegistration()
     return True
 
+  def replayJournal(self, directory, afterSequence):
+    for entry in self.journal.read(afterSequence):
+      event = entry["event"]
+      logging.debug("Replaying journal entry %d: %s" % (entry["sequence"], event))
+      if event == "seriesReceived":
+        self.seriesReceivedTimeStamps[entry["series"]] = entry["time"]
+      elif event in RegistrationStatus.StatusEvents.keys():
+        missingFileNames = self._getMissingFileNames(directory, entry["result"])
+        if missingFileNames:
+          logging.warn("Skipping journal entry %d: %s has not been written" % (entry["sequence"],
+                                                                                ", ".join(missingFileNames)))
+          continue
+        ContentAddressedStore().names.update(entry.get("blobNames", {}))
+        self.registrationResults.pop(entry["result"]["name"], None)
+        self.loadResult(entry["result"], directory)
+      elif event == "caseResumed":
+        self.resumeTimeStamps.append(entry["time"])
+      elif event == "caseClosed":
+        self.closedLogTimeStamps.append(entry["logfile"])
+      elif event == "caseCompleted":
+        self.completed = True
+        self.completedLogTimeStamp = entry["logfile"]
+
+  def _getMissingFileNames(self, directory, jsonResult):
+    """ returns the files referenced by a result which do not exist (e.g. when crashing before writing them) """
+    fileNames = []
+    for attribute in ["volumes", "transforms", "targets", "labels"]:
+      for value in jsonResult.get(attribute, {}).values():
+        fileName = value["fileName"] if isinstance(value, dict) else value
+        if fileName:
+          fileNames.append(fileName)
+    tracker = NodeDirtyTracker()
+    return [fileName for fileName in fileNames if not tracker.exists(os.path.join(directory, fileName))]
+
   def readInitialTargetsAndVolume(self, data, directory):
     if "initialTargets" in data.keys():
       self.initialTargets = self._loadOrGetFileData(directory, data["initialTargets"],
@@ -129,12 +645,16 @@ class SessionData(ModuleLogicMixin):
       self.initialTargetsPath = os.path.join(directory, data["initialTargets"])
 
     if "initialVolume" in data.keys():
-      self.initialVolume = self._loadOrGetFileData(directory, data["initialVolume"], slicer.util.loadVolume)
+      self.initialVolume = self._loadOrGetFileData(directory, data["initialVolume"], slicer.util.loadVolume,
+                                                   self._getBlobName("initialVolume", data["initialVolume"]))
 
   def loadZFrameRegistrationData(self, data, directory):
     if "zFrameRegistration" in data.keys():
       zFrameRegistration = data["zFrameRegistration"]
-      volume = self._loadOrGetFileData(directory, zFrameRegistration["volume"], slicer.util.loadVolume)
+      volume = self._loadOrGetFileData(directory, zFrameRegistration["volume"], slicer.util.loadVolume,
+                                       self._getBlobName(ContentAddressedStore.getReference("zFrameRegistration",
+                                                                                            "volume"),
+                                                         zFrameRegistration["volume"]))
       transform = self._loadOrGetFileData(directory, zFrameRegistration["transform"], slicer.util.loadTransform)
       name = zFrameRegistration["name"] if zFrameRegistration.has_key("name") else volume.GetName()
       self.zFrameRegistrationResult = ZFrameRegistrationResult(name)
@@ -162,64 +682,155 @@ class SessionData(ModuleLogicMixin):
     if len(data["results"]):
       self.customProgressBar.maximum = len(data["results"])
     for index, jsonResult in enumerate(data["results"], start=1):
-      name = jsonResult["name"]
-      logging.debug("processing %s" % name)
-      result = self.createResult(name, invokeEvent=False)
-      self.customProgressBar.updateStatus("Loading series registration result %s" % result.name, index)
-      slicer.app.processEvents()
-
-      for attribute, value in jsonResult.iteritems():
-        logging.debug("found %s: %s" % (attribute, value))
-        if attribute == 'volumes':
-          self._loadResultFileData(value, directory, slicer.util.loadVolume, result.setVolume)
-        elif attribute == 'transforms':
-          self._loadResultFileData(value, directory, slicer.util.loadTransform, result.setTransform)
-        elif attribute == 'targets':
-          approved = value.pop('approved', None)
-          original = value.pop('original', None)
-          self._loadResultFileData(value, directory, slicer.util.loadMarkupsFiducialList, result.setTargets)
-          if approved:
-            approvedTargets = self._loadOrGetFileData(directory, approved["fileName"], slicer.util.loadMarkupsFiducialList)
-            setattr(result.targets, 'approved', approvedTargets)
-            result.targets.modifiedTargets[jsonResult["status"]["registrationType"]] = approved["userModified"]
-          if original:
-            originalTargets = self._loadOrGetFileData(directory, original, slicer.util.loadMarkupsFiducialList)
-            setattr(result.targets, 'original', originalTargets)
-        elif attribute == 'labels':
-          self._loadResultFileData(value, directory, slicer.util.loadLabelVolume, result.setLabel)
-        elif attribute == 'status':
-          result.status = value["state"]
-          result.timestamp = value["time"]
-          result.registrationType = value["registrationType"] if value.has_key("registrationType") else None
-          result.consentGivenBy = value["consentGivenBy"] if value.has_key("consentGivenBy") else None
-        elif attribute == 'series':
-          result.receivedTime = value['receivedTime']
-          seriesType = value["type"] if value.has_key("type") else None
-          self.seriesTypeManager.assign(name, seriesType)
-        elif attribute == 'registration':
-          result.startTime = value['startTime']
-          result.endTime = value['endTime']
-        elif attribute == 'segmentation':
-          result.segmentationData = SegmentationData.createFromJSON(value)
-        else:
-          setattr(result, attribute, value)
-        self.customProgressBar.text = "Finished loading registration results"
-
-  def _loadResultFileData(self, dictionary, directory, loadFunction, setFunction):
-    for regType, filename in dictionary.iteritems():
-      data = self._loadOrGetFileData(directory, filename, loadFunction)
-      setFunction(regType, data)
+      self.customProgressBar.updateStatus("Loading series registration result %s" % jsonResult["name"], index)
+      self.loadResult(jsonResult, directory)
+
+  def loadResult(self, jsonResult, directory):
+    name = jsonResult["name"]
+    logging.debug("processing %s" % name)
+    result = self.createResult(name, invokeEvent=False)
+
+    for attribute, value in jsonResult.iteritems():
+      logging.debug("found %s: %s" % (attribute, value))
+      if attribute == 'volumes':
+        self._loadResultFileData(value, directory, slicer.util.loadVolume, result.volumes,
+                                 ContentAddressedStore.getReference("results", name, attribute))
+      elif attribute == 'transforms':
+        self._loadResultFileData(value, directory, slicer.util.loadTransform, result.transforms)
+      elif attribute == 'targets':
+        approved = value.pop('approved', None)
+        if approved:
+          value['approved'] = approved["fileName"]
+          result.targets.modifiedTargets[jsonResult["status"]["registrationType"]] = approved["userModified"]
+        self._loadResultFileData(value, directory, slicer.util.loadMarkupsFiducialList, result.targets)
+      elif attribute == 'labels':
+        self._loadResultFileData(value, directory, slicer.util.loadLabelVolume, result.labels,
+                                 ContentAddressedStore.getReference("results", name, attribute))
+      elif attribute == 'status':
+        result.status = value["state"]
+        result.timestamp = value["time"]
+        result.registrationType = value["registrationType"] if value.has_key("registrationType") else None
+        result.consentGivenBy = value["consentGivenBy"] if value.has_key("consentGivenBy") else None
+      elif attribute == 'series':
+        result.receivedTime = value['receivedTime']
+        seriesType = value["type"] if value.has_key("type") else None
+        self.seriesTypeManager.assign(name, seriesType)
+      elif attribute == 'registration':
+        result.startTime = value['startTime']
+        result.endTime = value['endTime']
+        result.truncated = value.get('truncated', False)
+      elif attribute == 'segmentation':
+        result.segmentationData = SegmentationData.createFromJSON(value)
+      else:
+        setattr(result, attribute, value)
+      self.customProgressBar.text = "Finished loading registration results"
+
+  def _getInitialAndZFrameFiles(self, data):
+    files = []
+    if "initialTargets" in data.keys():
+      files.append((data["initialTargets"], slicer.util.loadMarkupsFiducialList))
+    if "initialVolume" in data.keys():
+      files.append((data["initialVolume"], slicer.util.loadVolume))
+    if "zFrameRegistration" in data.keys():
+      files.append((data["zFrameRegistration"]["volume"], slicer.util.loadVolume))
+      files.append((data["zFrameRegistration"]["transform"], slicer.util.loadTransform))
+    return files
+
+  def loadFiles(self, directory, files):
+    """ loads the given (filename, loadFunction) tuples in parallel unless they have been loaded already """
+    files = [(filename, loadFunction) for filename, loadFunction in files
+             if filename and filename not in self.alreadyLoadedFileNames]
+    if not files:
+      return
+    if self.container:
+      for filename, loadFunction in files:
+        self._loadOrGetFileData(directory, filename, loadFunction)
+      return
+    numberOfThreads = int(self.getSetting("File_Loading_Threads", moduleName=SliceTrackerConstants.MODULE_NAME) or 1)
+    nodes = ParallelFileLoader(numberOfThreads).load([(os.path.join(directory, filename), loadFunction)
+                                                       for filename, loadFunction in files])
+    for filename, _ in files:
+      self._registerLoadedNode(directory, filename, nodes.get(os.path.join(directory, filename)))
+
+  def _registerLoadedNode(self, directory, filename, node):
+    self.alreadyLoadedFileNames[filename] = node
+    if not node:
+      return
+    if ContentAddressedStore.isBlobFileName(filename):
+      ContentAddressedStore().registerLoadedNode(node, filename, directory)
+    NodeDirtyTracker().markNodeSaved(node, os.path.join(directory, filename))
 
-  def _loadOrGetFileData(self, directory, filename, loadFunction):
+  def _loadResultFileData(self, dictionary, directory, loadFunction, registrationData, reference=None):
+    for regType, filename in dictionary.iteritems():
+      if not filename:
+        setattr(registrationData, regType, None)
+        continue
+      self._loadFunctions[filename] = loadFunction
+      name = self._getBlobName(ContentAddressedStore.getReference(reference, regType), filename) if reference else None
+      registrationData.setLazy(regType, filename,
+                               lambda f=filename, n=name: self._loadOrGetFileData(directory, f, loadFunction, n),
+                               nodeName=name)
+
+  def _getBlobName(self, reference, filename):
+    if not ContentAddressedStore.isBlobFileName(filename):
+      return None
+    return ContentAddressedStore().getName(reference, filename)
+
+  def getNumberOfPendingFiles(self):
+    return sum(len(data.getPendingFileNames()) for result in self.registrationResults.values()
+               for data in [result.volumes, result.transforms, result.targets, result.labels])
+
+  def preloadDataForNextRegistration(self):
+    """ loads the data of the most recent approved results, which the next registration depends on """
+    required = []
+    coverProstate = self.getMostRecentApprovedCoverProstateRegistration()
+    if coverProstate:
+      required += [(coverProstate.volumes, ['fixed', 'moving']), (coverProstate.labels, ['fixed', 'moving']),
+                   (coverProstate.targets, ['original', 'approved'])]
+    mostRecentApproved = self.getMostRecentApprovedResult()
+    if mostRecentApproved:
+      required += [(mostRecentApproved.transforms, ['rigid', mostRecentApproved.registrationType]),
+                   (mostRecentApproved.targets, ['approved'])]
+    mostRecentApprovedGuidance = self._getMostRecentApprovedGuidanceResult()
+    if mostRecentApprovedGuidance:
+      required.append((mostRecentApprovedGuidance.transforms, [mostRecentApprovedGuidance.registrationType]))
+
+    pending = [data.getPendingFileNames() for data, _ in required]
+    files = [(fileNames[name], self._loadFunctions[fileNames[name]])
+             for fileNames, (_, names) in zip(pending, required) for name in names if name in fileNames]
+    if self._directory:
+      self.loadFiles(self._directory, files)
+    for data, names in required:
+      data.load(*[name for name in names if name])
+
+  def _loadOrGetFileData(self, directory, filename, loadFunction, name=None):
+    """ returns the node of filename, loading it if needed. Blobs are named by the given name of their reference """
     if not filename:
       return None
+    if name and (filename, name) in self.alreadyLoadedFileNames:
+      return self.alreadyLoadedFileNames[(filename, name)]
     try:
       data = self.alreadyLoadedFileNames[filename]
     except KeyError:
-      _, data = loadFunction(os.path.join(directory, filename), returnNode=True)
-      self.alreadyLoadedFileNames[filename] = data
+      if self.container:
+        data = self.container.readNode(filename, loadFunction)
+      else:
+        _, data = loadFunction(os.path.join(directory, filename), returnNode=True)
+      self._registerLoadedNode(directory, filename, data)
+    if name and data:
+      data = self._getNamedBlobNode(directory, filename, data, name)
     return data
 
+  def _getNamedBlobNode(self, directory, filename, node, name):
+    """ the first name a blob is referenced with names its loaded node. Other names get a copy of it """
+    if self._blobNodeNames.setdefault(filename, name) == name:
+      node.SetName(name)
+    else:
+      node = self.volumesLogic.CloneVolume(slicer.mrmlScene, node, name)
+    self.alreadyLoadedFileNames[(filename, name)] = node
+    ContentAddressedStore().registerLoadedNode(node, filename, directory)
+    return node
+
   def generateLogfileTimeStampDict(self):
     return {
       "time": self.getTime(),
@@ -229,38 +840,69 @@ class SessionData(ModuleLogicMixin):
   def close(self, outputDir):
     if not self.completed:
       self.closedLogTimeStamps.append(self.generateLogfileTimeStampDict())
-    return self.save(outputDir)
-
-  def save(self, outputDir):
+      self.recordEvent("caseClosed", logfile=self.closedLogTimeStamps[-1])
+    startTime = time.time()
+    success, failedFileNames = self.save(outputDir)
+    failedFileNames += self.flush()
+    self.reportStorage(outputDir, time.time() - startTime)
+    success = success and not len(failedFileNames)
+    if success and self.journal:
+      self.journal.truncate()
+    return success, failedFileNames
+
+  def flush(self):
+    """ waits for pending writes and returns the names of files which failed to be written """
+    tracker = NodeDirtyTracker()
+    if not tracker.writer:
+      return []
+    failedFileNames = tracker.writer.flush()
+    for filename in failedFileNames:
+      tracker.forget(filename)
+      ContentAddressedStore().forget(filename)
+    return failedFileNames
+
+  def reportStorage(self, outputDir, elapsedTime):
+    writer = NodeDirtyTracker().writer
+    if not writer:
+      return
+    statistics = writer.getStatistics(reset=True)
+    size = sum(os.path.getsize(os.path.join(root, fileName)) for root, _, fileNames in os.walk(outputDir)
+               for fileName in fileNames)
+    logging.info("Saved case in %.2fs: %d files (%.1f MB) written in %.2fs. Size on disk: %.1f MB"
+                 % (elapsedTime, statistics["files"], statistics["bytes"] / (1024.0 * 1024.0), statistics["seconds"],
+                    size / (1024.0 * 1024.0)))
+
+  def save(self, outputDir, journaled=False):
+    """ saves all modified data. If journaled, results.json is only rewritten in case there is no journal """
     if not os.path.exists(outputDir):
       self.createDirectory(outputDir)
+    self._configureStorage(outputDir)
 
     successfullySavedFileNames = []
     failedSaveOfFileNames = []
 
-    logFilePath = self.getSlicerErrorLogPath()
-    shutil.copy(logFilePath, os.path.join(outputDir, os.path.basename(logFilePath)))
-    successfullySavedFileNames.append(os.path.join(outputDir, os.path.basename(logFilePath)))
+    successfullySavedFileNames.append(self.mirrorLogFile(self.getSlicerErrorLogPath(), outputDir))
 
     def saveManualSegmentation():
       if self.segmentModelNode:
-        success, name = self.saveNodeData(self.segmentModelNode, outputDir, FileExtension.VTK)
+        success, name = NodeDirtyTracker().saveNodeDataIfModified(self.segmentModelNode, outputDir, FileExtension.VTK)
         self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
 
       if self.inputMarkupNode:
-        success, name = self.saveNodeData(self.inputMarkupNode, outputDir, FileExtension.FCSV)
+        success, name = NodeDirtyTracker().saveNodeDataIfModified(self.inputMarkupNode, outputDir, FileExtension.FCSV)
         self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
 
     def saveInitialTargets():
-      success, name = self.saveNodeData(self.initialTargets, outputDir, FileExtension.FCSV,
-                                        name="Initial_Targets")
+      success, name = NodeDirtyTracker().saveNodeDataIfModified(self.initialTargets, outputDir, FileExtension.FCSV,
+                                                                name="Initial_Targets")
       self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
       return name + FileExtension.FCSV
 
     def saveInitialVolume():
-      success, name = self.saveNodeData(self.initialVolume, outputDir, FileExtension.NRRD)
-      self.handleSaveNodeDataReturn(success, name, successfullySavedFileNames, failedSaveOfFileNames)
-      return name + FileExtension.NRRD
+      success, fileName = ContentAddressedStore().save(self.initialVolume, outputDir,
+                                                       compression=self.getCompression(Compression.APPROVED))
+      self.handleSaveNodeDataReturn(success, fileName, successfullySavedFileNames, failedSaveOfFileNames)
+      return fileName
 
     def createResultsList():
       results = []
@@ -280,6 +922,9 @@ class SessionData(ModuleLogicMixin):
 
     data.update(self.getGITRevisionInformation())
 
+    if self.journal:
+      data["journalSequence"] = self.journal.sequence
+
     def addProcedureEvents():
       procedureEvents = {
         "caseStarted": self.startTime,
@@ -295,7 +940,8 @@ class SessionData(ModuleLogicMixin):
     addProcedureEvents()
 
     if self.zFrameRegistrationResult:
-      data["zFrameRegistration"] = self.zFrameRegistrationResult.save(outputDir)
+      data["zFrameRegistration"] = self.zFrameRegistrationResult.save(outputDir,
+                                                                      self.getCompression(Compression.APPROVED))
 
     if self.initialTargets:
       data["initialTargets"] = saveInitialTargets()
@@ -303,17 +949,43 @@ class SessionData(ModuleLogicMixin):
     if self.initialVolume:
       data["initialVolume"] = saveInitialVolume()
 
+    failedSaveOfFileNames += self.saveRegistrationResults(outputDir)
+
+    data["blobNames"] = self.getBlobNames()
+
+    # written last: the persistence worker replaces results.json only after the data it references
     destinationFile = os.path.join(outputDir, SliceTrackerConstants.JSON_FILENAME)
-    with open(destinationFile, 'w') as outfile:
+    if journaled and self.journal and NodeDirtyTracker().exists(destinationFile):
+      logging.debug("Results are journaled. Skipping rewrite of %s" % destinationFile)
+    elif NodeDirtyTracker().writeFileIfModified(destinationFile, json.dumps(data, indent=2)):
       logging.debug("Writing registration results to %s" % destinationFile)
-      json.dump(data, outfile, indent=2)
-
-    failedSaveOfFileNames += self.saveRegistrationResults(outputDir)
 
     self.printOutput("The following data was successfully saved:\n", successfullySavedFileNames)
     self.printOutput("The following data failed to saved:\n", failedSaveOfFileNames)
     return len(failedSaveOfFileNames) == 0, failedSaveOfFileNames
 
+  def getBlobNames(self):
+    """ returns the node names of all content addressed volumes by reference """
+    blobNames = {}
+    if self.initialVolume:
+      blobNames["initialVolume"] = self.initialVolume.GetName()
+    if self.zFrameRegistrationResult and self.zFrameRegistrationResult.volume:
+      blobNames[ContentAddressedStore.getReference("zFrameRegistration", "volume")] = \
+        self.zFrameRegistrationResult.volume.GetName()
+    for result in self.getResultsAsList():
+      blobNames.update(result.getBlobNames())
+    return blobNames
+
+  def mirrorLogFile(self, logFilePath, outputDir):
+    destination = os.path.join(outputDir, os.path.basename(logFilePath))
+    mirror = self._logFileMirrors.setdefault(destination, LogFileMirror(logFilePath, destination))
+    writer = NodeDirtyTracker().writer
+    if writer:
+      writer.mirrorFile(mirror)
+    else:
+      mirror.update()
+    return destination
+
   def getGITRevisionInformation(self):
     import inspect
     dirname = os.path.dirname(inspect.getfile(self.__class__))
@@ -354,11 +1026,9 @@ class SessionData(ModuleLogicMixin):
     for index, result in enumerate(self.getResultsAsList(), start=1):
       self.customProgressBar.maximum = len(self.registrationResults)
       self.customProgressBar.updateStatus("Saving registration result for series %s" % result.name, index)
-      slicer.app.processEvents()
-      if result not in self._savedRegistrationResults:
-        successfulList, failedList = result.save(outputDir)
-        failedToSave += failedList
-        self._savedRegistrationResults.append(result)
+      compression = self.getCompression(Compression.APPROVED if result.approved else Compression.TEMPORARY)
+      successfulList, failedList = result.save(outputDir, compression)
+      failedToSave += failedList
     self.customProgressBar.text = "Registration data successfully saved" if len(failedToSave) == 0 else "Error/s occurred during saving"
     return failedToSave
 
@@ -385,14 +1055,13 @@ class SessionData(ModuleLogicMixin):
     return self.registrationResults.values()
 
   def getMostRecentApprovedCoverProstateRegistration(self):
-    seriesTypeManager = SeriesTypeManager()
-    for result in self.registrationResults.values():
-      if seriesTypeManager.isCoverProstate(result.name) and result.approved:
+    for result in self.registrationResults.getResultsBySeriesType(SliceTrackerConstants.COVER_PROSTATE):
+      if result.approved:
         return result
     return None
 
   def getLastApprovedRigidTransformation(self):
-    if sum([1 for result in self.registrationResults.values() if result.approved]) == 1:
+    if self.registrationResults.getNumberOfApprovedResults() == 1:
       lastRigidTfm = None
     else:
       lastRigidTfm = self.getMostRecentApprovedResult().transforms.rigid
@@ -403,12 +1072,13 @@ class SessionData(ModuleLogicMixin):
 
   @onExceptionReturnNone
   def getMostRecentApprovedTransform(self):
+    result = self._getMostRecentApprovedGuidanceResult()
+    return result.getTransform(result.registrationType) if result else None
+
+  def _getMostRecentApprovedGuidanceResult(self):
     seriesTypeManager = SeriesTypeManager()
-    results = sorted(self.registrationResults.values(), key=lambda s: s.seriesNumber)
-    for result in reversed(results):
-      if result.approved and not seriesTypeManager.isCoverProstate(result.name):
-        return result.getTransform(result.registrationType)
-    return None
+    return self.registrationResults.getMostRecentApprovedResult(
+      condition=lambda result: not seriesTypeManager.isCoverProstate(result.name))
 
   @onExceptionReturnNone
   def getResult(self, series):
@@ -419,7 +1089,11 @@ class SessionData(ModuleLogicMixin):
     return self.getResultsBySeriesNumber(seriesNumber)
 
   def getResultsBySeriesNumber(self, seriesNumber):
-    return [result for result in self.getResultsAsList() if seriesNumber == result.seriesNumber]
+    return self.registrationResults.getResultsBySeriesNumber(seriesNumber)
+
+  def getNumberOfResultsForSeries(self, series):
+    seriesNumber = RegistrationResult.getSeriesNumberFromString(series)
+    return sum(1 for result in self.getResultsBySeriesNumber(seriesNumber) if series in result.name)
 
   def removeResult(self, series):
     # TODO: is this method ever used?
@@ -433,13 +1107,7 @@ class SessionData(ModuleLogicMixin):
 
   @onExceptionReturnNone
   def getMostRecentApprovedResult(self, priorToSeriesNumber=None):
-    results = sorted(self.registrationResults.values(), key=lambda s: s.seriesNumber)
-    if priorToSeriesNumber:
-      results = [result for result in results if result.seriesNumber < priorToSeriesNumber]
-    for result in reversed(results):
-      if result.approved:
-        return result
-    return None
+    return self.registrationResults.getMostRecentApprovedResult(priorToSeriesNumber)
 
   def getApprovedOrLastResultForSeries(self, series):
     results = self.getResultsBySeries(series)
@@ -450,12 +1118,72 @@ class SessionData(ModuleLogicMixin):
 
 
 class AbstractRegistrationData(ModuleLogicMixin):
+  """ Holds the nodes of a registration result by attribute name
+
+  Attributes can be set lazily with a loader which gets called on first access of the attribute. Collecting file
+  names and saving do not trigger pending loads since their files already exist.
+  """
 
   FILE_EXTENSION = None
+  CONTENT_ADDRESSED = False
 
   def __init__(self):
+    self._lazyLoaders = {}
+    self._lazyNodeNames = {}
+    self._lazyLoadingSuspended = False
     self.initializeMembers()
 
+  def __getattr__(self, name):
+    lazyLoaders = self.__dict__.get('_lazyLoaders')
+    if not lazyLoaders or name not in lazyLoaders:
+      raise AttributeError(name)
+    if self.__dict__.get('_lazyLoadingSuspended'):
+      return None
+    fileName, loader = lazyLoaders.pop(name)
+    logging.debug("Loading %s on first access" % fileName)
+    node = loader()
+    object.__setattr__(self, name, node)
+    return node
+
+  def __setattr__(self, name, value):
+    lazyLoaders = self.__dict__.get('_lazyLoaders')
+    if lazyLoaders:
+      lazyLoaders.pop(name, None)
+    object.__setattr__(self, name, value)
+
+  def setLazy(self, name, fileName, loader, nodeName=None):
+    self.__dict__.pop(name, None)
+    self._lazyLoaders[name] = (fileName, loader)
+    self._lazyNodeNames[name] = nodeName
+
+  def isLoaded(self, name):
+    return name not in self._lazyLoaders
+
+  def load(self, *names):
+    for name in names:
+      getattr(self, name)
+
+  def getPendingFileNames(self):
+    return {name: fileName for name, (fileName, _) in self._lazyLoaders.iteritems()}
+
+  def getNodeNames(self):
+    """ returns the node names by attribute, using the names known from loading for data which is not loaded """
+    names = {name: self._lazyNodeNames.get(name) for name in self._lazyLoaders.keys()}
+    with self.lazyLoadingSuspended():
+      for name, node in self.asDict().iteritems():
+        if node:
+          names[name] = node.GetName()
+    return {name: nodeName for name, nodeName in names.iteritems() if nodeName}
+
+  @contextmanager
+  def lazyLoadingSuspended(self):
+    suspended = self._lazyLoadingSuspended
+    self._lazyLoadingSuspended = True
+    try:
+      yield
+    finally:
+      self._lazyLoadingSuspended = suspended
+
   def initializeMembers(self):
     raise NotImplementedError
 
@@ -469,27 +1197,39 @@ class AbstractRegistrationData(ModuleLogicMixin):
   def getFileName(self, node, withExtension=True):
     if isinstance(node, slicer.vtkMRMLVolumeNode) and node.GetImageData() is None:
       return None
-    return self.replaceUnwantedCharacters(node.GetName()) + self.FILE_EXTENSION if withExtension else ""
+    if self.CONTENT_ADDRESSED:
+      return ContentAddressedStore().getFileName(node, self.FILE_EXTENSION if withExtension else "")
+    name = self.replaceUnwantedCharacters(node.GetName())
+    return name + self.FILE_EXTENSION if withExtension else name
 
   def getFileNameByAttributeName(self, name):
+    if not self.isLoaded(name):
+      return self.getPendingFileNames()[name]
     return self.getFileName(getattr(self, name))
 
   def getAllFileNames(self):
-    fileNames = {}
-    for regType, node in self.asDict().iteritems():
-      if node:
-        fileNames[regType] = self.getFileName(node)
+    fileNames = self.getPendingFileNames()
+    with self.lazyLoadingSuspended():
+      for regType, node in self.asDict().iteritems():
+        if node:
+          fileNames[regType] = self.getFileName(node)
     return fileNames
 
-  def save(self, directory):
+  def save(self, directory, compression=None):
     assert self.FILE_EXTENSION is not None
     savedSuccessfully = []
     failedToSave = []
-    for node in [node for node in self.asList() if node]:
+    with self.lazyLoadingSuspended():
+      nodes = [node for node in self.asList() if node]
+    for node in nodes:
       filename = self.getFileName(node, withExtension=False)
-      if filename:
-        success, name = self.saveNodeData(node, directory, self.FILE_EXTENSION, name=filename)
-        self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
+      if not filename:
+        continue
+      if self.CONTENT_ADDRESSED:
+        success, name = ContentAddressedStore().save(node, directory, self.FILE_EXTENSION, compression)
+      else:
+        success, name = NodeDirtyTracker().saveNodeDataIfModified(node, directory, self.FILE_EXTENSION, name=filename)
+      self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     return savedSuccessfully, failedToSave
 
 
@@ -564,15 +1304,17 @@ class SegmentationData(Serializable, ModuleLogicMixin):
     }
     self._modifiedLabel = label
 
-  def save(self, directory):
+  def save(self, directory, compression=None):
     savedSuccessfully = []
     failedToSave = []
     if self._label:
-      success, name = self.saveNodeData(self._label, directory, self.FILE_EXTENSION)
+      success, name = NodeDirtyTracker().saveNodeDataIfModified(self._label, directory, self.FILE_EXTENSION,
+                                                                compression=compression)
       self.fileName = name + self.FILE_EXTENSION if success else None
       self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     if self._modifiedLabel:
-      success, name = self.saveNodeData(self._modifiedLabel, directory, self.FILE_EXTENSION)
+      success, name = NodeDirtyTracker().saveNodeDataIfModified(self._modifiedLabel, directory, self.FILE_EXTENSION,
+                                                                compression=compression)
       self.userModified["fileName"] = name + self.FILE_EXTENSION if success else None
       self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     return savedSuccessfully, failedToSave
@@ -652,10 +1394,10 @@ class Targets(RegistrationTypeData):
                                         cloneName=approvedTargets.GetName().replace(registrationType, "approved"),
                                         keepDisplayNode=True)
 
-  def save(self, directory):
-    savedSuccessfully, failedToSave = super(Targets, self).save(directory)
-    if self.approved:
-      success, name = self.saveNodeData(self.approved, directory, self.FILE_EXTENSION)
+  def save(self, directory, compression=None):
+    savedSuccessfully, failedToSave = super(Targets, self).save(directory, compression)
+    if self.isLoaded('approved') and self.approved:
+      success, name = NodeDirtyTracker().saveNodeDataIfModified(self.approved, directory, self.FILE_EXTENSION)
       self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
     return savedSuccessfully, failedToSave
 
@@ -676,6 +1418,7 @@ class Targets(RegistrationTypeData):
 class Volumes(RegistrationTypeData):
 
   FILE_EXTENSION = FileExtension.NRRD
+  CONTENT_ADDRESSED = True
 
   def __init__(self):
     super(Volumes, self).__init__()
@@ -697,6 +1440,7 @@ class Volumes(RegistrationTypeData):
 class Labels(AbstractRegistrationData):
 
   FILE_EXTENSION = FileExtension.NRRD
+  CONTENT_ADDRESSED = True
 
   def __init__(self):
     super(Labels, self).__init__()
@@ -850,6 +1594,7 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
     self.cmdArguments = ""
     self.suffix = ""
     self.score = None
+    self.truncated = False
 
     self.modifiedTargets = {}
 
@@ -893,13 +1638,10 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
     logging.debug('# __________________________________________________________________________________')
 
   @logmethod(logging.DEBUG)
-  def save(self, outputDir):
+  def save(self, outputDir, compression=None):
     def saveCMDParameters():
       if self.cmdArguments != "":
-        filename = os.path.join(outputDir, self.cmdFileName)
-        f = open(filename, 'w+')
-        f.write(self.cmdArguments)
-        f.close()
+        NodeDirtyTracker().writeFileIfModified(os.path.join(outputDir, self.cmdFileName), self.cmdArguments)
 
     def saveData():
       savedSuccessfully = []
@@ -907,7 +1649,7 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
       for data in [self.transforms, self.targets, self.volumes, self.labels, self.segmentationData]:
         if not data:
           continue
-        successful, failed = data.save(outputDir)
+        successful, failed = data.save(outputDir, compression=compression)
         savedSuccessfully += successful
         failedToSave += failed
       logging.debug("Successfully saved: %s \n" % str(savedSuccessfully))
@@ -924,6 +1666,14 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
       modified = [False for i in range(self.targets.approved.GetNumberOfFiducials())]
     return modified
 
+  def getBlobNames(self):
+    """ returns the node names of the content addressed volumes and labels of this result by reference """
+    blobNames = {}
+    for attribute, data in [("volumes", self.volumes), ("labels", self.labels)]:
+      for name, nodeName in data.getNodeNames().iteritems():
+        blobNames[ContentAddressedStore.getReference("results", self.name, attribute, name)] = nodeName
+    return blobNames
+
   def asDict(self):
     seriesTypeManager = SeriesTypeManager()
     dictionary = super(RegistrationResult, self).asDict()
@@ -945,11 +1695,13 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
           "startTime": self.startTime,
           "endTime": self.endTime
         }
+        if self.truncated:
+          dictionary["registration"]["truncated"] = True
       if self.approved:
         dictionary["status"]["registrationType"] = self.registrationType
     elif self.skipped:
       dictionary["volumes"] = {
-        "fixed": self.volumes.getFileName(self.volumes.fixed)
+        "fixed": self.volumes.getFileNameByAttributeName("fixed")
       }
     if self.score:
       dictionary["score"] = self.score
@@ -965,12 +1717,22 @@ class RegistrationResult(RegistrationResultBase, RegistrationStatus):
 
 class ZFrameRegistrationResult(RegistrationResultBase):
 
+  @property
+  def volume(self):
+    self._volume = getattr(self, "_volume", None)
+    return self._volume
+
+  @volume.setter
+  def volume(self, volume):
+    self._volume = volume
+    ContentAddressedStore().prefetchContentHashes([volume])
+
   def __init__(self, series):
     RegistrationResultBase.__init__(self, series)
     self.volume = None
     self.transform = None
 
-  def save(self, outputDir):
+  def save(self, outputDir, compression=None):
     seriesTypeManager = SeriesTypeManager()
     dictionary = {
       "name": self.name,
@@ -978,10 +1740,10 @@ class ZFrameRegistrationResult(RegistrationResultBase):
     }
     savedSuccessfully = []
     failedToSave = []
-    success, name = self.saveNodeData(self.transform, outputDir, FileExtension.H5)
+    success, name = NodeDirtyTracker().saveNodeDataIfModified(self.transform, outputDir, FileExtension.H5)
     dictionary["transform"] = name + FileExtension.H5
     self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
-    success, name = self.saveNodeData(self.volume, outputDir, FileExtension.NRRD)
-    dictionary["volume"] = name + FileExtension.NRRD
-    self.handleSaveNodeDataReturn(success, name, savedSuccessfully, failedToSave)
+    success, fileName = ContentAddressedStore().save(self.volume, outputDir, compression=compression)
+    dictionary["volume"] = fileName
+    self.handleSaveNodeDataReturn(success, fileName, savedSuccessfully, failedToSave)
     return dictionary
\ No newline at end of file
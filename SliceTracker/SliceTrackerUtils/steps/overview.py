@@ -1,4 +1,5 @@
 import ast
+import bisect
 import ctk
 import qt
 import slicer
@@ -11,7 +12,9 @@ from plugins.targets import SliceTrackerTargetTablePlugin
 from plugins.training import SliceTrackerTrainingPlugin
 from plugins.charts import SliceTrackerDisplacementChartPlugin
 from ..constants import SliceTrackerConstants as constants
+from ..configuration import SliceTrackerSettings
 from ..sessionData import RegistrationResult
+from ..jobs import Job
 from ..helpers import IncomingDataMessageBox, SeriesTypeToolButton, SeriesTypeManager
 
 from SlicerDevelopmentToolboxUtils.constants import COLOR
@@ -24,7 +27,8 @@ class SliceTrackerOverViewStepLogic(SliceTrackerLogicBase):
   def __init__(self):
     super(SliceTrackerOverViewStepLogic, self).__init__()
 
-  def applyBiasCorrection(self):
+  def applyBiasCorrection(self, callback=None):
+    """ runs the bias correction in the background and replaces the initial volume once it completed """
     outputVolume = slicer.vtkMRMLScalarVolumeNode()
     outputVolume.SetName('VOLUME-PREOP-N4')
     slicer.mrmlScene.AddNode(outputVolume)
@@ -33,9 +37,17 @@ class SliceTrackerOverViewStepLogic(SliceTrackerLogicBase):
               'outputImageName': outputVolume.GetID(),
               'numberOfIterations': '500,400,300'}
 
-    slicer.cli.run(slicer.modules.n4itkbiasfieldcorrection, None, params, wait_for_completion=True)
-    self.session.data.initialVolume = outputVolume
-    self.session.data.preopData.usedERC = True
+    def onFinished(job):
+      if job.state == Job.COMPLETED:
+        self.session.data.initialVolume = outputVolume
+        self.session.data.preopData.usedERC = True
+      elif outputVolume.GetScene():
+        slicer.mrmlScene.RemoveNode(outputVolume)
+      if callback:
+        callback(job)
+
+    return self.session.scheduler.submitCLI("Bias correction", slicer.modules.n4itkbiasfieldcorrection, params,
+                                            priority=Job.BIAS_CORRECTION, callback=onFinished)
 
 
 class SliceTrackerOverviewStep(SliceTrackerStep):
@@ -50,6 +62,8 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
 
   def cleanup(self):
     self._seriesModel.clear()
+    self._series = []
+    self._seriesNumbers = []
     self.notifyUserAboutNewData = True
     self.changeSeriesTypeButton.enabled = False
     self.trackTargetsButton.enabled = False
@@ -122,6 +136,8 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
     self.intraopSeriesSelector = qt.QComboBox()
     self.intraopSeriesSelector.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Minimum)
     self._seriesModel = qt.QStandardItemModel()
+    self._series = []
+    self._seriesNumbers = []
     self.intraopSeriesSelector.setModel(self._seriesModel)
     self.intraopSeriesSelector.setToolTip(constants.IntraopSeriesSelectorToolTip)
 
@@ -135,18 +151,22 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
     super(SliceTrackerOverviewStep, self).addSessionObservers()
     self.session.addEventObserver(self.session.SeriesTypeManuallyAssignedEvent, self.onSeriesTypeManuallyAssigned)
     self.session.addEventObserver(self.session.RegistrationStatusChangedEvent, self.onRegistrationStatusChanged)
+    self.session.addEventObserver(self.session.SeriesStatusChangedEvent, self.onSeriesStatusChanged)
+    self.session.addEventObserver(self.session.SeriesTypeChangedEvent, self.onSeriesTypeChanged)
     self.session.addEventObserver(self.session.ZFrameRegistrationSuccessfulEvent, self.onZFrameRegistrationSuccessful)
 
   def removeSessionEventObservers(self):
     SliceTrackerStep.removeSessionEventObservers(self)
     self.session.removeEventObserver(self.session.SeriesTypeManuallyAssignedEvent, self.onSeriesTypeManuallyAssigned)
     self.session.removeEventObserver(self.session.RegistrationStatusChangedEvent, self.onRegistrationStatusChanged)
+    self.session.removeEventObserver(self.session.SeriesStatusChangedEvent, self.onSeriesStatusChanged)
+    self.session.removeEventObserver(self.session.SeriesTypeChangedEvent, self.onSeriesTypeChanged)
     self.session.removeEventObserver(self.session.ZFrameRegistrationSuccessfulEvent, self.onZFrameRegistrationSuccessful)
 
   def onSkipIntraopSeriesButtonClicked(self):
     if slicer.util.confirmYesNoDisplay("Do you really want to skip this series?", windowTitle="Skip series?"):
       self.session.skip(self.intraopSeriesSelector.currentText)
-      self.updateIntraopSeriesSelectorTable()
+      self.onSeriesSelectorTableChanged()
 
   def onTrackTargetsButtonClicked(self):
     self.session.takeActionForCurrentSeries()
@@ -212,6 +232,7 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
       self.intraopSeriesSelector.currentIndex = index
 
   def onZFrameRegistrationSuccessful(self, caller, event):
+    self.updateSeriesColors([series for series in self._series if self.session.seriesTypeManager.isCoverTemplate(series)])
     self.active = True
 
   def onRegistrationStatusChanged(self, caller, event):
@@ -235,14 +256,26 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
     self.configureRedSliceNodeForPreopData()
     self.promptUserAndApplyBiasCorrectionIfNeeded()
     if not self.session.isBusy():
-      self.session.save()
+      self.session.scheduleSave(journaled=False)
 
   def onActivation(self):
     super(SliceTrackerOverviewStep, self).onActivation()
     self.updateIntraopSeriesSelectorTable()
 
-  def onSeriesTypeManuallyAssigned(self, caller, event):
-    self.updateIntraopSeriesSelectorTable()
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSeriesTypeManuallyAssigned(self, caller, event, callData):
+    self.updateSeriesColors([callData])
+    self.onSeriesSelectorTableChanged()
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSeriesStatusChanged(self, caller, event, callData):
+    self.updateSeriesColors([callData])
+    self.updateSeriesSelectorStyle()
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSeriesTypeChanged(self, caller, event, callData):
+    self.updateSeriesColors([callData])
+    self.onSeriesSelectorTableChanged()
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def onNewImageSeriesReceived(self, caller, event, callData):
@@ -286,38 +319,76 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
         self.onTrackTargetsButtonClicked()
 
   def updateIntraopSeriesSelectorTable(self):
+    """ inserts new series at their sorted position and removes deleted ones. Other rows remain untouched. """
     self.intraopSeriesSelector.blockSignals(True)
-    currentIndex = self.intraopSeriesSelector.currentIndex
-    self._seriesModel.clear()
-    for series in self.session.seriesList:
-      sItem = qt.QStandardItem(series)
-      self._seriesModel.appendRow(sItem)
-      color = COLOR.YELLOW
-      if self.session.data.registrationResultWasApproved(series) or \
-        (self.session.seriesTypeManager.isCoverTemplate(series) and not self.session.isCoverTemplateTrackable(series)):
-        color = COLOR.GREEN
-      elif self.session.data.registrationResultWasSkipped(series):
-        color = COLOR.RED
-      elif self.session.data.registrationResultWasRejected(series):
-        color = COLOR.GRAY
-      self._seriesModel.setData(sItem.index(), color, qt.Qt.BackgroundRole)
-    self.intraopSeriesSelector.setCurrentIndex(currentIndex)
+    currentSeries = self.intraopSeriesSelector.currentText if self.intraopSeriesSelector.currentIndex != -1 else None
+    seriesList = self.session.seriesList
+    existingSeries = set(seriesList)
+    for row in reversed(range(len(self._series))):
+      if self._series[row] not in existingSeries:
+        self._removeSeries(row)
+    modelSeries = set(self._series)
+    for series in seriesList:
+      if series not in modelSeries:
+        self._insertSeries(series)
+    self.intraopSeriesSelector.setCurrentIndex(self._series.index(currentSeries) if currentSeries in modelSeries else -1)
     self.intraopSeriesSelector.blockSignals(False)
-    colorStyle = self.session.getColorForSelectedSeries(self.intraopSeriesSelector.currentText)
-    self.intraopSeriesSelector.setStyleSheet("QComboBox{%s} QToolTip{background-color: white;}" % colorStyle)
+    self.onSeriesSelectorTableChanged()
+
+  def onSeriesSelectorTableChanged(self):
+    self.updateSeriesSelectorStyle()
     if self.active and not self.session.isBusy():
       self.selectMostRecentEligibleSeries()
 
+  def updateSeriesSelectorStyle(self):
+    colorStyle = self.session.getColorForSelectedSeries(self.intraopSeriesSelector.currentText)
+    self.intraopSeriesSelector.setStyleSheet("QComboBox{%s} QToolTip{background-color: white;}" % colorStyle)
+
+  def _insertSeries(self, series):
+    seriesNumber = RegistrationResult.getSeriesNumberFromString(series)
+    row = bisect.bisect_right(self._seriesNumbers, seriesNumber)
+    self._series.insert(row, series)
+    self._seriesNumbers.insert(row, seriesNumber)
+    self._seriesModel.insertRow(row, qt.QStandardItem(series))
+    self._updateSeriesColor(row)
+
+  def _removeSeries(self, row):
+    self._seriesModel.removeRow(row)
+    del self._series[row]
+    del self._seriesNumbers[row]
+
+  def updateSeriesColors(self, seriesList):
+    for series in seriesList:
+      seriesNumber = RegistrationResult.getSeriesNumberFromString(series)
+      for row in range(bisect.bisect_left(self._seriesNumbers, seriesNumber),
+                       bisect.bisect_right(self._seriesNumbers, seriesNumber)):
+        self._updateSeriesColor(row)
+
+  def _updateSeriesColor(self, row):
+    self._seriesModel.setData(self._seriesModel.index(row, 0), self._getSeriesColor(self._series[row]),
+                              qt.Qt.BackgroundRole)
+
+  def _getSeriesColor(self, series):
+    if self.session.data.registrationResultWasApproved(series) or \
+      (self.session.seriesTypeManager.isCoverTemplate(series) and not self.session.isCoverTemplateTrackable(series)):
+      return COLOR.GREEN
+    elif self.session.data.registrationResultWasSkipped(series):
+      return COLOR.RED
+    elif self.session.data.registrationResultWasRejected(series):
+      return COLOR.GRAY
+    return COLOR.YELLOW
+
   def selectMostRecentEligibleSeries(self):
-    substring = self.getSetting("NEEDLE_IMAGE_PATTERN")
+    settings = SliceTrackerSettings().snapshot
+    substring = settings.needleImagePattern
     seriesTypeManager = SeriesTypeManager()
     self.intraopSeriesSelector.blockSignals(True)
     self.intraopSeriesSelector.setCurrentIndex(-1)
     self.intraopSeriesSelector.blockSignals(False)
     index = -1
     if not self.session.data.getMostRecentApprovedCoverProstateRegistration():
-      substring = self.getSetting("COVER_TEMPLATE_PATTERN") \
-        if not self.session.zFrameRegistrationSuccessful else self.getSetting("COVER_PROSTATE_PATTERN")
+      substring = settings.coverTemplatePattern \
+        if not self.session.zFrameRegistrationSuccessful else settings.coverProstatePattern
     for item in list(reversed(range(len(self.session.seriesList)))):
       series = self._seriesModel.item(item).text()
       if substring in seriesTypeManager.getSeriesType(series):
@@ -353,19 +424,21 @@ class SliceTrackerOverviewStep(SliceTrackerStep):
     if usedERC:
       customProgressbar = CustomStatusProgressbar()
       customProgressbar.busy = True
-      currentModule = slicer.util.getModuleGui(self.MODULE_NAME)
-      if currentModule:
-        currentModule.parent().enabled = False
+      customProgressbar.updateStatus("Bias correction running in the background")
       try:
-        customProgressbar.updateStatus("Bias correction running!")
-        slicer.app.processEvents()
-        self.logic.applyBiasCorrection()
+        self.logic.applyBiasCorrection(callback=self.onBiasCorrectionFinished)
       except AttributeError:
-        pass
-      finally:
         customProgressbar.busy = False
-        if currentModule:
-          currentModule.parent().enabled = True
-      customProgressbar.updateStatus("Bias correction done!")
 
-    self.session.data.preopData.usedERC = usedERC
\ No newline at end of file
+    self.session.data.preopData.usedERC = usedERC
+
+  def onBiasCorrectionFinished(self, job):
+    customProgressbar = CustomStatusProgressbar()
+    customProgressbar.busy = False
+    if job.state == Job.COMPLETED:
+      customProgressbar.updateStatus("Bias correction done!")
+      self.configureRedSliceNodeForPreopData()
+      if not self.session.isBusy():
+        self.session.scheduleSave(journaled=False)
+    elif job.state == Job.FAILED:
+      customProgressbar.updateStatus("Bias correction failed!")
\ No newline at end of file
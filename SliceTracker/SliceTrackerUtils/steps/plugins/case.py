@@ -59,6 +59,8 @@ class SliceTrackerCaseManagerPlugin(SliceTrackerPlugin):
     self.openCaseButton = self.createButton("", icon=Icons.open, iconSize=iconSize, toolTip="Open case")
     self.closeCaseButton = self.createButton("", icon=Icons.exit, iconSize=iconSize,
                                              toolTip="Close case with resume support", enabled=False)
+    self.exportCaseButton = self.createButton("", icon=Icons.save, iconSize=iconSize,
+                                              toolTip="Export case as directory", enabled=False)
     self.setupCaseWatchBox()
     self.casesRootDirectoryButton = self.createDirectoryButton(text="Choose cases root location",
                                                                caption="Choose cases root location",
@@ -75,7 +77,7 @@ class SliceTrackerCaseManagerPlugin(SliceTrackerPlugin):
     self.caseGroupBox = qt.QGroupBox("Case")
     self.caseGroupBoxLayout = qt.QFormLayout(self.caseGroupBox)
     self.caseGroupBoxLayout.addWidget(self.createHLayout([self.createNewCaseButton, self.openCaseButton,
-                                                          self.closeCaseButton]))
+                                                          self.closeCaseButton, self.exportCaseButton]))
     self.caseGroupBoxLayout.addWidget(self.caseDirectoryInformationArea)
     self.layout().addWidget(self.caseGroupBox)
 
@@ -90,6 +92,7 @@ class SliceTrackerCaseManagerPlugin(SliceTrackerPlugin):
     self.createNewCaseButton.clicked.connect(self.onCreateNewCaseButtonClicked)
     self.openCaseButton.clicked.connect(self.onOpenCaseButtonClicked)
     self.closeCaseButton.clicked.connect(self.onCloseCaseButtonClicked)
+    self.exportCaseButton.clicked.connect(self.onExportCaseButtonClicked)
     self.casesRootDirectoryButton.directoryChanged.connect(lambda: setattr(self, "caseRootDir",
                                                                            self.casesRootDirectoryButton.directory))
 
@@ -117,6 +120,17 @@ class SliceTrackerCaseManagerPlugin(SliceTrackerPlugin):
     if self.session.isRunning():
       self.session.close(save=False)
 
+  def onExportCaseButtonClicked(self):
+    destination = qt.QFileDialog.getExistingDirectory(self.parent().window(), "Select Export Directory",
+                                                      self.caseRootDir)
+    if not destination:
+      return
+    try:
+      self.session.exportCase(destination)
+      slicer.util.infoDisplay("Case has been exported to %s" % destination)
+    except (IOError, OSError, ValueError) as exc:
+      slicer.util.errorDisplay("Case export failed: %s" % str(exc))
+
   def onNewCaseStarted(self, caller, event):
     self.update()
 
@@ -152,6 +166,7 @@ class SliceTrackerCaseManagerPlugin(SliceTrackerPlugin):
 
   def updateCaseButtons(self):
     self.closeCaseButton.enabled = self.session.directory is not None
+    self.exportCaseButton.enabled = self.session.isRunning() and self.session.isStoredInContainer()
 
   def checkAndWarnUserIfCaseInProgress(self):
     if self.session.isRunning():
@@ -2,8 +2,11 @@ import vtk
 import qt
 import ctk
 import ast
+import colorsys
+import numpy
 import slicer
 import logging
+from vtk.util import numpy_support
 
 from ..base import SliceTrackerPlugin, SliceTrackerLogicBase, SliceTrackerStep
 from ...session import SliceTrackerSession
@@ -13,19 +16,129 @@ from ...constants import SliceTrackerConstants as constants
 from SlicerDevelopmentToolboxUtils.decorators import onModuleSelected
 
 
+class TargetDisplacementMatrix(object):
+  """ Approved target positions of the approved results (results x targets x xyz) sorted by series number
+
+  Positions of a result are read once and kept until its approved targets get replaced or one of their points gets
+  added, removed or moved. The stacked positions are only rebuilt when approved results were added, removed or changed.
+  Targets missing in a result are NaN.
+  """
+
+  TARGET_EVENTS = ["PointAddedEvent", "PointRemovedEvent", "PointModifiedEvent"]
+
+  @property
+  def numberOfTargets(self):
+    return self.positions.shape[1]
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    for name in list(getattr(self, "_resultPositions", {})):
+      self._removeResult(name)
+    self._resultPositions = {}
+    self._modifiedResults = set()
+    self._names = []
+    self.seriesNumbers = []
+    self.positions = numpy.zeros((0, 0, 3))
+
+  @staticmethod
+  def getTargetPositions(targets):
+    positions = numpy.zeros((targets.GetNumberOfFiducials(), 3))
+    position = [0.0, 0.0, 0.0]
+    for index in range(len(positions)):
+      targets.GetNthFiducialPosition(index, position)
+      positions[index] = position
+    return positions
+
+  def update(self, approvedResults):
+    """ returns True if the positions changed """
+    names = [result.name for result in approvedResults]
+    changed = names != self._names
+    for name in set(self._resultPositions.keys()) - set(names):
+      self._removeResult(name)
+    for result in approvedResults:
+      targets = result.targets.approved
+      cached = self._resultPositions.get(result.name)
+      if cached and cached[0] is targets:
+        if result.name not in self._modifiedResults:
+          continue
+        observers = cached[1]
+      else:
+        if cached:
+          self._removeResult(result.name)
+        observers = self._observeTargets(result.name, targets)
+      self._modifiedResults.discard(result.name)
+      self._resultPositions[result.name] = (targets, observers, self.getTargetPositions(targets))
+      changed = True
+    if changed:
+      self._names = names
+      self.seriesNumbers = [result.seriesNumber for result in approvedResults]
+      self._stackPositions()
+    return changed
+
+  def _observeTargets(self, name, targets):
+    onTargetsModified = lambda caller, event: self._modifiedResults.add(name)
+    return [targets.AddObserver(getattr(targets, event), onTargetsModified) for event in self.TARGET_EVENTS]
+
+  def _removeResult(self, name):
+    targets, observers, _ = self._resultPositions.pop(name)
+    for observer in observers:
+      targets.RemoveObserver(observer)
+    self._modifiedResults.discard(name)
+
+  def _stackPositions(self):
+    resultPositions = [self._resultPositions[name][2] for name in self._names]
+    numberOfTargets = max([len(positions) for positions in resultPositions] or [0])
+    self.positions = numpy.full((len(resultPositions), numberOfTargets, 3), numpy.nan)
+    for index, positions in enumerate(resultPositions):
+      self.positions[index, :len(positions)] = positions
+
+  def getDisplacements(self, currentPositions=None):
+    """ returns the displacements between consecutive results, with zero displacement for the first result
+
+    currentPositions are appended as positions of a not yet evaluated result
+    """
+    positions = self.positions
+    if currentPositions is not None:
+      numberOfTargets = max(self.numberOfTargets, len(currentPositions))
+      positions = numpy.full((len(self.positions) + 1, numberOfTargets, 3), numpy.nan)
+      positions[:-1, :self.numberOfTargets] = self.positions
+      positions[-1, :len(currentPositions)] = currentPositions
+    displacements = numpy.zeros_like(positions)
+    displacements[1:] = positions[1:] - positions[:-1]
+    return displacements
+
+
 class SliceTrackerDisplacementChartLogic(SliceTrackerLogicBase):
 
   def __init__(self):
     super(SliceTrackerDisplacementChartLogic, self).__init__()
     self.session = SliceTrackerSession()
-
-  def calculateTargetDisplacement(self, prevTargets, currTargets, targetIndex):
-    prevPos = [0.0, 0.0, 0.0]
-    currPos = [0.0, 0.0, 0.0]
-    currTargets.GetNthFiducialPosition(targetIndex, currPos)
-    prevTargets.GetNthFiducialPosition(targetIndex, prevPos)
-    displacement = [currPos[0] - prevPos[0], currPos[1] - prevPos[1], currPos[2] - prevPos[2]]
-    return displacement
+    self.displacementMatrix = TargetDisplacementMatrix()
+    self._sessionData = None
+
+  def updateDisplacementMatrix(self):
+    if self._sessionData is not self.session.data:
+      self._sessionData = self.session.data
+      self.displacementMatrix.reset()
+    return self.displacementMatrix.update(self.session.data.registrationResults.getApprovedResults())
+
+  def getTargetDisplacements(self, currentTargets=None):
+    """ returns the series numbers and displacements (results x targets x xyz) of all approved results
+
+    If the current result was not evaluated yet, currentTargets get appended as its targets
+    """
+    self.updateDisplacementMatrix()
+    seriesNumbers = list(self.displacementMatrix.seriesNumbers)
+    currentPositions = None
+    if not self.session.currentResult.wasEvaluated() and currentTargets:
+      seriesNumbers.append(self.session.currentResult.seriesNumber)
+      currentPositions = TargetDisplacementMatrix.getTargetPositions(currentTargets)
+    coverProstate = self.session.data.getMostRecentApprovedCoverProstateRegistration()
+    if seriesNumbers and coverProstate:
+      seriesNumbers[0] = coverProstate.seriesNumber
+    return seriesNumbers, self.displacementMatrix.getDisplacements(currentPositions)
 
   def isTargetDisplacementChartDisplayable(self, selectedSeries):
     if not selectedSeries or not (self.session.seriesTypeManager.isCoverProstate(selectedSeries) or
@@ -33,8 +146,7 @@ class SliceTrackerDisplacementChartLogic(SliceTrackerLogicBase):
                                   self.session.data.registrationResultWasRejected(selectedSeries):
       return False
     selectedSeriesNumber = RegistrationResult.getSeriesNumberFromString(selectedSeries)
-    approvedResults = sorted([r for r in self.session.data.registrationResults.values() if r.approved],
-                             key=lambda result: result.seriesNumber)
+    approvedResults = self.session.data.registrationResults.getApprovedResults()
     nonSelectedApprovedResults = filter(lambda x: x.seriesNumber != selectedSeriesNumber, approvedResults)
     if len(nonSelectedApprovedResults) == 0 or self.session.currentResult is None:
       return False
@@ -54,6 +166,7 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
   PLOT_COLOR_IS = [204/255.0, 121/255.0, 167/255.0]
   PLOT_COLOR_3D = [0, 0, 0]
   PLOT_NAMES = ["L/R Displacement", "P/A Displacement", "I/S Displacement", "3-D Distance"]
+  COLUMN_NAMES = ["L/R Displ", "P/A Displ", "I/S Displ", "3-D Dis"]
 
   @property
   def plotWidgetViewNode(self):
@@ -68,10 +181,6 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
   def onMrmlSceneCleared(self, caller=None, event=None, callData=None):
     self.resetAndInitializeData()
 
-  def resetChart(self):
-    for arr in [self.arrX, self.arrXD, self.arrYD, self.arrZD, self.arrD]:
-      arr.Initialize()
-
   def setup(self):
     super(SliceTrackerDisplacementChartPlugin, self).setup()
 
@@ -84,8 +193,10 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
 
     self.showLegendCheckBox = qt.QCheckBox('Show legend')
     self.showLegendCheckBox.setChecked(1)
+    self.showAllTargetsCheckBox = qt.QCheckBox('Show all targets')
 
     self.collapsibleButton.layout().addWidget(self.showLegendCheckBox, 0, 0)
+    self.collapsibleButton.layout().addWidget(self.showAllTargetsCheckBox, 0, 1)
     self.layout().addWidget(self.collapsibleButton)
 
   def resetAndInitializeData(self):
@@ -93,6 +204,11 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
     self._plotWidget = None
     self._plotViewNode = None
     self._plotSeriesNodes = []
+    self._targetPlotSeriesNodes = []
+    self._seriesNumbers = None
+    self._displacements = None
+    self.targetIndex = -1
+    self.currResultTargets = None
 
     self._initializeChartTable()
     self._initializePlotChartNode()
@@ -107,18 +223,6 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
     self._plotChartNode.SetXAxisTitle('Series Number')
     self._plotChartNode.SetYAxisTitle('Displacement')
 
-    def createFloatArray(name):
-      floatArray = vtk.vtkFloatArray()
-      floatArray.SetName(name)
-      self._chartTable.AddColumn(floatArray)
-      return floatArray
-
-    self.arrX = createFloatArray('X Axis')
-    self.arrXD = createFloatArray('L/R Displ')
-    self.arrYD = createFloatArray('P/A Displ')
-    self.arrZD = createFloatArray('I/S Displ')
-    self.arrD = createFloatArray('3-D Dis')
-
   def _initializePlotView(self):
     if self._plotView:
       self.collapsibleButton.layout().removeWidget(self._plotView)
@@ -145,13 +249,9 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
     self._plotView.setMRMLPlotViewNode(self._plotViewNode)
     self._plotViewNode.SetPlotChartNodeID(self._plotChartNode.GetID())
 
-  def _initializeChart(self, coverProstateSeriesNumber):
-    self.arrX.InsertNextValue(coverProstateSeriesNumber)
-    for arr in [self.arrXD, self.arrYD, self.arrZD, self.arrD]:
-      arr.InsertNextValue(0)
-
   def setupConnections(self):
     self.showLegendCheckBox.connect('stateChanged(int)', self.onShowLegendChanged)
+    self.showAllTargetsCheckBox.connect('toggled(bool)', self.onShowAllTargetsToggled)
 
   def onActivation(self):
     super(SliceTrackerDisplacementChartPlugin, self).onActivation()
@@ -169,6 +269,10 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
   def onShowLegendChanged(self, checked):
     self._plotChartNode.SetLegendVisibility(True if checked == 2 else False)
 
+  def onShowAllTargetsToggled(self, checked):
+    if self._displacements is not None:
+      self.updatePlotSeries()
+
   def addSessionObservers(self):
     super(SliceTrackerDisplacementChartPlugin, self).addSessionObservers()
     self.session.addEventObserver(self.session.TargetSelectionEvent, self.onTargetSelectionChanged)
@@ -195,53 +299,78 @@ class SliceTrackerDisplacementChartPlugin(SliceTrackerPlugin):
 
   def updateTargetDisplacementChart(self, targetsAvailable):
     if self.logic.isTargetDisplacementChartDisplayable(self.session.currentSeries) and targetsAvailable:
-      self.resetChart()
-      results = sorted([r for r in self.session.data.registrationResults.values() if r.approved],
-                       key=lambda result: result.seriesNumber)
-      if not self.session.currentResult.wasEvaluated():
-        results.append(self.session.currentResult)
-      for currIndex, currResult in enumerate(results[1:], 1):
-        prevTargets = results[currIndex - 1].targets.approved
-        if not self.session.currentResult.wasEvaluated() and currIndex == len(results[1:]):
-          currTargets = self.currResultTargets
-        else:
-          currTargets = currResult.targets.approved
-        displacement = self.logic.calculateTargetDisplacement(prevTargets, currTargets, self.targetIndex)
-        self.invokeEvent(self.ShowEvent)
-        self.addPlotPoints([displacement], currResult.seriesNumber)
+      seriesNumbers, displacements = self.logic.getTargetDisplacements(self.currResultTargets)
+      self.updateChartTable(seriesNumbers, displacements)
+      self.updatePlotSeries()
       self.invokeEvent(self.ShowEvent)
     else:
       self.invokeEvent(self.HideEvent)
 
-  def addPlotPoints(self, displacement, seriesNumber):
-    numCurrentRows = self._chartTable.GetNumberOfRows()
+  def updateChartTable(self, seriesNumbers, displacements):
+    """ writes the displacements of all targets into the chart table, unless they did not change
+
+    The table holds the series numbers and the L/R, P/A, I/S and 3-D columns of every target, so that changing the
+    selected target only changes the columns the plot series nodes point to.
+    """
+    if self._displacements is not None and self._seriesNumbers == seriesNumbers and \
+       self._displacements.shape == displacements.shape and \
+       numpy.allclose(self._displacements, displacements, equal_nan=True):
+      return
+    self._chartTable.GetTable().Initialize()
+    self._addChartTableColumn('X Axis', numpy.array(seriesNumbers))
+    distances = numpy.sqrt((displacements ** 2).sum(axis=2))
+    for targetIndex in range(displacements.shape[1]):
+      for component in range(3):
+        self._addChartTableColumn(self.getColumnName(targetIndex, component), displacements[:, targetIndex, component])
+      self._addChartTableColumn(self.getColumnName(targetIndex, 3), distances[:, targetIndex])
+    self._chartTable.Modified()
+    self._seriesNumbers = seriesNumbers
+    self._displacements = displacements
+
+  def _addChartTableColumn(self, name, values):
+    floatArray = numpy_support.numpy_to_vtk(values.astype(numpy.float32), deep=True)
+    floatArray.SetName(name)
+    self._chartTable.AddColumn(floatArray)
+
+  def getColumnName(self, targetIndex, column):
+    return "%s %d" % (self.COLUMN_NAMES[column], targetIndex + 1)
+
+  def getNumberOfChartedTargets(self):
+    return self._displacements.shape[1] if self._displacements is not None else 0
+
+  def getTargetName(self, targetIndex):
+    if self.currResultTargets and targetIndex < self.currResultTargets.GetNumberOfFiducials():
+      return self.currResultTargets.GetNthFiducialLabel(targetIndex)
+    return "Target %d" % (targetIndex + 1)
+
+  def updatePlotSeries(self):
     self._plotViewNode.SetPlotChartNodeID(self._plotChartNode.GetID())
-
-    for i in range(len(displacement)):
-      if numCurrentRows == 0:
-        self._initializeChart(self.session.data.getMostRecentApprovedCoverProstateRegistration().seriesNumber)
-      self.arrX.InsertNextValue(seriesNumber)
-      for component, arr in enumerate([self.arrXD, self.arrYD, self.arrZD]):
-        arr.InsertNextValue(displacement[i][component])
-      distance = (displacement[i][0] ** 2 + displacement[i][1] ** 2 + displacement[i][2] ** 2) ** 0.5
-      self.arrD.InsertNextValue(distance)
-    if self._plotChartNode.GetNumberOfPlotSeriesNodes() == 0:
-      for index, plot in enumerate([self.PLOT_COLOR_LR, self.PLOT_COLOR_PA, self.PLOT_COLOR_IS, self.PLOT_COLOR_3D], start=1):
-        self.createPlot(plot, index)
-    else:
-      self._plotChartNode.RemoveAllPlotSeriesNodeIDs()
-      for plotSeriesNode in self._plotSeriesNodes:
+    if not self._plotSeriesNodes:
+      for name, color in zip(self.PLOT_NAMES, [self.PLOT_COLOR_LR, self.PLOT_COLOR_PA, self.PLOT_COLOR_IS,
+                                               self.PLOT_COLOR_3D]):
+        self._plotSeriesNodes.append(self.createPlot(name, color))
+    numberOfTargets = self.getNumberOfChartedTargets()
+    while len(self._targetPlotSeriesNodes) < numberOfTargets:
+      hue = (len(self._targetPlotSeriesNodes) * 0.618034) % 1.0
+      self._targetPlotSeriesNodes.append(self.createPlot(self.getTargetName(len(self._targetPlotSeriesNodes)),
+                                                         colorsys.hsv_to_rgb(hue, 0.9, 0.8)))
+    self._plotChartNode.RemoveAllPlotSeriesNodeIDs()
+    if self.showAllTargetsCheckBox.checked:
+      for targetIndex, plotSeriesNode in enumerate(self._targetPlotSeriesNodes[:numberOfTargets]):
+        plotSeriesNode.SetName(self.getTargetName(targetIndex))
+        plotSeriesNode.SetYColumnName(self.getColumnName(targetIndex, 3))
+        self._plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
+    elif 0 <= self.targetIndex < numberOfTargets:
+      for column, plotSeriesNode in enumerate(self._plotSeriesNodes):
+        plotSeriesNode.SetYColumnName(self.getColumnName(self.targetIndex, column))
         self._plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
 
-  def createPlot(self, color, plotNumber):
-    plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", self.PLOT_NAMES[plotNumber - 1])
+  def createPlot(self, name, color):
+    plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", name)
     plotSeriesNode.SetAndObserveTableNodeID(self._chartTable.GetID())
-    plotSeriesNode.SetXColumnName(self._chartTable.GetColumnName(0))
-    plotSeriesNode.SetYColumnName(self._chartTable.GetColumnName(plotNumber))
+    plotSeriesNode.SetXColumnName('X Axis')
     plotSeriesNode.SetColor(color)
     plotSeriesNode.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
     plotSeriesNode.SetMarkerStyle(4)
     plotSeriesNode.SetMarkerSize(3 * plotSeriesNode.GetLineWidth())
-
-    self._plotSeriesNodes.append(plotSeriesNode)
-    self._plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
\ No newline at end of file
+    return plotSeriesNode
\ No newline at end of file
@@ -30,12 +30,17 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
   @targetList.setter
   def targetList(self, targetList):
     self._targetList = targetList
-    if self.currentGuidanceComputation and self.observer:
-      self.self.currentGuidanceComputation.RemoveObserver(self.observer)
+    self.observeTargetLists()
+    self.invalidateRowData()
+    if self.currentGuidanceComputation:
+      self.currentGuidanceComputation.removeEventObserver(vtk.vtkCommand.ModifiedEvent, self.updateHoleAndDepth)
+      self.currentGuidanceComputation.removeEventObserver(ZFrameGuidanceComputation.TargetModifiedEvent,
+                                                          self.onTargetModified)
     self.currentGuidanceComputation = self.getOrCreateNewGuidanceComputation(targetList)
     if self.currentGuidanceComputation:
-      self.observer = self.currentGuidanceComputation.addEventObserver(vtk.vtkCommand.ModifiedEvent,
-                                                                       self.updateHoleAndDepth)
+      self.currentGuidanceComputation.addEventObserver(vtk.vtkCommand.ModifiedEvent, self.updateHoleAndDepth)
+      self.currentGuidanceComputation.addEventObserver(ZFrameGuidanceComputation.TargetModifiedEvent,
+                                                       self.onTargetModified)
     if ModuleWidgetMixin.isQtVersionOlder():
       self.reset()
     else:
@@ -49,7 +54,21 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
 
   @coverProstateTargetList.setter
   def coverProstateTargetList(self, targetList):
+    if self._coverProstateGuidanceComputation:
+      self._coverProstateGuidanceComputation.removeEventObserver(vtk.vtkCommand.ModifiedEvent,
+                                                                 self.onCoverProstateTargetsModified)
+      self._coverProstateGuidanceComputation.removeEventObserver(ZFrameGuidanceComputation.TargetModifiedEvent,
+                                                                 self.onCoverProstateTargetsModified)
+      self._coverProstateGuidanceComputation = None
     self._coverProstateTargetList = targetList
+    if targetList and targetList is not self.targetList:
+      self._coverProstateGuidanceComputation = self.getOrCreateNewGuidanceComputation(targetList)
+      self._coverProstateGuidanceComputation.addEventObserver(vtk.vtkCommand.ModifiedEvent,
+                                                              self.onCoverProstateTargetsModified)
+      self._coverProstateGuidanceComputation.addEventObserver(ZFrameGuidanceComputation.TargetModifiedEvent,
+                                                              self.onCoverProstateTargetsModified)
+    self.observeTargetLists()
+    self.invalidateRowData()
 
   def __init__(self, logic, targets=None, parent=None, *args):
     qt.QAbstractTableModel.__init__(self, parent, *args)
@@ -58,10 +77,13 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
     self._cursorPosition = None
     self._targetList = None
     self._guidanceComputations = []
+    self._coverProstateGuidanceComputation = None
+    self._rowData = {}
+    self._rowDataCount = 0
+    self._targetListObservers = []
     self.currentGuidanceComputation = None
     self.targetList = targets
     self.currentTargetIndex = -1
-    self.observer = None
     self.session.addEventObserver(self.session.ZFrameRegistrationSuccessfulEvent, self.onZFrameRegistrationSuccessful)
 
   def getOrCreateNewGuidanceComputation(self, targetList):
@@ -81,11 +103,84 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
 
   def onZFrameRegistrationSuccessful(self, caller, event):
     self._guidanceComputations = []
+    self.invalidateRowData()
 
   def updateHoleAndDepth(self, caller=None, event=None):
-    self.dataChanged(self.index(0, 3), self.index(self.rowCount() - 1, 4))
+    self.invalidateRowData()
+    self.dataChanged(self.index(0, 0), self.index(self.rowCount() - 1, 2))
     self.invokeEvent(vtk.vtkCommand.ModifiedEvent)
 
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onTargetModified(self, caller, event, callData):
+    row = int(callData)
+    self.invalidateRowData(row)
+    self.dataChanged(self.index(row, 0), self.index(row, 2))
+    self.invokeEvent(vtk.vtkCommand.ModifiedEvent)
+
+  def onCoverProstateTargetsModified(self, caller, event):
+    self.invalidateRowData()
+    self.dataChanged(self.index(0, 1), self.index(self.rowCount() - 1, 2))
+
+  def observeTargetLists(self):
+    """ observes point modifications of the displayed and the cover prostate targets, which invalidate cached rows """
+    for targetList, observer in self._targetListObservers:
+      targetList.RemoveObserver(observer)
+    targetLists = [self._targetList]
+    if self.coverProstateTargetList is not self._targetList:
+      targetLists.append(self.coverProstateTargetList)
+    self._targetListObservers = [(targetList, targetList.AddObserver(targetList.PointModifiedEvent,
+                                                                     self.onTargetListPointModified))
+                                 for targetList in targetLists if targetList]
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onTargetListPointModified(self, caller, event, callData):
+    if callData is None or not 0 <= callData < self.rowCount():
+      self.invalidateRowData()
+      return
+    self.invalidateRowData(callData)
+    self.dataChanged(self.index(callData, 0), self.index(callData, self.columnCount() - 1))
+
+  def invalidateRowData(self, row=None):
+    if row is None:
+      self._rowData = {}
+    else:
+      self._rowData.pop(row, None)
+
+  def getRowData(self, row):
+    """ returns the values derived from the target of the given row. They are cached until the target changes """
+    rowCount = self.rowCount()
+    if rowCount != self._rowDataCount:
+      self._rowData = {}
+      self._rowDataCount = rowCount
+    try:
+      return self._rowData[row]
+    except KeyError:
+      self._rowData[row] = rowData = self.computeRowData(row)
+    return rowData
+
+  def computeRowData(self, row):
+    guidance = self.currentGuidanceComputation
+    rowData = {"name": self.targetList.GetNthFiducialLabel(row),
+               "hole": guidance.getZFrameHole(row),
+               "depth": guidance.getZFrameDepth(row, asString=False),
+               "depthText": guidance.getZFrameDepth(row),
+               "inRange": guidance.getZFrameDepthInRange(row)}
+    rowData["outOfRangeText"] = "" if rowData["inRange"] else "Current depth: out of range"
+    if self.coverProstateTargetList and not self.coverProstateTargetList is self.targetList:
+      coverProstateGuidance = self.getOrCreateNewGuidanceComputation(self.coverProstateTargetList)
+      coverProstateHole = coverProstateGuidance.getZFrameHole(row)
+      coverProstateDepth = coverProstateGuidance.getZFrameDepth(row, asString=False)
+      currentDepth = rowData["depth"]
+      rowData.update({
+        "holeMatches": rowData["hole"] == coverProstateHole,
+        "holeDisplacementText": "{} hole: {}".format(self.PLANNING_IMAGE_NAME, coverProstateHole),
+        "depthMatches": abs(currentDepth - coverProstateDepth) <= max(1e-9 * max(abs(currentDepth),
+                                                                                 abs(coverProstateDepth)), 0.5),
+        "depthDisplacementText": "%s depth: '%.1f' %s" % (self.PLANNING_IMAGE_NAME, coverProstateDepth,
+                                                          "\n" + rowData["outOfRangeText"])
+      })
+    return rowData
+
   def headerData(self, col, orientation, role):
     if orientation == qt.Qt.Horizontal and role in [qt.Qt.DisplayRole, qt.Qt.ToolTipRole]:
         return self.headers[col]
@@ -112,42 +207,36 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
     if not index.isValid() or role not in [qt.Qt.DisplayRole, qt.Qt.ToolTipRole]:
       return None
 
+    rowData = self.getRowData(row)
     if col == 0:
-      return self.targetList.GetNthFiducialLabel(row)
+      return rowData["name"]
     elif col == 1 and self.session.zFrameRegistrationSuccessful:
-      return self.currentGuidanceComputation.getZFrameHole(row)
+      return rowData["hole"]
     elif col == 2 and self.session.zFrameRegistrationSuccessful:
-      return self.currentGuidanceComputation.getZFrameDepth(row)
+      return rowData["depthText"]
     return ""
 
   def getBackgroundOrToolTipData(self, index, role):
     if role not in [qt.Qt.BackgroundRole, qt.Qt.ToolTipRole]:
       return None
     backgroundRequested = role == qt.Qt.BackgroundRole
-    row = index.row()
     col = index.column()
-    outOfRangeText = "" if self.currentGuidanceComputation.getZFrameDepthInRange(row) else "Current depth: out of range"
+    rowData = self.getRowData(index.row())
+    outOfRangeText = rowData["outOfRangeText"]
     if self.coverProstateTargetList and not self.coverProstateTargetList is self.targetList:
-      if col in [1, 2]:
-        coverProstateGuidance = self.getOrCreateNewGuidanceComputation(self.coverProstateTargetList)
-        if col == 1:
-          coverProstateHole = coverProstateGuidance.getZFrameHole(row)
-          if self.currentGuidanceComputation.getZFrameHole(row) == coverProstateHole:
-            return qt.QColor(qt.Qt.green) if backgroundRequested else ""
-          else:
-            return qt.QColor(qt.Qt.red) if backgroundRequested else "{} hole: {}".format(self.PLANNING_IMAGE_NAME,
-                                                                                         coverProstateHole)
-        elif col == 2:
-          currentDepth = self.currentGuidanceComputation.getZFrameDepth(row, asString=False)
-          coverProstateDepth = coverProstateGuidance.getZFrameDepth(row, asString=False)
-          if abs(currentDepth - coverProstateDepth) <= max(1e-9 * max(abs(currentDepth), abs(coverProstateDepth)), 0.5):
-            if backgroundRequested:
-              return qt.QColor(qt.Qt.red) if len(outOfRangeText) else qt.QColor(qt.Qt.green)
-            return "%s depth: '%.1f' %s" % (self.PLANNING_IMAGE_NAME, coverProstateDepth, "\n"+outOfRangeText)
-          else:
-            if backgroundRequested:
-              return qt.QColor(qt.Qt.red)
-            return "%s depth: '%.1f' %s" % (self.PLANNING_IMAGE_NAME, coverProstateDepth, "\n"+outOfRangeText)
+      if col == 1:
+        if rowData["holeMatches"]:
+          return qt.QColor(qt.Qt.green) if backgroundRequested else ""
+        return qt.QColor(qt.Qt.red) if backgroundRequested else rowData["holeDisplacementText"]
+      elif col == 2:
+        if rowData["depthMatches"]:
+          if backgroundRequested:
+            return qt.QColor(qt.Qt.red) if len(outOfRangeText) else qt.QColor(qt.Qt.green)
+          return rowData["depthDisplacementText"]
+        else:
+          if backgroundRequested:
+            return qt.QColor(qt.Qt.red)
+          return rowData["depthDisplacementText"]
     elif self.coverProstateTargetList is self.targetList and col == 3:
       if backgroundRequested and len(outOfRangeText):
         return qt.QColor(qt.Qt.red)
@@ -158,13 +247,15 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
 
 class ZFrameGuidanceComputation(ModuleLogicMixin):
 
-  SUPPORTED_EVENTS = [vtk.vtkCommand.ModifiedEvent]
+  TargetModifiedEvent = vtk.vtkCommand.UserEvent + 1201
+
+  SUPPORTED_EVENTS = [vtk.vtkCommand.ModifiedEvent, TargetModifiedEvent]
 
   def __init__(self, targetList):
     self.session = SliceTrackerSession()
     self.zFrameRegistration = SliceTrackerZFrameRegistrationStepLogic()
     self.targetList = targetList
-    self.observer = self.targetList.AddObserver(self.targetList.PointModifiedEvent, self.calculate)
+    self.observer = self.targetList.AddObserver(self.targetList.PointModifiedEvent, self.onPointModified)
     self.reset()
     self.calculate()
 
@@ -180,10 +271,17 @@ class ZFrameGuidanceComputation(ModuleLogicMixin):
   def calculate(self, caller=None, event=None):
     if not self.targetList or not self.session.zFrameRegistrationSuccessful:
       return
-    for index in range(self.targetList.GetNumberOfFiducials()):
-      self.calculateZFrameHoleAndDepth(index)
+    self.calculateZFrameHolesAndDepths(range(self.targetList.GetNumberOfFiducials()))
     self.invokeEvent(vtk.vtkCommand.ModifiedEvent)
 
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointModified(self, caller, event, callData):
+    if callData is None or not 0 <= callData < self.targetList.GetNumberOfFiducials():
+      self.calculate()
+    elif self.session.zFrameRegistrationSuccessful:
+      self.calculateZFrameHoleAndDepth(callData)
+      self.invokeEvent(self.TargetModifiedEvent, str(callData))
+
   def getZFrameHole(self, index):
     if index not in self.computedHoles.keys():
       self.calculateZFrameHoleAndDepth(index)
@@ -204,33 +302,31 @@ class ZFrameGuidanceComputation(ModuleLogicMixin):
     return self.computedDepth[index][0]
 
   def calculateZFrameHoleAndDepth(self, index):
-    targetPosition = self.getTargetPosition(self.targetList, index)
-    (start, end, indexX, indexY, depth, inRange) = self.computeNearestPath(targetPosition)
-    logging.debug("start:{}, end:{}, indexX:{}, indexY:{}, depth:{}, inRange:{}".format(start, end, indexX, indexY, depth, inRange))
-    self.needleStartEndPositions[index] = (start, end)
-    self.computedHoles[index] = [indexX, indexY]
-    self.computedDepth[index] = [inRange, round(depth/10, 1)]
+    self.calculateZFrameHolesAndDepths([index])
+
+  def calculateZFrameHolesAndDepths(self, indexes):
+    positions = [self.getTargetPosition(self.targetList, index) for index in indexes]
+    for index, nearestPath in zip(indexes, self.computeNearestPaths(positions)):
+      (start, end, indexX, indexY, depth, inRange) = nearestPath
+      logging.debug("start:{}, end:{}, indexX:{}, indexY:{}, depth:{}, inRange:{}".format(start, end, indexX, indexY,
+                                                                                          depth, inRange))
+      self.needleStartEndPositions[index] = (start, end)
+      self.computedHoles[index] = [indexX, indexY]
+      self.computedDepth[index] = [inRange, round(depth/10, 1)]
 
   def computeNearestPath(self, pos):
-    minMag2 = numpy.Inf
-    minDepth = 0.0
-    minIndex = -1
+    return self.computeNearestPaths([pos])[0]
+
+  def computeNearestPaths(self, positions):
+    if not len(positions):
+      return []
+    nearest, depths = self.zFrameRegistration.pathSearch.findNearest(positions)
+    return [self.describeNearestPath(int(index), float(depth)) for index, depth in zip(nearest, depths)]
+
+  def describeNearestPath(self, minIndex, minDepth):
     needleStart = None
     needleEnd = None
 
-    p = numpy.array(pos)
-    for i, orig in enumerate(self.zFrameRegistration.pathOrigins):
-      vec = self.zFrameRegistration.pathVectors[i]
-      op = p - orig
-      aproj = numpy.inner(op, vec)
-      perp = op-aproj*vec
-      mag2 = numpy.vdot(perp, perp)
-      if mag2 < minMag2:
-        minMag2 = mag2
-        minIndex = i
-        minDepth = aproj
-      i += 1
-
     indexX = '--'
     indexY = '--'
     inRange = False
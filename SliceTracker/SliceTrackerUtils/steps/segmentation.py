@@ -29,6 +29,7 @@ class SliceTrackerSegmentationStepLogic(SliceTrackerLogicBase):
       return self.session.fixedVolume and self.session.fixedLabel and self.session.movingTargets
 
   def loadInitialData(self):
+    self.session.finishBiasCorrection()
     self.session.movingLabel = self.session.data.initialLabel
     self.session.movingVolume = self.session.data.initialVolume
     self.session.movingTargets = self.session.data.initialTargets
@@ -1,13 +1,12 @@
-import sys, os
+import sys, os, time
+import logging
 import qt, vtk
 import csv, numpy
 import slicer
 import ast
 
-import SimpleITK as sitk
-import sitkUtils
-
 from ..algorithms.zFrameRegistration import LineMarkerRegistration, OpenSourceZFrameRegistration
+from ..algorithms.zFrameRegistration import ZFrameROILocalizer, NeedlePathSearch, labelSliceIslands
 from ..constants import SliceTrackerConstants
 from base import SliceTrackerLogicBase, SliceTrackerStep
 
@@ -26,6 +25,8 @@ class SliceTrackerZFrameRegistrationStepLogic(SliceTrackerLogicBase):
   ZFRAME_MODEL_NAME = 'ZFrameModel'
   ZFRAME_TEMPLATE_NAME = 'NeedleGuideTemplate'
   ZFRAME_TEMPLATE_PATH_NAME = 'NeedleGuideNeedlePath'
+
+  templateGeometryCache = {}
   # COMPUTED_NEEDLE_MODEL_NAME = 'ComputedNeedleModel'
 
   @property
@@ -54,9 +55,12 @@ class SliceTrackerZFrameRegistrationStepLogic(SliceTrackerLogicBase):
     self.tempModelNode = None
     self.pathModelNode = None
     self.templateConfig = []
-    self.templateMaxDepth = []
-    self.pathOrigins = []  ## Origins of needle paths (after transformation by parent transform node)
-    self.pathVectors = []  ## Normal vectors of needle paths (after transformation by parent transform node)
+    self.templateMaxDepth = numpy.zeros(0)
+    self.templatePathOrigins = numpy.zeros((0, 4))  ## Homogeneous origins of needle paths (w=1)
+    self.templatePathVectors = numpy.zeros((0, 4))  ## Homogeneous normal vectors of needle paths (w=0)
+    self.pathOrigins = numpy.zeros((0, 3))  ## Origins of needle paths (after transformation by parent transform node)
+    self.pathVectors = numpy.zeros((0, 3))  ## Normal vectors of needle paths (after transformation by parent transform node)
+    self.pathSearch = NeedlePathSearch(self.pathOrigins, self.pathVectors)
 
     self.clearOldNodes()
     self.loadZFrameModel()
@@ -101,53 +105,79 @@ class SliceTrackerZFrameRegistrationStepLogic(SliceTrackerLogicBase):
 
     defaultTemplateFile = os.path.join(self.resourcesPath, "zframe", self.ZFRAME_TEMPLATE_CONFIG_FILE_NAME)
 
-    reader = csv.reader(open(defaultTemplateFile, 'rb'))
-    try:
-      next(reader)
-      for row in reader:
-        self.templateIndex.append(row[0:2])
-        self.templateConfig.append([float(row[2]), float(row[3]), float(row[4]),
-                                    float(row[5]), float(row[6]), float(row[7]),
-                                    float(row[8])])
-    except csv.Error as e:
-      print('file %s, line %d: %s' % (defaultTemplateFile, reader.line_num, e))
-      return
+    cacheKey = (defaultTemplateFile, os.path.getmtime(defaultTemplateFile))
+    if cacheKey not in self.templateGeometryCache:
+      templateIndex, templateConfig = [], []
+      reader = csv.reader(open(defaultTemplateFile, 'rb'))
+      try:
+        next(reader)
+        for row in reader:
+          templateIndex.append(row[0:2])
+          templateConfig.append([float(row[2]), float(row[3]), float(row[4]),
+                                 float(row[5]), float(row[6]), float(row[7]),
+                                 float(row[8])])
+      except csv.Error as e:
+        print('file %s, line %d: %s' % (defaultTemplateFile, reader.line_num, e))
+        return
+      self.templateGeometryCache.clear()
+      self.templateGeometryCache[cacheKey] = (templateIndex, templateConfig) + \
+                                             self.createTemplateAndNeedlePathPolyData(templateConfig)
 
-    self.createTemplateAndNeedlePathModel()
+    templateIndex, templateConfig, templatePolyData, pathPolyData = self.templateGeometryCache[cacheKey]
+    self.templateIndex = list(templateIndex)
+    self.templateConfig = list(templateConfig)
+
+    self.createTemplateAndNeedlePathModel(templatePolyData, pathPolyData)
     self.setTemplateVisibility(0)
     self.setTemplatePathVisibility(0)
     self.setNeedlePathVisibility(0)
     self.updateTemplateVectors()
 
-  def createTemplateAndNeedlePathModel(self):
-    self.templatePathVectors = []
-    self.templatePathOrigins = []
+  def createTemplateAndNeedlePathPolyData(self, templateConfig):
+    templateSegments, pathSegments = [], []
+    for row in templateConfig:
+      p, _ = self.extractPointsAndNormalVectors(row)
+      templateSegments.append((p[0], p[1]))
+      pathSegments.append((p[0], p[2]))
+    return (self.createTubesPolyData(templateSegments, radius=1.0, numberOfSides=18),
+            self.createTubesPolyData(pathSegments, radius=0.8, numberOfSides=18))
+
+  @staticmethod
+  def createTubesPolyData(segments, radius, numberOfSides):
+    """ creates the tubes around all line segments with a single tube filter run """
+    points = vtk.vtkPoints()
+    lines = vtk.vtkCellArray()
+    for start, end in segments:
+      line = vtk.vtkLine()
+      line.GetPointIds().SetId(0, points.InsertNextPoint(*[float(c) for c in start]))
+      line.GetPointIds().SetId(1, points.InsertNextPoint(*[float(c) for c in end]))
+      lines.InsertNextCell(line)
+    linesPolyData = vtk.vtkPolyData()
+    linesPolyData.SetPoints(points)
+    linesPolyData.SetLines(lines)
+    tubeFilter = vtk.vtkTubeFilter()
+    tubeFilter.SetInputData(linesPolyData)
+    tubeFilter.SetRadius(radius)
+    tubeFilter.SetNumberOfSides(numberOfSides)
+    tubeFilter.CappingOn()
+    tubeFilter.Update()
+    return tubeFilter.GetOutput()
+
+  def createTemplateAndNeedlePathModel(self, templatePolyData, pathPolyData):
+    config = numpy.array(self.templateConfig, dtype=float).reshape(-1, 7)
+    vectors = config[:, 3:6] - config[:, 0:3]
+    normals = vectors / numpy.linalg.norm(vectors, axis=1)[:, numpy.newaxis]
+    self.templatePathOrigins = numpy.column_stack([config[:, 0:3], numpy.ones(len(config))])
+    self.templatePathVectors = numpy.column_stack([normals, numpy.zeros(len(config))])
+    self.templateMaxDepth = config[:, 6]
 
     self.checkAndCreateTemplateModelNode()
     self.checkAndCreatePathModelNode()
 
-    pathModelAppend = vtk.vtkAppendPolyData()
-    templateModelAppend = vtk.vtkAppendPolyData()
-
-    for row in self.templateConfig:
-      p, n = self.extractPointsAndNormalVectors(row)
-
-      tempTubeFilter = self.createVTKTubeFilter(p[0], p[1], radius=1.0, numSides=18)
-      templateModelAppend.AddInputData(tempTubeFilter.GetOutput())
-      templateModelAppend.Update()
-
-      pathTubeFilter = self.createVTKTubeFilter(p[0], p[2], radius=0.8, numSides=18)
-      pathModelAppend.AddInputData(pathTubeFilter.GetOutput())
-      pathModelAppend.Update()
-
-      self.templatePathOrigins.append([row[0], row[1], row[2], 1.0])
-      self.templatePathVectors.append([n[0], n[1], n[2], 1.0])
-      self.templateMaxDepth.append(row[6])
-
-    self.tempModelNode.SetAndObservePolyData(templateModelAppend.GetOutput())
+    self.tempModelNode.SetAndObservePolyData(templatePolyData)
     self.tempModelNode.GetDisplayNode().SetColor(0.5,0,1)
 
-    self.pathModelNode.SetAndObservePolyData(pathModelAppend.GetOutput())
+    self.pathModelNode.SetAndObservePolyData(pathPolyData)
     self.pathModelNode.GetDisplayNode().SetColor(0.8,0.5,1)
 
   def extractPointsAndNormalVectors(self, row):
@@ -182,21 +212,12 @@ class SliceTrackerZFrameRegistrationStepLogic(SliceTrackerLogicBase):
       transformNode.GetMatrixTransformToWorld(trans)
     else:
       trans.Identity()
+    matrix = numpy.array([[trans.GetElement(row, column) for column in range(4)] for row in range(4)])
 
-    # Calculate offset
-    zero = [0.0, 0.0, 0.0, 1.0]
-    offset = trans.MultiplyDoublePoint(zero)
-
-    self.pathOrigins = []
-    self.pathVectors = []
-
-    for i, orig in enumerate(self.templatePathOrigins):
-      torig = trans.MultiplyDoublePoint(orig)
-      self.pathOrigins.append(numpy.array(torig[0:3]))
-      vec = self.templatePathVectors[i]
-      tvec = trans.MultiplyDoublePoint(vec)
-      self.pathVectors.append(numpy.array([tvec[0] - offset[0], tvec[1] - offset[1], tvec[2] - offset[2]]))
-      i += 1
+    # vectors have w=0 and therefore are not affected by the translation
+    self.pathOrigins = numpy.dot(self.templatePathOrigins, matrix.T)[:, :3]
+    self.pathVectors = numpy.dot(self.templatePathVectors, matrix.T)[:, :3]
+    self.pathSearch = NeedlePathSearch(self.pathOrigins, self.pathVectors)
 
   def setZFrameVisibility(self, visibility):
     self.setNodeVisibility(self.zFrameModelNode, visibility)
@@ -217,15 +238,100 @@ class SliceTrackerZFrameRegistrationStepLogic(SliceTrackerLogicBase):
       self.setNodeSliceIntersectionVisibility(self.needleModelNode, visibility)
 
   def runZFrameRegistration(self, inputVolume, algorithm, **kwargs):
-    registration = algorithm(inputVolume)
+    transform = self.computeZFrameTransform(inputVolume, algorithm, **kwargs)
+    zFrameRegistrationResult = self.session.data.createZFrameRegistrationResult(self.templateVolume.GetName())
+    zFrameRegistrationResult.volume = inputVolume
+    zFrameRegistrationResult.transform = transform
+    return True
+
+  def computeZFrameTransform(self, inputVolume, algorithm, **kwargs):
+    registration = algorithm(inputVolume, scheduler=self.session.scheduler)
     if isinstance(registration, OpenSourceZFrameRegistration):
       registration.runRegistration(start=kwargs.pop("startSlice"), end=kwargs.pop("endSlice"))
     elif isinstance(registration, LineMarkerRegistration):
       registration.runRegistration()
-    zFrameRegistrationResult = self.session.data.createZFrameRegistrationResult(self.templateVolume.GetName())
-    zFrameRegistrationResult.volume = inputVolume
-    zFrameRegistrationResult.transform = registration.getOutputTransformation()
-    return True
+    return registration.getOutputTransformation()
+
+  def createMaskedTemplateVolume(self, templateVolume, coverTemplateROI):
+    croppedVolume = self.createCroppedVolume(templateVolume, coverTemplateROI)
+    labelVolume = self.createLabelMapFromCroppedVolume(croppedVolume, "labelmap")
+    maskedVolume = self.createMaskedVolume(templateVolume, labelVolume, outputVolumeName="maskedTemplateVolume")
+    maskedVolume.SetName(templateVolume.GetName() + "-label")
+    return croppedVolume, labelVolume, maskedVolume
+
+  def getStartEndSlices(self, maskedVolume, coverTemplateROI):
+    _, center, _ = self.getROIMinCenterMaxSliceNumbers(coverTemplateROI)
+    otsuOutputVolume = self.applyOtsuFilter(maskedVolume)
+    self.dilateMask(otsuOutputVolume)
+    return self.getStartEndWithConnectedComponents(otsuOutputVolume, center)
+
+  def localizeZFrameROI(self, templateVolume):
+    """ returns an annotation ROI around the automatically localized z-frame plus start and end slice or None """
+    localization = ZFrameROILocalizer(templateVolume).localize()
+    if not localization:
+      return None
+    (minimumIJK, maximumIJK), start, end = localization
+    ijkToRAS = vtk.vtkMatrix4x4()
+    templateVolume.GetIJKToRASMatrix(ijkToRAS)
+    corners = [ijkToRAS.MultiplyPoint([float(i), float(j), float(k), 1.0])[:3]
+               for i in (minimumIJK[0], maximumIJK[0])
+               for j in (minimumIJK[1], maximumIJK[1])
+               for k in (minimumIJK[2], maximumIJK[2])]
+    lower, upper = numpy.min(corners, axis=0), numpy.max(corners, axis=0)
+    roi = slicer.vtkMRMLAnnotationROINode()
+    roi.SetName(templateVolume.GetName() + "-ZFrameROI")
+    slicer.mrmlScene.AddNode(roi)
+    roi.SetXYZ(*((lower + upper) / 2.0).tolist())
+    roi.SetRadiusXYZ(*((upper - lower) / 2.0).tolist())
+    return roi, start, end
+
+  def benchmarkZFrameROILocalization(self, templateVolume, manualROI, manualROIPlacementTime=0.0):
+    """ registers templateVolume with an automatically localized ROI and with manualROI
+
+    Returns per run the computation time in seconds from template volume to transform and the time to calibration,
+    which adds manualROIPlacementTime (the time the user took to place manualROI) to the manual run. Also returns the
+    difference between both resulting transforms (translation in mm, rotation in degrees). Returns None if the z-frame
+    could not be localized.
+    """
+    runs = {}
+    localization = None
+    for mode in ["automatic", "manual"]:
+      startTime = time.time()
+      if mode == "automatic":
+        localization = self.localizeZFrameROI(templateVolume)
+        if not localization:
+          return None
+        roi, start, end = localization
+        nodes = self.createMaskedTemplateVolume(templateVolume, roi)
+      else:
+        roi = manualROI
+        nodes = self.createMaskedTemplateVolume(templateVolume, roi)
+        start, end = self.getStartEndSlices(nodes[-1], roi)
+      transform = self.computeZFrameTransform(nodes[-1], OpenSourceZFrameRegistration, startSlice=start, endSlice=end)
+      elapsed = time.time() - startTime
+      runs[mode] = {"time": elapsed, "startSlice": start, "endSlice": end, "transform": transform,
+                    "timeToCalibration": elapsed + (manualROIPlacementTime if mode == "manual" else 0.0)}
+      for node in nodes:
+        self.removeNodeFromMRMLScene(node)
+    self.removeNodeFromMRMLScene(localization[0])
+    translation, rotation = self.getTransformDifference(runs["automatic"]["transform"], runs["manual"]["transform"])
+    for run in runs.values():
+      self.removeNodeFromMRMLScene(run.pop("transform"))
+    runs.update({"translationDifference": translation, "rotationDifference": rotation})
+    logging.info("Z-frame ROI benchmark: %s" % runs)
+    return runs
+
+  @staticmethod
+  def getTransformDifference(transformNode, otherTransformNode):
+    matrices = []
+    for node in [transformNode, otherTransformNode]:
+      matrix = vtk.vtkMatrix4x4()
+      node.GetMatrixTransformToParent(matrix)
+      matrices.append(numpy.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)]))
+    translation = numpy.linalg.norm(matrices[0][:3, 3] - matrices[1][:3, 3])
+    relativeRotation = numpy.dot(matrices[0][:3, :3].T, matrices[1][:3, :3])
+    rotation = numpy.degrees(numpy.arccos(numpy.clip((numpy.trace(relativeRotation) - 1) / 2.0, -1.0, 1.0)))
+    return float(translation), float(rotation)
 
   def getROIMinCenterMaxSliceNumbers(self, coverTemplateROI):
     center = [0.0, 0.0, 0.0]
@@ -238,27 +344,30 @@ class SliceTrackerZFrameRegistrationStepLogic(SliceTrackerLogicBase):
             self.getIJKForXYZ(self.redSliceWidget, pMax)[2]]
 
   def getStartEndWithConnectedComponents(self, volume, center):
-    address = sitkUtils.GetSlicerITKReadWriteAddress(volume.GetName())
-    image = sitk.ReadImage(address)
-    start = self.getStartSliceUsingConnectedComponents(center, image)
-    end = self.getEndSliceUsingConnectedComponents(center, image)
+    islandCounts = self.getIslandCountPerSlice(slicer.util.arrayFromVolume(volume))
+    start = self.getStartSliceUsingConnectedComponents(center, islandCounts)
+    end = self.getEndSliceUsingConnectedComponents(center, islandCounts)
     return start, end
 
-  def getStartSliceUsingConnectedComponents(self, center, image):
+  def getIslandCountPerSlice(self, array):
+    """ returns the number of islands of each slice (first array axis) computed with a single labeling pass """
+    _, sliceOfLabel = labelSliceIslands(array)
+    return numpy.bincount(sliceOfLabel[sliceOfLabel >= 0], minlength=array.shape[0])
+
+  def getStartSliceUsingConnectedComponents(self, center, islandCounts):
     sliceIndex = start = center
-    while sliceIndex > 0:
-      if self.getIslandCount(image, sliceIndex) > 6:
+    while 0 < sliceIndex < len(islandCounts):
+      if islandCounts[sliceIndex] > 6:
         start = sliceIndex
         sliceIndex -= 1
         continue
       break
     return start
 
-  def getEndSliceUsingConnectedComponents(self, center, image):
-    imageSize = image.GetSize()
+  def getEndSliceUsingConnectedComponents(self, center, islandCounts):
     sliceIndex = end = center
-    while sliceIndex < imageSize[2]:
-      if self.getIslandCount(image, sliceIndex) > 6:
+    while 0 <= sliceIndex < len(islandCounts):
+      if islandCounts[sliceIndex] > 6:
         end = sliceIndex
         sliceIndex += 1
         continue
@@ -285,6 +394,11 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
     self.zFrameClickObserver = None
     self.zFrameInstructionAnnotation = None
 
+    self.proposedROIGeometry = None
+    self.proposedSlices = None
+    self.calibrationStartTime = None
+    self.roiPlacementTime = None
+
     super(SliceTrackerZFrameRegistrationStep, self).__init__()
     self.logic.templateVolume = None
 
@@ -301,6 +415,7 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
     self.layout().addWidget(self.zFrameRegistrationManualIndexesGroupBox)
     self.layout().addWidget(self.createHLayout([self.runZFrameRegistrationButton, self.retryZFrameRegistrationButton,
                                                 self.approveZFrameRegistrationButton]))
+    self.layout().addWidget(self.benchmarkZFrameROIButton)
     self.layout().addStretch(1)
 
   def setupManualIndexesGroupBox(self):
@@ -325,6 +440,11 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
     self.retryZFrameRegistrationButton = self.createButton("", icon=Icons.retry, iconSize=iconSize, enabled=False,
                                                            visible=self.zFrameRegistrationClass is OpenSourceZFrameRegistration,
                                                            toolTip="Reset")
+    developerMode = str(self.getSetting('DeveloperMode', 'Developer')).lower() == 'true'
+    self.benchmarkZFrameROIButton = self.createButton("Benchmark ROI localization", enabled=False,
+                                                      visible=developerMode and
+                                                      self.zFrameRegistrationClass is OpenSourceZFrameRegistration,
+                                                      toolTip="Compare automatic ROI localization with the current ROI")
 
   def setupAdditionalViewSettingButtons(self):
     iconSize = qt.QSize(24, 24)
@@ -338,6 +458,7 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
     self.retryZFrameRegistrationButton.clicked.connect(self.onRetryZFrameRegistrationButtonClicked)
     self.approveZFrameRegistrationButton.clicked.connect(self.onApproveZFrameRegistrationButtonClicked)
     self.runZFrameRegistrationButton.clicked.connect(self.onApplyZFrameRegistrationButtonClicked)
+    self.benchmarkZFrameROIButton.clicked.connect(self.onBenchmarkZFrameROIButtonClicked)
 
     self.showZFrameModelButton.connect('toggled(bool)', self.onShowZFrameModelToggled)
     self.showTemplateButton.connect('toggled(bool)', self.onShowZFrameTemplateToggled)
@@ -417,17 +538,53 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
     self.resetZFrameRegistration()
     self.setupFourUpView(self.logic.templateVolume)
     self.redSliceNode.SetSliceVisible(True)
-    if self.zFrameRegistrationClass is OpenSourceZFrameRegistration:
+    self.calibrationStartTime = time.time()
+    if self.zFrameRegistrationClass is OpenSourceZFrameRegistration and not self.proposeZFrameROI():
       self.addROIObserver()
       self.activateCreateROIMode()
       self.addZFrameInstructions()
 
+  def proposeZFrameROI(self):
+    if str(self.getSetting("ZFrame_Automatic_ROI")).lower() != 'true':
+      return False
+    localization = self.logic.localizeZFrameROI(self.logic.templateVolume)
+    if not localization:
+      logging.info("Z-frame could not be localized automatically. Falling back to manual ROI placement.")
+      return False
+    self.coverTemplateROI, start, end = localization
+    self.proposedROIGeometry = self.getROIGeometry(self.coverTemplateROI)
+    self.proposedSlices = start, end
+    numberOfSlices = self.logic.templateVolume.GetImageData().GetDimensions()[2]
+    for spinBox, value in [(self.zFrameRegistrationStartIndex, start), (self.zFrameRegistrationEndIndex, end)]:
+      spinBox.maximum = numberOfSlices - 1
+      spinBox.value = value
+    self.runZFrameRegistrationButton.enabled = self.isRegistrationPossible()
+    return True
+
+  @staticmethod
+  def getROIGeometry(roi):
+    center = [0.0, 0.0, 0.0]
+    radius = [0.0, 0.0, 0.0]
+    roi.GetXYZ(center)
+    roi.GetRadiusXYZ(radius)
+    return center + radius
+
+  def getROIMode(self):
+    if self.proposedROIGeometry is None:
+      return "manual"
+    return "automatic" if self.getROIGeometry(self.coverTemplateROI) == self.proposedROIGeometry else "adjusted"
+
   def resetZFrameRegistration(self):
     self.runZFrameRegistrationButton.enabled = False
     self.approveZFrameRegistrationButton.enabled = False
     self.retryZFrameRegistrationButton.enabled = False
 
     self.removeNodeFromMRMLScene(self.coverTemplateROI)
+    self.coverTemplateROI = None
+    self.proposedROIGeometry = None
+    self.proposedSlices = None
+    self.roiPlacementTime = None
+    self.benchmarkZFrameROIButton.enabled = False
     self.removeNodeFromMRMLScene(self.zFrameCroppedVolume)
     self.removeNodeFromMRMLScene(self.zFrameLabelVolume)
     self.removeNodeFromMRMLScene(self.zFrameMaskedVolume)
@@ -492,22 +649,21 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
     try:
       if self.zFrameRegistrationClass is OpenSourceZFrameRegistration:
         self.annotationLogic.SetAnnotationLockedUnlocked(self.coverTemplateROI.GetID())
-        self.zFrameCroppedVolume = self.logic.createCroppedVolume(zFrameTemplateVolume, self.coverTemplateROI)
-        self.zFrameLabelVolume = self.logic.createLabelMapFromCroppedVolume(self.zFrameCroppedVolume, "labelmap")
-        self.zFrameMaskedVolume = self.logic.createMaskedVolume(zFrameTemplateVolume, self.zFrameLabelVolume,
-                                                                outputVolumeName="maskedTemplateVolume")
-        self.zFrameMaskedVolume.SetName(zFrameTemplateVolume.GetName() + "-label")
-
-        if not self.zFrameRegistrationManualIndexesGroupBox.checked:
-          start, center, end = self.logic.getROIMinCenterMaxSliceNumbers(self.coverTemplateROI)
-          otsuOutputVolume = self.logic.applyOtsuFilter(self.zFrameMaskedVolume)
-          self.logic.dilateMask(otsuOutputVolume)
-          start, end = self.logic.getStartEndWithConnectedComponents(otsuOutputVolume, center)
-          self.zFrameRegistrationStartIndex.value = start
-          self.zFrameRegistrationEndIndex.value = end
-        else:
+        self.zFrameCroppedVolume, self.zFrameLabelVolume, self.zFrameMaskedVolume = \
+          self.logic.createMaskedTemplateVolume(zFrameTemplateVolume, self.coverTemplateROI)
+
+        if self.calibrationStartTime is not None:
+          self.roiPlacementTime = time.time() - self.calibrationStartTime
+        if self.zFrameRegistrationManualIndexesGroupBox.checked:
           start = self.zFrameRegistrationStartIndex.value
           end = self.zFrameRegistrationEndIndex.value
+        else:
+          if self.getROIMode() == "automatic":
+            start, end = self.proposedSlices
+          else:
+            start, end = self.logic.getStartEndSlices(self.zFrameMaskedVolume, self.coverTemplateROI)
+          self.zFrameRegistrationStartIndex.value = start
+          self.zFrameRegistrationEndIndex.value = end
         self.logic.runZFrameRegistration(self.zFrameMaskedVolume, self.zFrameRegistrationClass,
                                          startSlice=start, endSlice=end)
       else:
@@ -518,9 +674,36 @@ class SliceTrackerZFrameRegistrationStep(SliceTrackerStep):
       slicer.util.errorDisplay("An error occurred. For further information click 'Show Details...'",
                    windowTitle=self.__class__.__name__, detailedText=str(exc.message))
     else:
+      self.recordCalibrationTime(zFrameTemplateVolume)
       self.setBackgroundToVolumeID(zFrameTemplateVolume)
       self.approveZFrameRegistrationButton.enabled = True
       self.retryZFrameRegistrationButton.enabled = True
+      self.benchmarkZFrameROIButton.enabled = self.zFrameRegistrationClass is OpenSourceZFrameRegistration
+
+  def onBenchmarkZFrameROIButtonClicked(self):
+    runs = self.logic.benchmarkZFrameROILocalization(self.logic.templateVolume, self.coverTemplateROI,
+                                                     self.roiPlacementTime or 0.0)
+    if not runs:
+      slicer.util.warningDisplay("The z-frame could not be localized automatically.",
+                                 windowTitle="Z-frame ROI benchmark")
+      return
+    slicer.util.infoDisplay("Time to calibration: %.1fs automatic, %.1fs manual (ROI placement included)\n"
+                            "Slices: %d-%d automatic, %d-%d manual\n"
+                            "Transform difference: %.2f mm, %.2f degrees"
+                            % (runs["automatic"]["timeToCalibration"], runs["manual"]["timeToCalibration"],
+                               runs["automatic"]["startSlice"], runs["automatic"]["endSlice"],
+                               runs["manual"]["startSlice"], runs["manual"]["endSlice"],
+                               runs["translationDifference"], runs["rotationDifference"]),
+                            windowTitle="Z-frame ROI benchmark")
+
+  def recordCalibrationTime(self, zFrameTemplateVolume):
+    if self.calibrationStartTime is None:
+      return
+    roiMode = self.getROIMode() if self.zFrameRegistrationClass is OpenSourceZFrameRegistration else None
+    duration = time.time() - self.calibrationStartTime
+    logging.info("Z-frame calibration of %s took %.2fs (ROI: %s)" % (zFrameTemplateVolume.GetName(), duration, roiMode))
+    self.session.data.recordEvent("zFrameCalibrated", series=zFrameTemplateVolume.GetName(), roi=roiMode,
+                                  duration=duration)
 
   def applyZFrameTransform(self):
     for node in [node for node in
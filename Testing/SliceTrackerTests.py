@@ -1,9 +1,18 @@
 import unittest
-import os, inspect, slicer
+import os, inspect, re, slicer
+import logging, time
+import numpy
 from SliceTrackerUtils.session import SliceTrackerSession
 from SliceTrackerUtils.sessionData import SessionData
+from SliceTrackerUtils.configuration import SliceTrackerSettings, SliceTrackerConfiguration
+from SliceTrackerUtils.constants import SliceTrackerConstants
+from SliceTrackerUtils.algorithms.zFrameRegistration import NeedlePathSearch, ZFrameROILocalizer
+from SliceTrackerUtils.helpers import SeriesTypeClassifier
+from SliceTrackerUtils.steps.plugins.charts import TargetDisplacementMatrix
+from SliceTrackerRegistration import CLIProgressMonitor
 
-__all__ = ['SliceTrackerSessionTests', 'RegistrationResultsTest']
+__all__ = ['SliceTrackerSessionTests', 'RegistrationResultsTest', 'CLIProgressMonitorTest', 'SettingsSnapshotTest',
+           'NeedlePathSearchTest', 'SeriesTypeClassifierTest', 'ZFrameROILocalizerTest', 'TargetDisplacementMatrixTest']
 
 tempDir =  os.path.join(slicer.app.temporaryPath, "SliceTrackerResults")
 
@@ -50,4 +59,247 @@ class RegistrationResultsTest(unittest.TestCase):
   def test_Writing_json(self):
     self.registrationResults.resumed = True
     self.registrationResults.completed = True
-    self.registrationResults.save(tempDir)
\ No newline at end of file
+    self.registrationResults.save(tempDir)
+    self.registrationResults.flush()
+    self.assertTrue(os.path.exists(os.path.join(tempDir, "results.json")))
+
+
+class CLIProgressMonitorTest(unittest.TestCase):
+
+  BRAINSFIT_OUTPUT = "\n".join([
+    "Original Fixed image origin[-103.35, -111.549, -63.6521]",
+    "Initializer, center of rotation: [1.17822, -3.8147, 2.02164]",
+    "Initializer, transformInitializationStrategy: useMomentsAlign",
+    " 0   -0.348157   [0.0021435, -0.00120211, 0.000312, 1.20432, -0.514389, 2.10753]",
+    " 1   -0.412384   [0.00310987, -0.00200343, 0.000523, 1.55012, -0.702343, 2.35998]",
+    " 2   -4.31577e-01   [0.00330871, -0.00235431, 0.000611, 1.61234, -0.731002, 2.40121]",
+    "Stop condition from optimizer.Step too small after 3 iterations. Current step (0.0001) is less than minimum",
+    "   3   -0.43202   [0.00331002, -0.00235998, 0.000612, 1.61301, -0.731234, 2.40203]",
+    "4   -0.4321"])
+
+  def runTest(self):
+    self.test_Parse_BRAINSFit_iterations()
+
+  def test_Parse_BRAINSFit_iterations(self):
+    monitor = CLIProgressMonitor("Rigid")
+    monitor._parseOutput(self.BRAINSFIT_OUTPUT)
+    self.assertEqual(monitor.metricValues, [(0, -0.348157), (1, -0.412384), (2, -0.431577), (3, -0.43202)])
+    monitor._parseOutput(self.BRAINSFIT_OUTPUT + "\n")
+    self.assertEqual(monitor.lastMetricValue, (4, -0.4321))
+    self.assertIn("iteration 4, metric -0.43210", monitor.getStatusText())
+
+
+class SettingsSnapshotTest(unittest.TestCase):
+
+  NUMBER_OF_CALLS = 2000
+
+  @classmethod
+  def setUpClass(cls):
+    cls.settings = SliceTrackerSettings()
+
+  def runTest(self):
+    self.test_Snapshot_matches_settings()
+    self.test_Snapshot_is_cached()
+    self.test_Snapshot_invalidated_on_change()
+    self.test_Snapshot_per_call_cost()
+
+  def test_Snapshot_matches_settings(self):
+    snapshot = self.settings.snapshot
+    moduleName = SliceTrackerConstants.MODULE_NAME
+    self.assertEqual(snapshot.needleImagePattern, self.settings.getSetting("NEEDLE_IMAGE_PATTERN", moduleName=moduleName))
+    self.assertEqual(snapshot.computeSeriesType("7: %s" % snapshot.needleImagePattern),
+                     SliceTrackerConstants.GUIDANCE_IMAGE)
+    self.assertTrue(self.settings.refresh() is snapshot)
+    self.settings.setSetting("VIBE_IMAGE_PATTERN", snapshot.vibeImagePattern)
+    self.assertTrue(self.settings.snapshot is snapshot)
+
+  def test_Snapshot_is_cached(self):
+    snapshot = self.settings.snapshot
+    reads = []
+    readValues = self.settings._readValues
+    self.settings._readValues = lambda: reads.append(True) or readValues()
+    try:
+      for index in range(100):
+        self.assertTrue(SliceTrackerSettings().snapshot is snapshot)
+        snapshot.computeSeriesType("%d: AX T2" % index)
+    finally:
+      del self.settings._readValues
+    self.assertEqual(len(reads), 0)
+
+  def test_Snapshot_invalidated_on_change(self):
+    snapshot = self.settings.snapshot
+    original = snapshot.vibeImagePattern
+    configFile = os.path.join(os.path.dirname(inspect.getfile(SliceTrackerConfiguration)), "..", "Resources",
+                              "default.cfg")
+    configuration = SliceTrackerConfiguration(SliceTrackerConstants.MODULE_NAME, configFile)
+    try:
+      self.settings.setSetting("VIBE_IMAGE_PATTERN", original + "_Changed")
+      self.assertFalse(self.settings.snapshot is snapshot)
+      self.assertEqual(self.settings.snapshot.vibeImagePattern, original + "_Changed")
+      snapshot = self.settings.snapshot
+      configuration.setSetting("VIBE_IMAGE_PATTERN", original)
+      self.assertFalse(self.settings.snapshot is snapshot)
+      self.assertEqual(self.settings.snapshot.vibeImagePattern, original)
+    finally:
+      self.settings.setSetting("VIBE_IMAGE_PATTERN", original)
+
+  def test_Snapshot_per_call_cost(self):
+    moduleName = SliceTrackerConstants.MODULE_NAME
+    patterns = ["COVER_PROSTATE_PATTERN", "COVER_TEMPLATE_PATTERN", "NEEDLE_IMAGE_PATTERN", "VIBE_IMAGE_PATTERN"]
+
+    def computeFromSettings(series):
+      return next((p for p in [self.settings.getSetting(name, moduleName=moduleName) for name in patterns]
+                   if p in series), None)
+
+    def computeFromSnapshot(series):
+      return SliceTrackerSettings().snapshot.computeSeriesType(series)
+
+    before = self._measurePerCallCost(computeFromSettings)
+    after = self._measurePerCallCost(computeFromSnapshot)
+    logging.info("Series type computation per call: %.2f us from QSettings, %.2f us from snapshot"
+                 % (before * 1e6, after * 1e6))
+
+  def _measurePerCallCost(self, function):
+    start = time.time()
+    for index in range(self.NUMBER_OF_CALLS):
+      function("%d: AX T2" % index)
+    return (time.time() - start) / self.NUMBER_OF_CALLS
+
+
+class NeedlePathSearchTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_Index_matches_brute_force()
+    self.test_Index_requires_parallel_paths()
+
+  def createTemplate(self, direction=(0.0, 0.0, 1.0)):
+    origins = [(column * 5.0, row * 5.0, 0.0) for row in range(13) for column in range(13)]
+    return numpy.array(origins), numpy.tile(direction, (len(origins), 1))
+
+  def test_Index_matches_brute_force(self):
+    origins, directions = self.createTemplate()
+    targets = numpy.random.RandomState(0).uniform(low=[-10, -10, -50], high=[70, 70, 50], size=(500, 3))
+    indexedSearch = NeedlePathSearch(origins, directions, useIndex=True)
+    self.assertIsNotNone(indexedSearch._grid)
+    nearest, depths = NeedlePathSearch(origins, directions, useIndex=False).findNearest(targets)
+    indexedNearest, indexedDepths = indexedSearch.findNearest(targets)
+    numpy.testing.assert_array_equal(indexedNearest, nearest)
+    numpy.testing.assert_allclose(indexedDepths, depths)
+
+  def test_Index_requires_parallel_paths(self):
+    origins, directions = self.createTemplate()
+    directions[0] = (0.0, 0.1, 1.0)
+    self.assertIsNone(NeedlePathSearch(origins, directions, useIndex=True)._grid)
+
+
+class SeriesTypeClassifierTest(unittest.TestCase):
+
+  SERIES_TYPES = [SliceTrackerConstants.COVER_TEMPLATE, SliceTrackerConstants.COVER_PROSTATE,
+                  SliceTrackerConstants.GUIDANCE_IMAGE, SliceTrackerConstants.VIBE_IMAGE,
+                  SliceTrackerConstants.OTHER_IMAGE]
+
+  RULES = """
+    # comment
+    GUIDANCE = ProtocolName ~ ^t2_tse_tra_needle & NumberOfSlices >= 10
+    VIBE = SequenceName ~ vibe
+    UNKNOWN = ProtocolName ~ anything
+    COVER PROSTATE = NumberOfSlices >> 3
+  """
+
+  def setUp(self):
+    rules = SeriesTypeClassifier.parseRules(self.RULES, self.SERIES_TYPES)
+    rules.append((SliceTrackerConstants.COVER_PROSTATE, [("SeriesDescription", re.escape("COVER PROSTATE"))], []))
+    self.classifier = SeriesTypeClassifier(rules, defaultSeriesType=SliceTrackerConstants.OTHER_IMAGE)
+
+  def runTest(self):
+    self.test_Invalid_rules_are_skipped()
+    self.test_Rules_match_in_order()
+    self.test_Classification_is_cached()
+
+  def test_Invalid_rules_are_skipped(self):
+    self.assertEqual([rule[0] for rule in SeriesTypeClassifier.parseRules(self.RULES, self.SERIES_TYPES)],
+                     [SliceTrackerConstants.GUIDANCE_IMAGE, SliceTrackerConstants.VIBE_IMAGE])
+
+  def test_Rules_match_in_order(self):
+    needle = {"ProtocolName": "t2_tse_tra_needle", "SeriesDescription": "COVER PROSTATE", "NumberOfSlices": 12}
+    self.assertEqual(self.classifier.classify("5: needle", needle), SliceTrackerConstants.GUIDANCE_IMAGE)
+    needle["NumberOfSlices"] = 5
+    self.assertEqual(self.classifier.classify("6: needle", needle), SliceTrackerConstants.COVER_PROSTATE)
+    self.assertEqual(self.classifier.classify("7: vibe", {"SequenceName": "*fl3d_vibe"}),
+                     SliceTrackerConstants.VIBE_IMAGE)
+    self.assertEqual(self.classifier.classify("8: COVER PROSTATE"), SliceTrackerConstants.COVER_PROSTATE)
+    self.assertEqual(self.classifier.classify("9: AX T1"), SliceTrackerConstants.OTHER_IMAGE)
+
+  def test_Classification_is_cached(self):
+    headers = {"ProtocolName": "t2_tse_tra_needle", "NumberOfSlices": 4}
+    self.assertEqual(self.classifier.classify("10: needle", headers), SliceTrackerConstants.OTHER_IMAGE)
+    headers = dict(headers, NumberOfSlices=20)
+    self.assertEqual(self.classifier.classify("10: needle", headers), SliceTrackerConstants.OTHER_IMAGE)
+    self.classifier.invalidate("10: needle")
+    self.assertEqual(self.classifier.classify("10: needle", headers), SliceTrackerConstants.GUIDANCE_IMAGE)
+
+
+class ZFrameROILocalizerTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_Longest_run()
+
+  def test_Longest_run(self):
+    getLongestRun = ZFrameROILocalizer.getLongestRun
+    self.assertEqual(getLongestRun([False, True, True, False, True, True, True, False]), (4, 6))
+    self.assertEqual(getLongestRun([True, True, False, True, True]), (0, 1))
+    self.assertEqual(getLongestRun([True] * 5), (0, 4))
+    self.assertIsNone(getLongestRun([False] * 5))
+    self.assertIsNone(getLongestRun([]))
+
+
+class TargetDisplacementMatrixTest(unittest.TestCase):
+
+  class Result(object):
+
+    def __init__(self, name, seriesNumber, targets):
+      self.name = name
+      self.seriesNumber = seriesNumber
+      self.targets = type("Targets", (object,), {"approved": targets})()
+
+  def createTargets(self, positions):
+    targets = slicer.vtkMRMLMarkupsFiducialNode()
+    for index, position in enumerate(positions):
+      targets.AddFiducialFromArray(position, "T%d" % index)
+    return targets
+
+  def runTest(self):
+    self.test_Displacements()
+    self.test_Update_detects_changes()
+
+  def test_Displacements(self):
+    matrix = TargetDisplacementMatrix()
+    results = [self.Result("5: needle", 5, self.createTargets([[0, 0, 0], [1, 1, 1]])),
+               self.Result("7: needle", 7, self.createTargets([[1, 2, 3]]))]
+    self.assertTrue(matrix.update(results))
+    self.assertEqual(matrix.seriesNumbers, [5, 7])
+    self.assertEqual(matrix.positions.shape, (2, 2, 3))
+    displacements = matrix.getDisplacements(currentPositions=[[2, 2, 2], [1, 1, 2]])
+    self.assertEqual(displacements.shape, (3, 2, 3))
+    numpy.testing.assert_array_equal(displacements[0], numpy.zeros((2, 3)))
+    numpy.testing.assert_array_equal(displacements[1, 0], [1, 2, 3])
+    self.assertTrue(numpy.isnan(displacements[1, 1]).all())
+    numpy.testing.assert_array_equal(displacements[2, 0], [1, 0, -1])
+
+  def test_Update_detects_changes(self):
+    matrix = TargetDisplacementMatrix()
+    results = [self.Result("5: needle", 5, self.createTargets([[0, 0, 0]]))]
+    self.assertTrue(matrix.update(results))
+    self.assertFalse(matrix.update(results))
+    results[0].targets.approved = self.createTargets([[1, 0, 0]])
+    self.assertTrue(matrix.update(results))
+    numpy.testing.assert_array_equal(matrix.positions[0, 0], [1, 0, 0])
+    results[0].targets.approved.SetNthFiducialPositionFromArray(0, [2, 0, 0])
+    self.assertTrue(matrix.update(results))
+    numpy.testing.assert_array_equal(matrix.positions[0, 0], [2, 0, 0])
+    self.assertFalse(matrix.update(results))
+    results[0].targets.approved.AddFiducialFromArray([3, 0, 0], "T1")
+    self.assertTrue(matrix.update(results))
+    self.assertEqual(matrix.numberOfTargets, 2)
+    self.assertTrue(matrix.update([]))
+    self.assertEqual(matrix.positions.shape[0], 0)